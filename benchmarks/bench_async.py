@@ -0,0 +1,58 @@
+"""Reading many sensors from one asyncio thread.
+
+Reads N ultrasonic sensors from an emulator that takes LATENCY seconds to
+answer: awaiting each read in turn, then all at once with asyncio.gather(),
+which sends them in one write.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_async.py
+"""
+import asyncio
+import time
+
+from memebot import memebot
+
+LATENCY = 0.005
+COUNTS = [1, 8, 16, 32]
+REPEAT = 20
+
+
+def make_bot(count):
+    config = "\n".join("ultrasound %i sonar%i" % (port, port)
+                       for port in range(1, count + 1))
+    bot = memebot.configure("connection emulator\n" + config)
+    bot.conn.s.latency = LATENCY
+    return bot
+
+
+async def one_by_one(bot):
+    for sensor in bot.sensors():
+        await sensor.read()
+
+
+async def gathered(bot):
+    await asyncio.gather(*[sensor.read() for sensor in bot.sensors()])
+
+
+async def timed(bot, read):
+    start = time.perf_counter()
+    for i in range(REPEAT):
+        await read(bot)
+    return (time.perf_counter() - start) / REPEAT
+
+
+async def main():
+    print("%8s %14s %14s" % ("sensors", "one by one", "gathered"))
+    for count in COUNTS:
+        bot = make_bot(count)
+        # Let the window open up to the board before timing anything
+        await timed(bot, gathered)
+        sequential = await timed(bot, one_by_one)
+        together = await timed(bot, gathered)
+        print("%8i %12.1fms %12.1fms" % (
+            count, sequential * 1e3, together * 1e3))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
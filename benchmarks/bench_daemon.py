@@ -0,0 +1,85 @@
+"""What going through ``memebot serve`` costs per request.
+
+Times COUNT round trips, one at a time, against an emulator that answers
+straight away: first from a bot with the port to itself, then from a bot
+connected to a daemon.Server owning the same kind of port.  The difference
+is the daemon's overhead.  The emulator doesn't pace writes like a real
+link, so everything goes at control priority to skip admission control.
+Then CLIENTS bots read the same sensor at once
+through the daemon, to show how many reads reach the board.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_daemon.py
+"""
+import os
+import tempfile
+import threading
+
+from memebot import bench
+from memebot import communication
+from memebot import daemon
+from memebot import memebot
+
+COUNT = 2000
+CLIENTS = 4
+READS = 500
+
+
+def round_trips(bot):
+    rtts = []
+    for i in range(COUNT):
+        message = communication.UltrasonicSensorRead(10)
+        bot.send(message, priority=communication.PRIORITY_CONTROL)
+        if message.wait(1):
+            rtts.append(message.rtt)
+    return bench.percentiles(rtts)
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), "memebot.sock")
+    direct = memebot.configure("connection emulator")
+    server = daemon.Server(memebot.configure("connection emulator").conn,
+                           path)
+    server.start()
+    client = memebot.configure("", connection="unix:" + path)
+    print("%-8s %9s %9s %9s" % ("", "p50", "p90", "p99"))
+    results = {}
+    for name, bot in [("direct", direct), ("daemon", client)]:
+        results[name] = round_trips(bot)
+        print("%-8s %7.3fms %7.3fms %7.3fms" % (
+            name, results[name][50] * 1e3, results[name][90] * 1e3,
+            results[name][99] * 1e3))
+    print("overhead %7.3fms %7.3fms %7.3fms" % tuple(
+        (results["daemon"][p] - results["direct"][p]) * 1e3
+        for p in (50, 90, 99)))
+
+    clients = [memebot.configure("", connection="unix:" + path)
+               for i in range(CLIENTS)]
+    board = server.conn.s
+    before = len(board.frames_for(1))
+    deduplicated = server.stats["deduplicated"]
+    answered = []
+
+    def read(bot):
+        messages = [communication.UltrasonicSensorRead(10)
+                    for i in range(READS)]
+        for message in messages:
+            bot.send(message, priority=communication.PRIORITY_CONTROL)
+        answered.extend(message for message in messages if message.wait(2))
+
+    threads = [threading.Thread(target=read, args=(bot,)) for bot in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("%d clients sent %d reads, %d answered; %d reached the board "
+          "(%d shared)" % (
+              CLIENTS, CLIENTS * READS, len(answered),
+              len(board.frames_for(1)) - before,
+              server.stats["deduplicated"] - deduplicated))
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""How fast can an LED strip be refreshed, by strip length?
+
+Each frame is encoded by LEDStrip against the emulator, and the refresh rate
+is limited by whichever is slower: encoding the frame, or getting its bytes
+over the 115200 baud link.  Frames go at control priority, as the emulator
+doesn't pace writes like a real link.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_led_strip.py
+"""
+import timeit
+
+import numpy
+
+from memebot import communication
+from memebot import memebot
+from memebot.emulator import wire_time
+
+LENGTHS = [8, 15, 30, 60, 120, 240]
+FRAMES = 200
+
+
+def make_strip():
+    bot = memebot.Bot()
+    bot.start("emulator")
+    bot.add_device("strip", "led_strip", 6, 2)
+    return bot, bot.conn.s
+
+
+def frames_for(pattern, length):
+    rng = numpy.random.RandomState(0)
+    frames = []
+    for i in range(FRAMES):
+        if pattern == "full":
+            frame = rng.randint(0, 256, (length, 3))
+        elif pattern == "solid":
+            frame = numpy.tile(rng.randint(0, 256, 3), (length, 1))
+        else:
+            # One pixel moving along the strip
+            frame = numpy.zeros((length, 3))
+            frame[i % length] = [255, 255, 255]
+        frames.append(frame.astype(numpy.uint8))
+    return frames
+
+
+def bench(pattern, length):
+    bot, port = make_strip()
+    frames = frames_for(pattern, length)
+    # The first frame always sends every pixel
+    bot.strip.show(frames[-1])
+    start_bytes = port.bytes_written
+    it = iter(frames)
+    elapsed = timeit.timeit(
+        lambda: bot.strip.show(next(it), communication.PRIORITY_CONTROL),
+        number=FRAMES)
+    per_frame = (port.bytes_written - start_bytes) / FRAMES
+    encode = elapsed / FRAMES
+    wire = wire_time(per_frame)
+    return per_frame, encode, wire, 1.0 / max(encode, wire)
+
+
+def main():
+    print("%-7s %6s %10s %11s %10s %9s" % (
+        "pattern", "pixels", "bytes/frm", "encode(us)", "wire(ms)", "max fps"))
+    for pattern in ["full", "solid", "moving"]:
+        for length in LENGTHS:
+            per_frame, encode, wire, fps = bench(pattern, length)
+            print("%-7s %6i %10.0f %11.1f %10.2f %9.1f" % (
+                pattern, length, per_frame, encode * 1e6, wire * 1e3, fps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Sending a common sequence of commands as Messages and as a Macro.
+
+The sequence stops the motors, clears an LED, shows 0 on the display and
+zeroes an encoder.  Each is sent COUNT times to the emulator, at control
+priority as the emulator doesn't pace writes like a real link: once by
+making and encoding the Messages every time, once from a Macro, and once
+from a Macro with a slot set every time.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_macro.py
+"""
+import time
+
+from memebot import communication
+from memebot import emulator
+
+COUNT = 20000
+
+
+def sequence():
+    return [
+        communication.MotorMove(0, 0),
+        communication.RgbLedDisplay(6, 2, 0, 0, 0, 0),
+        communication.SevenSegmentDisplay(7, 0),
+        communication.EncoderMotorSetCurPosZero(1),
+    ]
+
+
+def run(name, send):
+    port = emulator.EmulatedSerial()
+    manager = communication.Connection(port).manager
+    start = time.perf_counter()
+    for i in range(COUNT):
+        send(manager, i)
+    elapsed = time.perf_counter() - start
+    print("%-16s %8.2fus a sequence  %5.2f writes a sequence" % (
+        name, elapsed / COUNT * 1e6, manager.stats["writes"] / float(COUNT)))
+
+
+def main():
+    control = communication.PRIORITY_CONTROL
+    macro = communication.Macro(sequence(), priority=control)
+    shown = communication.Macro(sequence(), priority=control,
+                                number=(2, "number"))
+    run("messages", lambda manager, i: manager.send_many(sequence(), control))
+    run("macro", lambda manager, i: manager.send(macro))
+    run("macro with slot",
+        lambda manager, i: manager.send(shown.set(number=float(i))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Goodput and resync latency of the response decoder on a noisy link.
+
+Builds a stream of FLOAT responses, where response i has ext_id i & 0xff
+and the value i, flips bits at several bit error rates, and feeds it to a
+protocol.FrameDecoder in 64 byte reads.  For each rate it prints:
+
+goodput
+    the share of responses decoded with the right value
+undetected
+    responses decoded with the wrong value; there's no checksum, so a flip
+    inside a value gets through
+resync
+    bytes (and milliseconds at BAUDRATE) from each flipped bit to the start
+    of the next response decoded right
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_noise.py
+"""
+import bisect
+import random
+import struct
+import time
+
+from memebot import protocol
+
+COUNT = 100000
+BAUDRATE = 115200
+CHUNK = 64
+RATES = [0, 1e-5, 1e-4, 1e-3, 1e-2]
+SEED = 42
+
+
+def stream():
+    return bytearray(b"".join(
+        b"\xff\x55" + bytes([i & 0xff, protocol.FLOAT])
+        + struct.pack("<f", i) + b"\r\n" for i in range(COUNT)))
+
+
+def add_noise(data, rate, rng):
+    """Flips each bit with probability rate, returning where"""
+    errors = []
+    bits = len(data) * 8
+    if not rate:
+        return errors
+    position = 0
+    while True:
+        # The gap to the next flip is geometric
+        position += int(rng.expovariate(rate)) + 1
+        if position >= bits:
+            return errors
+        data[position // 8] ^= 1 << (position % 8)
+        errors.append(position // 8)
+
+
+def run(rate, frame_size):
+    data = stream()
+    errors = add_noise(data, rate, random.Random(SEED))
+    decoder = protocol.FrameDecoder()
+    good_starts = []
+    undetected = 0
+    start = time.perf_counter()
+    for offset in range(0, len(data), CHUNK):
+        for frame, ext_id, value in decoder.feed(data[offset:offset + CHUNK]):
+            if ext_id is None:
+                continue
+            index = int(value) if value == value and abs(value) < 2 ** 31 \
+                else -1
+            if value == index and index & 0xff == ext_id \
+                    and 0 <= index < COUNT:
+                good_starts.append(index * frame_size)
+            else:
+                undetected += 1
+    elapsed = time.perf_counter() - start
+    good_starts.sort()
+    resyncs = []
+    for error in errors:
+        i = bisect.bisect_right(good_starts, error)
+        if i < len(good_starts):
+            resyncs.append(good_starts[i] - error)
+    return {
+        "errors": len(errors),
+        "goodput": len(good_starts) / float(COUNT),
+        "undetected": undetected,
+        "resync_mean": sum(resyncs) / float(len(resyncs)) if resyncs else 0,
+        "resync_max": max(resyncs) if resyncs else 0,
+        "stats": decoder.stats,
+        "bytes_per_second": len(data) / elapsed,
+    }
+
+
+def main():
+    frame_size = len(stream()) // COUNT
+    byte_time = 10.0 / BAUDRATE * 1e3
+    print("%d responses of %d bytes, %d byte reads" % (
+        COUNT, frame_size, CHUNK))
+    print("%8s %7s %8s %10s %15s %15s %8s %9s %10s" % (
+        "ber", "flips", "goodput", "undetected", "resync mean",
+        "resync max", "corrupt", "truncated", "decode"))
+    for rate in RATES:
+        result = run(rate, frame_size)
+        stats = result["stats"]
+        print("%8g %7d %7.2f%% %10d %6.1fB %5.2fms %6dB %5.2fms "
+              "%8d %9d %6.1fMB/s" % (
+                  rate, result["errors"], result["goodput"] * 100,
+                  result["undetected"], result["resync_mean"],
+                  result["resync_mean"] * byte_time, result["resync_max"],
+                  result["resync_max"] * byte_time, stats["corrupt"],
+                  stats["truncated"], result["bytes_per_second"] / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""How long does refreshing every sensor take, one by one or all at once?
+
+Reads N ultrasonic sensors from an emulator that takes LATENCY seconds to
+answer: first each sensor in turn, waiting for its reply, then with
+Bot.read_all().
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_read_all.py
+"""
+import time
+
+from memebot import memebot
+
+LATENCY = 0.005
+COUNTS = [1, 4, 8, 16]
+REPEAT = 20
+
+
+def make_bot(count):
+    config = "\n".join("ultrasound %i sonar%i" % (port, port)
+                       for port in range(1, count + 1))
+    bot = memebot.configure("connection emulator\n" + config)
+    bot.conn.s.latency = LATENCY
+    return bot
+
+
+def one_by_one(bot):
+    for sensor in bot.sensors():
+        message = sensor.request()
+        bot.manager.send(message)
+        message.wait(1)
+
+
+def all_at_once(bot):
+    bot.read_all(timeout=1)
+
+
+def timed(function, bot):
+    start = time.perf_counter()
+    for i in range(REPEAT):
+        function(bot)
+    return (time.perf_counter() - start) / REPEAT
+
+
+def main():
+    print("latency %.1fms" % (LATENCY * 1e3))
+    for count in COUNTS:
+        bot = make_bot(count)
+        print("%3i sensors  one by one %7.2fms  read_all %7.2fms" % (
+            count, timed(one_by_one, bot) * 1e3,
+            timed(all_at_once, bot) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
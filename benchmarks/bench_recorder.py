@@ -0,0 +1,69 @@
+"""Writing and loading a day of sensor history.
+
+Times Recorder.add() over ADDS records, then writes a day of RATE Hz
+readings from each of DEVICES devices in the Recorder's format and times
+loading it back with recorder.load() and working out each device's mean.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_recorder.py
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from memebot import recorder
+
+ADDS = 200000
+RATE = 50
+DEVICES = 6
+DAY = 24 * 3600
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        rec = recorder.Recorder(directory)
+        start = time.perf_counter()
+        for i in range(ADDS):
+            rec.add("front", i * 0.02, 25.0)
+        elapsed = time.perf_counter() - start
+        rec.close()
+        print("add()   %.2fus a record" % (elapsed / ADDS * 1e6))
+        shutil.rmtree(directory)
+        os.makedirs(directory)
+
+        # A day is too many records to add() one at a time here, so the
+        # columns are written as a Recorder writes them
+        records = RATE * DAY
+        times = numpy.arange(records, dtype="<f8") / RATE
+        values = numpy.sin(times).astype("<f4")
+        for device in range(DEVICES):
+            name = "sensor%d" % device
+            with open(os.path.join(directory, name + recorder.TIME),
+                      "wb") as f:
+                times.tofile(f)
+            with open(os.path.join(directory, name + recorder.VALUE),
+                      "wb") as f:
+                values.tofile(f)
+        size = DEVICES * records * 12
+
+        start = time.perf_counter()
+        log = recorder.load(directory)
+        loaded = time.perf_counter() - start
+        means = dict((name, values.mean())
+                     for name, (times, values) in log.items())
+        scanned = time.perf_counter() - start - loaded
+        print("load()  %.2fms for %d devices x %d records (%.0fMB)" % (
+            loaded * 1e3, len(log), records, size / 1e6))
+        print("mean of every value  %.0fms" % (scanned * 1e3))
+        assert len(means) == DEVICES
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""How long until a Bot is ready to use?
+
+Times, each in a fresh interpreter: importing memebot.memebot, and
+configure() against the emulator up to the end of the startup probe.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_startup.py
+"""
+import subprocess
+import sys
+
+RUNS = 10
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+from memebot import memebot
+imported = time.perf_counter()
+bot = memebot.configure('''
+connection emulator
+ultrasound 10
+light_sensor 6
+led_strip 7+1
+''')
+ready = time.perf_counter()
+print(imported - start, ready - imported, bot.rtt)
+"""
+
+
+def run_once():
+    output = subprocess.check_output([sys.executable, "-c", SCRIPT])
+    return [float(v) for v in output.split()]
+
+
+def main():
+    results = [run_once() for i in range(RUNS)]
+    for i, label in enumerate(["import", "configure", "probe rtt"]):
+        values = sorted(r[i] for r in results)
+        print("%-10s median %7.2fms  max %7.2fms" % (
+            label, values[len(values) // 2] * 1e3, values[-1] * 1e3))
+
+
+if __name__ == "__main__":
+    main()
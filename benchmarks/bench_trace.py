@@ -0,0 +1,45 @@
+"""What tracing costs a round trip.
+
+Reads a sensor from the emulator COUNT times, one request at a time, at
+control priority as the emulator doesn't pace writes like a real link:
+once with nothing hooked and once with a trace.Tracer recording every
+send, write, byte, parse, dispatch and callback.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_trace.py
+"""
+import time
+
+from memebot import communication
+from memebot import emulator
+from memebot import trace
+
+COUNT = 5000
+
+
+def run(name, traced):
+    conn = communication.Connection(emulator.EmulatedSerial())
+    manager = conn.manager
+    manager.launch()
+    tracer = trace.Tracer(manager)
+    if traced:
+        tracer.start()
+    start = time.perf_counter()
+    for i in range(COUNT):
+        message = communication.UltrasonicSensorRead(10)
+        manager.send(message, communication.PRIORITY_CONTROL)
+        message.wait(1)
+    elapsed = time.perf_counter() - start
+    tracer.stop()
+    print("%-10s %8.2fus a round trip  %6i events" % (
+        name, elapsed / COUNT * 1e6, len(tracer.events)))
+
+
+def main():
+    run("untraced", False)
+    run("traced", True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Requests per second through the in-flight window, fixed and adaptive.
+
+The emulator takes LATENCY seconds to answer and drops requests once it
+has RX_BUFFER of them to answer, like the firmware's receive buffer
+overflowing.  Each run sends COUNT sensor reads as fast as the window lets
+it: first with the window pinned at a few sizes, then adapting.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_window.py
+"""
+import time
+
+from memebot import communication
+from memebot import emulator
+
+LATENCY = 0.005
+RX_BUFFER = 4
+COUNT = 1000
+
+
+def run(window=None):
+    port = emulator.EmulatedSerial(latency=LATENCY, rx_buffer=RX_BUFFER)
+    conn = communication.Connection(port)
+    manager = conn.manager
+    if window is not None:
+        manager.window = manager.min_window = manager.max_window = window
+    manager.launch()
+    messages = [communication.UltrasonicSensorRead(10) for i in range(COUNT)]
+    start = time.perf_counter()
+    for message in messages:
+        manager.send(message)
+    for message in messages:
+        message.wait(5)
+    elapsed = time.perf_counter() - start
+    answered = sum(1 for message in messages if message.error is None)
+    return answered / elapsed, port.dropped, manager.window
+
+
+def main():
+    print("latency %.1fms, board buffer %i requests" % (
+        LATENCY * 1e3, RX_BUFFER))
+    for window in [1, 2, 4, 8, None]:
+        rate, dropped, final = run(window)
+        label = "adaptive" if window is None else "fixed %i" % window
+        print("%-10s %7.0f answered/s  %4i dropped  window %.1f" % (
+            label, rate, dropped, final))
+
+
+if __name__ == "__main__":
+    main()
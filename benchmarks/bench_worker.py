@@ -0,0 +1,80 @@
+"""Round trips with the port in this process and in a worker process, while
+threads here keep the interpreter busy.
+
+Each run times COUNT sensor reads, one at a time, against an emulator
+taking LATENCY to answer, with BUSY threads spinning in pure Python
+alongside.  With the port in this process, the thread reading it has to win
+the interpreter lock back for every read; with worker.WorkerConnection the
+child process takes the bytes off the port however busy this one is.
+
+"delivered" is how long each read took to reach the thread waiting on it,
+and "wire" how long the response took to come off the port, which is what
+the Manager's round trip estimate and window go by.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/bench_worker.py
+"""
+import functools
+import threading
+
+from memebot import bench
+from memebot import communication
+from memebot import emulator
+from memebot import worker
+
+COUNT = 300
+LATENCY = 0.002
+BUSY = [0, 2, 4]
+
+
+def spin(stop):
+    n = 0
+    while not stop.is_set():
+        n = (n * 31 + 7) % 1000003
+
+
+def run(conn, busy):
+    stop = threading.Event()
+    spinners = [threading.Thread(target=spin, args=(stop,))
+                for i in range(busy)]
+    for spinner in spinners:
+        spinner.start()
+    rtts = []
+    conn.manager.rtts.clear()
+    try:
+        for i in range(COUNT):
+            message = communication.UltrasonicSensorRead(10)
+            conn.manager.send(message)
+            if message.wait(1):
+                rtts.append(message.rtt)
+    finally:
+        stop.set()
+        for spinner in spinners:
+            spinner.join()
+    return (bench.percentiles(rtts), bench.percentiles(conn.manager.rtts),
+            COUNT - len(rtts))
+
+
+def main():
+    port = functools.partial(emulator.EmulatedSerial, latency=LATENCY)
+    print("%-7s %4s  %-19s  %-19s %4s" % (
+        "port in", "busy", "delivered p50   p99", "wire p50      p99",
+        "lost"))
+    for name in ["this", "worker"]:
+        if name == "worker":
+            conn = worker.WorkerConnection(port)
+        else:
+            conn = communication.Connection(port())
+        conn.manager.launch()
+        for busy in BUSY:
+            delivered, wire, lost = run(conn, busy)
+            print("%-7s %4d  %7.2fms %7.2fms  %7.2fms %7.2fms %4d" % (
+                name, busy, delivered[50] * 1e3, delivered[99] * 1e3,
+                wire[50] * 1e3, wire[99] * 1e3, lost))
+        if name == "worker":
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
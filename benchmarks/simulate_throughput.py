@@ -0,0 +1,49 @@
+"""How many sensor reads a second would a configuration get?
+
+Runs a scheduler polling N ultrasonic sensors as fast as it's allowed, for
+DURATION seconds of virtual time against a simulated board that takes
+LATENCY seconds over each request, and reports what got through.  Nothing
+here waits in real time.
+
+Run from the top of the checkout with:
+
+    PYTHONPATH=. python benchmarks/simulate_throughput.py
+"""
+import time
+
+from memebot import simulation
+
+DURATION = 10
+SENSORS = [1, 4, 8]
+LATENCIES = [0.0005, 0.002, 0.005]
+
+
+def estimate(sensors, latency):
+    sim = simulation.Simulation()
+    config = "\n".join("ultrasound %i sonar%i" % (port, port)
+                       for port in range(1, sensors + 1))
+    bot = sim.bot(config, latency=latency, rx_buffer=4)
+    bot.scheduler(rate=1000, max_rate=1000).start()
+    start = sim.now
+    received = bot.manager.stats["received"]
+    sim.run(DURATION)
+    elapsed = sim.now - start
+    return ((bot.manager.stats["received"] - received) / elapsed,
+            bot.conn.utilization(), bot.manager.stats["timeouts"])
+
+
+def main():
+    started = time.time()
+    for latency in LATENCIES:
+        for sensors in SENSORS:
+            rate, utilization, timeouts = estimate(sensors, latency)
+            print("latency %4.1fms  %2i sensors  %6.0f reads/s  "
+                  "link %3.0f%%  %i timeouts" % (
+                      latency * 1e3, sensors, rate, utilization * 100,
+                      timeouts))
+    print("(%.1fs of real time for %is simulated each)" % (
+        time.time() - started, DURATION))
+
+
+if __name__ == "__main__":
+    main()
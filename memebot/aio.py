@@ -0,0 +1,103 @@
+"""Bot devices from asyncio.
+
+Inside a running event loop, Sensor.read() and the set() of the output
+devices return futures instead of blocking, so one thread can drive any
+number of devices at once::
+
+    front, light, done = await asyncio.gather(
+        bot.front.read(), bot.light.read(), bot.number_display.set(5))
+
+Everything the loop's coroutines send before it next gets control is
+collected by a Sender and goes out in one send_many(), in a worker thread
+so that waiting for room in the window doesn't hold up the loop: the reads
+above are one write to the board.
+"""
+import asyncio
+import functools
+
+
+class Sender(object):
+    """Sends messages for coroutines on loop, a loop iteration at a time"""
+
+    def __init__(self, manager, loop):
+        self.manager = manager
+        self.loop = loop
+        self._queue = []
+
+    def __repr__(self):
+        return "<Sender %s queued>" % len(self._queue)
+
+    def send(self, message):
+        """Returns a future that's done when message has been written"""
+        future = self.loop.create_future()
+        if not self._queue:
+            self.loop.call_soon(self._next_iteration)
+        self._queue.append((message, future))
+        return future
+
+    def _next_iteration(self):
+        # Tasks started alongside this one (by gather(), say) get their
+        # first step in before the flush
+        self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        batch, self._queue = self._queue, []
+        written = self.loop.run_in_executor(
+            None, self.manager.send_many, [message for message, f in batch])
+        written.add_done_callback(functools.partial(self._written, batch))
+
+    def _written(self, batch, written):
+        error = None
+        if written.cancelled():
+            error = asyncio.CancelledError()
+        else:
+            error = written.exception()
+        for message, future in batch:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+
+def sender(bot, loop):
+    """The bot's Sender for loop"""
+    current = bot._sender
+    if current is None or current.loop is not loop:
+        current = bot._sender = Sender(bot.manager, loop)
+    return current
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def _reject(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+
+async def read(sensor):
+    """Returns the sensor's next value, after updating it as update() would
+
+    Raises communication.RequestTimeout if the board doesn't answer, or
+    whatever stopped the request going out.
+    """
+    loop = asyncio.get_running_loop()
+    message = sensor.request()
+    result = loop.create_future()
+    update = message.callback
+
+    def on_value(value):
+        update(value)
+        loop.call_soon_threadsafe(_resolve, result, value)
+
+    def on_error(error):
+        loop.call_soon_threadsafe(_reject, result, error)
+
+    message.callback = on_value
+    message.errback = on_error
+    await sender(sensor.bot, loop).send(message)
+    return await result
@@ -0,0 +1,176 @@
+"""Benchmarks of the communication layer, as run by ``memebot bench``.
+
+Each benchmark returns a dict of results; format_results() lays them out for
+printing.
+"""
+import struct
+import threading
+import time
+
+from . import communication
+from . import emulator
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return dict((p, None) for p in points)
+    return dict((p, values[min(int(len(values) * p / 100.0), len(values) - 1)])
+                for p in points)
+
+
+def sample_messages():
+    return [
+        communication.UltrasonicSensorRead(10),
+        communication.SevenSegmentDisplay(7, 42),
+        communication.MotorMove(100, -100),
+        communication.RgbLedDisplay(6, 2, 1, 255, 128, 0),
+    ]
+
+
+def bench_encode(count=10000):
+    messages = sample_messages()
+    buffer = communication.WriteBuffer()
+    start = time.perf_counter()
+    for i in range(count):
+        for message in messages:
+            message.send(buffer)
+    elapsed = time.perf_counter() - start
+    total = count * len(messages)
+    return {
+        "name": "encode",
+        "messages": total,
+        "seconds": elapsed,
+        "per_second": total / elapsed,
+        "bytes_per_second": len(buffer.data) / elapsed,
+    }
+
+
+def sample_responses():
+    return [
+        b"\xff\x55" + bytes([0xa1, 2]) + struct.pack("<f", 123.5) + b"\r\n",
+        b"\xff\x55" + bytes([0x3d, 6]) + struct.pack("<l", 100000) + b"\r\n",
+        b"\xff\x55\r\n",
+    ]
+
+
+def bench_decode(count=2000):
+    conn = communication.Connection(emulator.EmulatedSerial())
+    data = b"".join(sample_responses()) * count
+    frames = count * len(sample_responses())
+    start = time.perf_counter()
+    for i in range(len(data)):
+        conn.on_byte(data[i:i + 1])
+    elapsed = time.perf_counter() - start
+    return {
+        "name": "decode",
+        "messages": frames,
+        "seconds": elapsed,
+        "per_second": frames / elapsed,
+        "bytes_per_second": len(data) / elapsed,
+    }
+
+
+def bench_round_trip(manager, count=500, window=1):
+    """Sends version requests with up to window of them waiting at once"""
+    rtts = []
+    pending = []
+    start = time.perf_counter()
+    for i in range(count):
+        message = communication.VersionRead()
+        manager.send(message)
+        pending.append(message)
+        if len(pending) >= window:
+            message = pending.pop(0)
+            if message.wait(1):
+                rtts.append(message.rtt)
+    for message in pending:
+        if message.wait(1):
+            rtts.append(message.rtt)
+    elapsed = time.perf_counter() - start
+    result = {
+        "name": "round trip (window %s)" % window,
+        "messages": count,
+        "seconds": elapsed,
+        "per_second": count / elapsed,
+        "lost": count - len(rtts),
+    }
+    for point, value in percentiles(rtts).items():
+        result["p%s" % point] = value
+    return result
+
+
+def bench_contention(threads=8, count=500):
+    """Sends sensor reads from threads at once, timing each send()
+
+    Runs against the emulator, where every thread reads its own port and
+    gets the port number back, so a response that went to the wrong request
+    shows up as a mismatch.  The emulator doesn't pace writes like a real
+    link, so the reads go at control priority to skip admission control.
+    """
+    values = dict(((1, port), port) for port in range(1, threads + 1))
+    conn = communication.Connection(emulator.EmulatedSerial(values=values))
+    manager = conn.manager
+    manager.launch()
+    send_times = []
+    mismatched = []
+    lost = []
+
+    def producer(port):
+        times = []
+        messages = []
+        for i in range(count):
+            message = communication.UltrasonicSensorRead(port)
+            started = time.perf_counter()
+            manager.send(message, communication.PRIORITY_CONTROL)
+            times.append(time.perf_counter() - started)
+            messages.append(message)
+        for message in messages:
+            if not message.wait(2):
+                lost.append(message)
+            elif message.value != port:
+                mismatched.append(message)
+        send_times.extend(times)
+
+    workers = [threading.Thread(target=producer, args=(port,))
+               for port in range(1, threads + 1)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    total = threads * count
+    result = {
+        "name": "contention (%s threads)" % threads,
+        "messages": total,
+        "seconds": elapsed,
+        "per_second": total / elapsed,
+        "lost": len(lost),
+        "mismatched": len(mismatched),
+        "writes": manager.stats["writes"],
+    }
+    for point, value in percentiles(send_times).items():
+        result["send_p%s" % point] = value
+    return result
+
+
+def format_results(results):
+    lines = []
+    for result in results:
+        line = "%-22s %9.0f msg/s" % (result["name"], result["per_second"])
+        if "bytes_per_second" in result:
+            line += "  %9.0f bytes/s" % result["bytes_per_second"]
+        if "p50" in result and result["p50"] is not None:
+            line += "  rtt p50 %.3fms p90 %.3fms p99 %.3fms" % (
+                result["p50"] * 1e3, result["p90"] * 1e3, result["p99"] * 1e3)
+        if "send_p50" in result and result["send_p50"] is not None:
+            line += "  send p50 %.3fms p99 %.3fms, %.1f msg/write" % (
+                result["send_p50"] * 1e3, result["send_p99"] * 1e3,
+                result["messages"] / max(result["writes"], 1))
+        if result.get("mismatched"):
+            line += "  (%s mismatched)" % result["mismatched"]
+        if result.get("lost"):
+            line += "  (%s lost)" % result["lost"]
+        lines.append(line)
+    return "\n".join(lines)
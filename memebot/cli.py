@@ -2,17 +2,149 @@
 
 """Console script for memebot."""
 import sys
+import time
+
 import click
 
+from . import bench as benchmarks
+from . import daemon
+from . import emulator
+from . import memebot
+from . import soak as soaks
+
 
-@click.command()
+@click.group()
 def main(args=None):
     """Console script for memebot."""
-    click.echo("Replace this message by putting your code into "
-               "memebot.cli.main")
-    click.echo("See click documentation at http://click.pocoo.org/")
+
+
+@main.command()
+@click.option("--port", default="emulator",
+              help="Serial port, 'auto' to look for one, or 'emulator'")
+@click.option("--count", default=500, help="Round trips to time")
+@click.option("--window", default=4,
+              help="Requests in flight at once for the pipelined round trip")
+@click.option("--threads", default=8,
+              help="Threads sending at once for the contention benchmark")
+def bench(port, count, window, threads):
+    """Time encoding, decoding and round trips."""
+    results = [
+        benchmarks.bench_encode(count * 10),
+        benchmarks.bench_decode(count),
+    ]
+    bot = memebot.configure("", connection=port)
+    results.append(benchmarks.bench_round_trip(bot.manager, count))
+    results.append(benchmarks.bench_round_trip(bot.manager, count, window))
+    results.append(benchmarks.bench_contention(1, count))
+    results.append(benchmarks.bench_contention(threads, count))
+    click.echo(benchmarks.format_results(results))
     return 0
 
 
+def monitor_lines(bot, previous, elapsed):
+    manager, conn = bot.manager, bot.conn
+    usage = conn.usage()
+    rtts = benchmarks.percentiles(manager.rtts)
+    lines = [
+        "memebot monitor - %s" % time.strftime("%H:%M:%S"),
+        "",
+        "messages  sent %7.1f/s  received %7.1f/s  in flight %i/%i" % (
+            (manager.stats["sent"] - previous["sent"]) / elapsed,
+            (manager.stats["received"] - previous["received"]) / elapsed,
+            manager.in_flight(), manager.window),
+        "link      out %6.0f B/s  in %6.0f B/s  utilization %5.1f%%" % (
+            usage["out_per_second"], usage["in_per_second"],
+            usage["utilization"] * 100),
+    ]
+    if rtts[50] is not None:
+        lines.append("rtt       p50 %.2fms  p90 %.2fms  p99 %.2fms" % (
+            rtts[50] * 1e3, rtts[90] * 1e3, rtts[99] * 1e3))
+    else:
+        lines.append("rtt       -")
+    lines.append("reconnects %(reconnects)i  stalls %(stalls)i  "
+                 "failed %(failed)i  rejected %(rejected)i" % conn.stats
+                 + "  timeouts %(timeouts)i" % manager.stats)
+    if conn.heartbeat.interval is not None:
+        lines.append("keepalive every %.1fms  jitter %.1fms" % (
+            conn.heartbeat.interval * 1e3, conn.heartbeat.jitter * 1e3))
+    lines.extend(["", "%-20s %12s %10s" % ("sensor", "value", "age")])
+    now = time.time()
+    for sensor in bot.sensors():
+        if sensor.last_value_time is None:
+            age = "-"
+        else:
+            age = "%.2fs" % (now - sensor.last_value_time)
+        lines.append("%-20s %12s %10s" % (sensor.name, sensor.last_value, age))
+    return lines
+
+
+@main.command()
+@click.argument("port")
+@click.option("--config", type=click.File(), help="Bot configuration")
+@click.option("--rate", default=10, help="Sensor polls per second")
+@click.option("--interval", default=1.0, help="Seconds between refreshes")
+@click.option("--iterations", default=0, help="Stop after this many refreshes")
+def monitor(port, config, rate, interval, iterations):
+    """Show live link and sensor statistics for a bot."""
+    bot = memebot.configure(config.read() if config else "", connection=port)
+    bot.scheduler(rate=rate).start()
+    count = 0
+    last = time.monotonic()
+    previous = dict(bot.manager.stats)
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        lines = monitor_lines(bot, previous, max(now - last, 1e-6))
+        last, previous = now, dict(bot.manager.stats)
+        if sys.stdout.isatty():
+            click.clear()
+        click.echo("\n".join(lines))
+        count += 1
+        if iterations and count >= iterations:
+            return 0
+
+
+@main.command()
+@click.argument("port")
+@click.option("--socket", "path", default="/tmp/memebot.sock",
+              help="Unix socket to listen on")
+@click.option("--worker", is_flag=True,
+              help="Read and write the port in a worker process")
+def serve(port, path, worker):
+    """Share a board between processes through a Unix socket.
+
+    Clients connect with the connection unix:PATH.
+    """
+    daemon.serve(port, path, worker=worker)
+    return 0
+
+
+@main.command()
+@click.option("--config", type=click.File(),
+              help="Bot configuration (its sensors are read)")
+@click.option("--duration", default=60.0, help="Seconds to run for")
+@click.option("--interval", default=1.0, help="Seconds between samples")
+@click.option("--noise", default=0.0,
+              help="Share of responses with junk in front of them")
+@click.option("--max-memory-growth", default=10.0,
+              help="Traced memory growth to allow, in MB an hour")
+@click.option("--max-latency-growth", default=50.0,
+              help="p99 read time growth to allow, in ms an hour")
+def soak(config, duration, interval, noise, max_memory_growth,
+         max_latency_growth):
+    """Read a bot's sensors from the emulator at full rate, watching for leaks.
+
+    Exits with status 1 if memory or p99 read times grow too fast.
+    """
+    port = emulator.EmulatedSerial(noise=noise, record=False)
+    bot = memebot.configure(config.read() if config else soaks.DEFAULT_CONFIG,
+                            connection=port)
+    report = soaks.Soak(bot, duration=duration, interval=interval,
+                        max_memory_growth=max_memory_growth * 1e6,
+                        max_latency_growth=max_latency_growth / 1e3).run()
+    click.echo(report.format())
+    sys.exit(0 if report.ok else 1)
+
+
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
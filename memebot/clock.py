@@ -0,0 +1,30 @@
+"""Where the communication code and everything on top of it get the time.
+
+Connection, Bot and the loops built on them ask their clock for the time and
+to sleep, instead of the time module, so that simulation.SimClock can stand
+in for it.
+"""
+import time
+
+
+class Clock(object):
+    """The real clocks, and real sleeping"""
+
+    # A simulated clock has no threads to wait on: anything that would block
+    # runs the simulation forward instead
+    simulated = False
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def __repr__(self):
+        return "<Clock>"
+
+
+REAL = Clock()
@@ -1,163 +1,1098 @@
 import serial
+import collections
+import concurrent.futures
+import glob
 import logging
 import struct
+import sys
 import time
 import threading
 
+from . import clock as clocks
+from . import protocol
+from .protocol import COMMANDS
+
 logger = logging.getLogger(__name__)
 
 start_time = int(time.time())
 
-def short2bytes(sval):
-    val = struct.pack("h", sval)
-    return [val[0], val[1]]
-
-def long2bytes(lval):
-    val = struct.pack("=l", lval)
-    return [val[0], val[1], val[2], val[3]]
-
-def float2bytes(fval):
-    val = struct.pack("f", fval)
-    return [val[0], val[1], val[2], val[3]]
-
-def char2byte(cval):
-    val = struct.pack("b", cval)
-    return val[0]
-
-def bytes2string(v):
-    return "".join(chr(b) for b in v)
-
-class Connection:
+def candidate_ports():
+    if sys.platform.startswith('win'):
+        return ['COM%s' % (i + 1) for i in range(256)]
+    elif sys.platform.startswith('darwin'):
+        patterns = ['/dev/tty.usbserial*', '/dev/tty.usbmodem*',
+                    '/dev/tty.wchusbserial*']
+    else:
+        # USB serial adapters (the MegaPi's own CH340 among them), then the
+        # Raspberry Pi header, but not consoles: probing writes to them
+        patterns = ['/dev/ttyUSB*', '/dev/ttyACM*', '/dev/ttyAMA*',
+                    '/dev/serial0']
+    ports = []
+    for pattern in patterns:
+        for port in sorted(glob.glob(pattern)):
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+# Asked for in the version request a probe sends, so the answer can't be
+# anything else's
+PROBE_EXT_ID = 0x5a
+
+def probe_port(port, timeout=1.5, baudrate=115200, opener=serial.Serial):
+    """Opens port and returns it if a MegaPi answers, otherwise None
+
+    Only an answer to the version request sent here counts: a string, with
+    the request's ext_id.  Keepalives, or something echoing what it's sent
+    back, don't.
+    """
+    try:
+        s = opener(port, baudrate=baudrate, timeout=0.05)
+    except (serial.SerialException, OSError) as e:
+        logger.debug("Could not open %s: %s" % (port, e))
+        return None
+    request = bytearray(VersionRead().encode())
+    request[3] = PROBE_EXT_ID
+    decoder = protocol.FrameDecoder()
+    deadline = time.monotonic() + timeout
+    next_request = 0
+    try:
+        while time.monotonic() < deadline:
+            if time.monotonic() >= next_request:
+                # Opening the port may have reset the board, so keep asking
+                s.write(request)
+                next_request = time.monotonic() + 0.25
+            for frame, ext_id, value in decoder.feed(s.read(64)):
+                if ext_id == PROBE_EXT_ID and frame[1] == protocol.STRING:
+                    logger.debug("%s answered with version %r" % (
+                        port, value))
+                    return s
+    except (serial.SerialException, OSError) as e:
+        logger.debug("Error probing %s: %s" % (port, e))
+    s.close()
+    return None
+
+def discover(ports=None, timeout=1.5, opener=serial.Serial):
+    """Probes all the ports at once, returning (port name, open port)
+
+    The first port with a MegaPi on it wins.  Returns (None, None) if
+    nothing answered.
+    """
+    if ports is None:
+        ports = candidate_ports()
+    if not ports:
+        return None, None
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(ports))
+    futures = dict(
+        (pool.submit(probe_port, port, timeout=timeout, opener=opener), port)
+        for port in ports)
+    winner = None
+    for future in concurrent.futures.as_completed(futures):
+        if future.result() is not None:
+            winner = future
+            logger.info("Found a MegaPi on %s" % futures[winner])
+            break
+    # Don't wait on the other probes, but close anything else they find
+    for future in futures:
+        if future is not winner:
+            future.add_done_callback(_close_probed)
+    pool.shutdown(wait=False)
+    if winner is None:
+        return None, None
+    return futures[winner], winner.result()
+
+def _close_probed(future):
+    s = future.result()
+    if s is not None:
+        s.close()
+
+class ConnectionLost(IOError):
+    pass
+
+class LinkSaturated(IOError):
+    pass
+
+class RequestTimeout(IOError):
+    pass
+
+# Control traffic is always let through; normal traffic until the link is
+# full; low priority traffic (like background polling) only up to
+# Connection.ceiling
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class RateMeter(object):
+    """Counts bytes per second over the last window seconds"""
+
+    def __init__(self, window=1.0, bins=10):
+        self.window = window
+        self.bin_width = window / bins
+        self.counts = [0] * bins
+        self.current = 0
+        self.total = 0
+        # When bytes were last added
+        self.last = None
+
+    def _advance(self, now):
+        current = int(now / self.bin_width)
+        if current != self.current:
+            bins = len(self.counts)
+            for i in range(max(self.current + 1, current - bins + 1),
+                           current + 1):
+                self.counts[i % bins] = 0
+            self.current = current
+
+    def add(self, nbytes, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._advance(now)
+        self.counts[self.current % len(self.counts)] += nbytes
+        self.total += nbytes
+        self.last = now
+
+    def rate(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._advance(now)
+        return sum(self.counts) / self.window
+
+class Heartbeat(object):
+    """How often the board's empty keepalive frames come, and how regularly
+
+    interval and jitter are smoothed like a round trip time and its
+    variation, from the gaps between keepalives.
+    """
+
+    def __init__(self):
+        self.interval = self.jitter = None
+        self.last = None
+        self.beats = 0
 
-    def __init__(self, port, baudrate=115200, timeout=10):
-        self.s = serial.Serial(port, baudrate=baudrate, timeout=timeout)
-        self.buffer = []
+    def __repr__(self):
+        if self.interval is None:
+            return "<Heartbeat (%s beats)>" % self.beats
+        return "<Heartbeat every %.3fs +/- %.3fs>" % (
+            self.interval, self.jitter)
+
+    def beat(self, now):
+        if self.last is not None:
+            gap = now - self.last
+            if self.interval is None:
+                self.interval = gap
+                self.jitter = gap / 2
+            else:
+                self.jitter += (abs(gap - self.interval) - self.jitter) / 4
+                self.interval += (gap - self.interval) / 8
+        self.last = now
+        self.beats += 1
+
+    def reset(self):
+        # The gap across an outage says nothing about the board
+        self.last = None
+
+    def lateness(self, now):
+        """How long overdue the next keepalive is, or None if unknown"""
+        if self.interval is None or self.last is None:
+            return None
+        return max(now - self.last - self.interval, 0.0)
+
+def _no_hook(*args):
+    pass
+
+
+class Hookable(object):
+    """Instrumentation hooks, for profilers, tracers and exporters
+
+    add_hook(name, function) calls function(time, ...) at that point, where
+    time is the clock's monotonic().  Frames are passed as memoryviews of the
+    buffers they were read from or written with, so copy them to keep them.
+    With nothing registered a hook point is a call to a shared no-op.
+    """
+
+    hook_names = ()
+
+    def add_hook(self, name, function):
+        if name not in self.hook_names:
+            raise ValueError("No hook %r on %r (there's %s)" % (
+                name, self, ", ".join(self.hook_names)))
+        self._hooks.setdefault(name, []).append(function)
+        self._install_hook(name)
+
+    def remove_hook(self, name, function):
+        hooks = self._hooks.get(name, [])
+        if function in hooks:
+            hooks.remove(function)
+        self._install_hook(name)
+
+    def _install_hook(self, name):
+        hooks = tuple(self._hooks.get(name, ()))
+        if not hooks:
+            call = _no_hook
+        elif len(hooks) == 1:
+            hook = hooks[0]
+
+            def call(*args):
+                hook(self.clock.monotonic(), *args)
+        else:
+            def call(*args):
+                now = self.clock.monotonic()
+                for hook in hooks:
+                    hook(now, *args)
+        setattr(self, name, call)
+        self._hooks_changed()
+
+    def _hooks_changed(self):
+        pass
+
+
+class Connection(Hookable):
+
+    # on_frame_out(time, data) for every write, on_bytes_in(time, data) for
+    # every read, on_frame_parsed(time, frame, ext_id, value) for every
+    # response frame (without the 0xff 0x55 and 0x0d 0x0a).
+    # on_write(time, started, data) is on_frame_out with when the write
+    # started, for timing it.  on_keepalive(time) for every keepalive.
+    hook_names = ("on_frame_out", "on_bytes_in", "on_frame_parsed",
+                  "on_write", "on_keepalive")
+    on_frame_out = on_bytes_in = on_frame_parsed = on_write = \
+        on_keepalive = staticmethod(_no_hook)
+
+    # Delay before the first attempt to reopen a lost port, doubling up to
+    # the maximum
+    reconnect_delay = 0.02
+    max_reconnect_delay = 0.5
+    # Keepalives the board can miss (allowing for their jitter) before the
+    # link counts as stalled and is reopened
+    missed_beats = 3
+
+    def __init__(self, port, baudrate=115200, timeout=0.1, ceiling=0.8,
+                 clock=None):
+        self.clock = clock or clocks.REAL
+        if isinstance(port, str):
+            self.s = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+        else:
+            # Already-open port, like emulator.EmulatedSerial
+            self.s = port
+            baudrate = getattr(port, "baudrate", baudrate)
+        # Bytes a second each way, with a start and stop bit for every byte
+        self.capacity = baudrate / 10.0
+        self.ceiling = ceiling
+        self.outbound = RateMeter()
+        self.inbound = RateMeter()
+        self.connected = True
+        self.stats = {
+            "disconnects": 0,
+            "reconnects": 0,
+            "last_outage": None,
+            "reissued": 0,
+            "failed": 0,
+            "rejected": 0,
+            "stalls": 0,
+        }
+        self.heartbeat = Heartbeat()
+        # Empty frames due back as acknowledgements of commands written, and
+        # how many have come (both under _state_lock), so they aren't taken
+        # for keepalives
+        self._acks_due = 0
+        self._acks_seen = 0
+        # Adds corrupt, truncated, unexpected and skipped_bytes to stats
+        self.decoder = protocol.FrameDecoder(self.stats)
+        self._lost_at = None
+        self._state_lock = threading.Lock()
+        self._hooks = {}
+        self._receive = self.on_byte
         self.manager = Manager(self)
 
     def write(self, v):
-        logger.debug("  Sending bytes %r" % v)
-        self.s.write(v)
+        logger.debug("  Sending bytes %r", v)
+        if not self.connected:
+            raise ConnectionLost("Serial port is reconnecting")
+        # Counted before the write, or an acknowledgement coming straight
+        # back could be taken for a keepalive
+        acks = protocol.acknowledged(v)
+        if acks:
+            with self._state_lock:
+                self._acks_due += acks
+        try:
+            self.s.write(v)
+        except LinkSaturated:
+            # Back-pressure from the port (like a worker's full ring), which
+            # is still there
+            self._forget_acks(acks)
+            raise
+        except (serial.SerialException, OSError) as e:
+            self._forget_acks(acks)
+            self.lost(e)
+            raise ConnectionLost(str(e))
+        self.outbound.add(len(v), self.clock.monotonic())
+        self.on_frame_out(memoryview(v))
+
+    def _forget_acks(self, acks):
+        # For a write that didn't happen
+        if acks:
+            with self._state_lock:
+                self._acks_due -= acks
+                self._acks_seen = min(self._acks_seen, self._acks_due)
+
+    def _hooks_changed(self):
+        # The read loop only pays for on_bytes_in, and writes for timing
+        # themselves, when something's listening
+        if self._hooks.get("on_bytes_in"):
+            self._receive = self._receive_hooked
+        else:
+            self._receive = self.on_byte
+        if self._hooks.get("on_write"):
+            self.write = self._write_timed
+        else:
+            self.__dict__.pop("write", None)
+
+    def _write_timed(self, v):
+        started = self.clock.monotonic()
+        type(self).write(self, v)
+        self.on_write(started, memoryview(v))
+
+    def _receive_hooked(self, data):
+        self.on_bytes_in(memoryview(data))
+        self.on_byte(data)
+
+    def utilization(self):
+        """The busier direction's share of the link over the last second"""
+        now = self.clock.monotonic()
+        busiest = max(self.outbound.rate(now), self.inbound.rate(now))
+        return busiest / self.capacity
+
+    def has_budget(self, nbytes=0, priority=PRIORITY_NORMAL):
+        if priority <= PRIORITY_CONTROL:
+            return True
+        limit = 1.0 if priority == PRIORITY_NORMAL else self.ceiling
+        now = self.clock.monotonic()
+        outbound = self.outbound.rate(now) + nbytes / self.outbound.window
+        return max(outbound, self.inbound.rate(now)) <= limit * self.capacity
+
+    def usage(self):
+        now = self.clock.monotonic()
+        return {
+            "bytes_out": self.outbound.total,
+            "bytes_in": self.inbound.total,
+            "out_per_second": self.outbound.rate(now),
+            "in_per_second": self.inbound.rate(now),
+            "capacity": self.capacity,
+            "utilization": self.utilization(),
+        }
+
+    def lost(self, error):
+        with self._state_lock:
+            if not self.connected:
+                return
+            logger.warning("Lost the serial port: %s" % error)
+            self.connected = False
+            self._lost_at = self.clock.monotonic()
+            self.stats["disconnects"] += 1
+            self.decoder.reset()
+            self.heartbeat.reset()
+            # Acknowledgements still due went with the port
+            self._acks_seen = self._acks_due
+        try:
+            self.s.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def reconnect(self):
+        """Reopens the port, backing off between attempts
+
+        Requests that time out meanwhile fail with ConnectionLost.
+        """
+        delay = self.reconnect_delay
+        while True:
+            try:
+                self.s.open()
+                break
+            except (serial.SerialException, OSError) as e:
+                logger.debug("Reopening failed (%s), retrying in %ss"
+                             % (e, delay))
+                self._wait_out(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        self._reconnected()
+
+    def _wait_out(self, delay):
+        # Requests can't be answered until the port's back, but they still
+        # fail once they've waited as long as they would have for an answer
+        until = self.clock.monotonic() + delay
+        while True:
+            wait = self.manager.expire()
+            left = until - self.clock.monotonic()
+            if left <= 0:
+                return
+            self.clock.sleep(min(wait, left))
+
+    def _reconnected(self):
+        with self._state_lock:
+            self.connected = True
+            outage = self.clock.monotonic() - self._lost_at
+            self.stats["reconnects"] += 1
+            self.stats["last_outage"] = outage
+        logger.warning("Serial port back after %.3fs" % outage)
+        self.manager.connection_restored()
 
     def on_byte(self, byte):
-        # The message starts with 0xff 0x55 ("U"), and ends with
-        # 0x0d ("\r") 0x0a ("\n") - if that's found then then buffer is cleared and
-        # the message sent
-        self.buffer.append(byte)
-        state = "look 0xff"
-        start = end = None
-        for i, c in enumerate(self.buffer):
-            if state == "look 0xff" and c == b"\xff":
-                state = "look 0x55"
-            elif state == "look 0x55":
-                if c == b"\x55":
-                    state = "look 0x0d"
-                    start = i + 1
-                else:
-                    state = "look 0xff"
-            elif state == "look 0x0d" and c == b"\x0d":
-                end = i
-                state = "look 0x0a"
-            elif state == "look 0x0a":
-                if c == b"\x0a":
-                    # We found it!
-                    buffer = self.buffer[start:end]
-                    if self.buffer[:start-2]:
-                        # This is leading text
-                        logging.info("Leading incoming text: %s" % b"".join(self.buffer[:start-2]).decode("UTF-8", "replace"))
-                    if not buffer:
-                        # It pings with empty message regularly
-                        self.buffer = []
-                        return
-                    ext_id, value = self.parse_message(self.buffer[start:end])
-                    logger.info("Received incoming message (%r): ext_id=%r; value=%r" % (self.buffer[start:end], ext_id, value))
-                    self.manager.dispatch_message(ext_id, value)
-                    self.buffer = []
-                    return
-                else:
-                    state = "look 0x0d"
-                    end = None
-        # logger.info("Failed to parse buffer: %r" % self.buffer)
-
-    def parse_message(self, message):
-        ## FIXME: test if there's any extra data
-        logger.info("Parsing message: %r" % message)
-        if not message:
-            return None, None
-        ext_id = ord(message[0])
-        type = ord(message[1])
-        value = None
-        rest = b"".join(message[2:])
-        print("incoming", type, rest)
-        if type == 1:
-            # byte
-            value = rest[0]
-        elif type == 2:
-            # float
-            value = struct.unpack("<f", rest[:4])[0]
-        # Truncation? Weird bit of code...
-        if value and (value < -512 or value > 1023):
-            value = 0
-        if type == 3:
-            # short
-            value = struct.unpack("<h", rest[:2])[0]
-        elif type == 4:
-            # length + string
-            length = rest[0]
-            value = rest[1:1 + length]
-        elif type == 5:
-            # double (same as float?)
-            value = struct.unpack("<f", rest[:4])[0]
-        elif type == 6:
-            # long
-            value = struct.unpack("<l", rest[:4])[0]
-        return ext_id, value
+        # Any number of bytes, with any number of messages in them
+        for frame, ext_id, value in self.decoder.feed(byte):
+            if ext_id is None:
+                self._empty_frame()
+                continue
+            self.on_frame_parsed(frame, ext_id, value)
+            if logger.isEnabledFor(logging.DEBUG):
+                # Copying every frame to log it costs, even unlogged
+                logger.debug(
+                    "Received incoming message (%r): ext_id=%r; value=%r",
+                    bytes(frame), ext_id, value)
+            self.manager.dispatch_message(ext_id, value)
+
+    def _empty_frame(self, received=None):
+        # received is when it came off the port, if that was a while ago
+        with self._state_lock:
+            ack = self._acks_seen < self._acks_due
+            if ack:
+                # Acknowledging a command
+                self._acks_seen += 1
+        if not ack:
+            # It pings with empty message regularly
+            if received is None:
+                received = self.clock.monotonic()
+            self.heartbeat.beat(received)
+            self.on_keepalive()
+
+    def feed(self, data):
+        """Takes bytes that came in other than through poll()
+
+        Like from a simulation.SimulatedSerial, which has no thread reading
+        it.
+        """
+        self.inbound.add(len(data), self.clock.monotonic())
+        self._receive(data)
 
     def poll(self):
         logger.info("Waiting for incoming messages...")
         while True:
-            if not self.s.isOpen():
-                time.sleep(0.05)
+            if not self.connected:
+                self.reconnect()
+                continue
+            try:
+                c = self.s.read(1)
+            except (serial.SerialException, OSError) as e:
+                self.lost(e)
                 continue
-            c = self.s.read(1)
             # logger.info("Received incoming: %r" % c)
-            self.on_byte(c)
-
-
-class Manager:
+            if c:
+                self.inbound.add(1, self.clock.monotonic())
+                self._receive(c)
+            else:
+                # Nothing for a read timeout; check for lost requests, and
+                # that the board's still there
+                self.check_link()
+                self.manager.expire()
+
+    def stalled(self):
+        """Whether the board has gone quiet for missed_beats keepalives
+
+        Always False if it doesn't send keepalives.
+        """
+        heartbeat = self.heartbeat
+        if heartbeat.interval is None or heartbeat.last is None:
+            return False
+        last = max(heartbeat.last, self.inbound.last or 0)
+        allowed = self.missed_beats * heartbeat.interval + 4 * heartbeat.jitter
+        return self.clock.monotonic() - last > allowed
+
+    def check_link(self):
+        """Reopens the port if the link has stalled; returns whether it had"""
+        if not self.connected or not self.stalled():
+            return False
+        self.stats["stalls"] += 1
+        self.lost("no keepalive for %.3fs" % (
+            self.clock.monotonic() - self.heartbeat.last))
+        return True
+
+    def link_latency(self):
+        """The latest estimate of the round trip time, or None
+
+        The smoothed round trip time of requests, unless the board's next
+        keepalive is overdue by longer: then answers would be at least that
+        late too, even if there's been no request to show it.
+        """
+        estimates = [self.manager.srtt,
+                     self.heartbeat.lateness(self.clock.monotonic())]
+        estimates = [e for e in estimates if e is not None]
+        return max(estimates) if estimates else None
+
+
+class Manager(Hookable):
+
+    # on_dispatch(time, ext_id, value, handler) for every response, with
+    # handler None if nothing was waiting for it, and on_delivered(time,
+    # handler) once the handler has its value (and its callback has run);
+    # on_timeout(time, handler) for every request that gets no response;
+    # on_send(time, started, handlers) as send_many() returns, with when it
+    # was called
+    hook_names = ("on_dispatch", "on_delivered", "on_timeout", "on_send")
+    on_dispatch = on_delivered = on_timeout = on_send = \
+        staticmethod(_no_hook)
+
+    # How many times a read is sent again after the port comes back, before
+    # it's failed with ConnectionLost.  Commands waiting on a response fail
+    # straight away, as they may already have run.
+    max_retries = 1
+
+    # How many requests can wait for a response at once.  The firmware drops
+    # requests when its receive buffer fills, so the window grows by about
+    # one for each round trip's worth of responses and halves when a
+    # request times out (at most once a round trip).  It stops growing
+    # while round trips run at more than twice the quickest seen, as
+    # requests are queueing up on the board.
+    initial_window = 4
+    min_window = 1
+    max_window = 32
+    # Request timeouts before there's a round trip time to go by, and the
+    # shortest they get
+    initial_timeout = 1.0
+    min_timeout = 0.1
 
     def __init__(self, conn):
         self.conn = conn
+        self.clock = conn.clock
+        self._hooks = {}
         self.handlers = {}
         self.thread = None
+        self.stats = {
+            "sent": 0,
+            "received": 0,
+            "unmatched": 0,
+            "writes": 0,
+            "timeouts": 0,
+            "window": self.initial_window,
+            "window_increases": 0,
+            "window_decreases": 0,
+            # Values a handler's value_range zeroed
+            "out_of_range": 0,
+        }
+        # Senders queue their encoded bytes here; whichever sender holds
+        # _write_lock writes out everything queued.  _handler_lock guards
+        # handlers against the poll thread's dispatch.
+        self._outbox = collections.deque()
+        self._write_lock = threading.Lock()
+        self._handler_lock = threading.Lock()
+        self.window = float(self.initial_window)
+        # (time.monotonic(), window, reason) whenever the window changes size
+        self.window_history = collections.deque(maxlen=1000)
+        self.srtt = self.rttvar = self.min_rtt = None
+        # Requests let through the window that aren't in handlers yet
+        self._reserved = 0
+        self._room = threading.Condition(self._handler_lock)
+        self._last_decrease = 0
+        self._expiry_due = False
+        # Round trip times of the latest responses, in seconds
+        self.rtts = collections.deque(maxlen=1000)
 
     def launch(self):
         self.thread = threading.Thread(target=self.conn.poll)
+        self.thread.daemon = True
         self.thread.start()
 
-    def send(self, handler):
-        self.add_handler(handler)
-        logger.debug("Added handler for %r" % handler.ext_id)
-        handler.time_sent = time.time()
-        logger.info("Sending message: %r" % handler)
-        handler.send(self.conn)
+    def send(self, handler, priority=None):
+        logger.info("Sending message: %r", handler)
+        self.send_many([handler], priority)
+
+    def probe(self, timeout=3, interval=0.25):
+        """Asks the board for its version, returning the round trip time
+
+        Returns None if nothing answers within timeout.  The request is
+        repeated every interval, as the board may still be booting.
+        """
+        clock = self.clock
+        deadline = clock.monotonic() + timeout
+        while True:
+            message = VersionRead()
+            sent = clock.monotonic()
+            self.send(message)
+            wait = min(interval, deadline - sent)
+            if message.wait(max(wait, 0)):
+                return clock.monotonic() - sent
+            if clock.monotonic() >= deadline:
+                return None
+
+    def _hooks_changed(self):
+        # send_many() only times itself when something's listening
+        if self._hooks.get("on_send"):
+            self.send_many = self._send_many_timed
+        else:
+            self.__dict__.pop("send_many", None)
+
+    def _send_many_timed(self, handlers, priority=None):
+        started = self.clock.monotonic()
+        try:
+            type(self).send_many(self, handlers, priority)
+        finally:
+            self.on_send(started, handlers)
+
+    def send_many(self, handlers, priority=None):
+        """Sends the messages in a single write
+
+        priority defaults to that of the most important message.  Raises
+        LinkSaturated if the link is too busy for that priority.  Safe to
+        call from any number of threads.
+
+        Requests wait for room in the window, except that control traffic
+        always goes and low priority traffic raises LinkSaturated instead.
+        """
+        buffer = WriteBuffer()
+        for handler in handlers:
+            handler.send(buffer)
+        if not buffer.data:
+            return
+        if priority is None:
+            priority = min(handler.priority for handler in handlers)
+        if not self.conn.has_budget(len(buffer.data), priority):
+            self.conn.stats["rejected"] += len(handlers)
+            raise LinkSaturated("Link is %i%% busy" % (
+                self.conn.utilization() * 100))
+        expected = sum(1 for handler in handlers if handler.expects_response)
+        reserved = 0
+        if expected and priority > PRIORITY_CONTROL:
+            self._reserve(expected, priority, len(handlers))
+            reserved = expected
+        batch = _Batch(bytes(buffer.data), handlers, reserved)
+        self._outbox.append(batch)
+        while not batch.done:
+            with self._write_lock:
+                # Whoever gets the lock writes everything queued so far,
+                # which may already include this batch
+                if not batch.done:
+                    self._write_outbox()
+        if batch.error is not None:
+            raise batch.error
+
+    def _write_outbox(self):
+        batches = []
+        while self._outbox:
+            batches.append(self._outbox.popleft())
+        handlers = [h for batch in batches for h in batch.handlers]
+        # Registered in the same order as the bytes go out, so responses
+        # still match up with the oldest handler
+        now = self.clock.monotonic()
+        with self._handler_lock:
+            for handler in handlers:
+                if handler.expects_response:
+                    self._add_handler(handler)
+                handler.time_sent = now
+                handler.clock = self.clock
+            self._reserved -= sum(batch.reserved for batch in batches)
+            if self.clock.simulated and not self._expiry_due:
+                self._expiry_due = True
+                self.clock.call_later(self.request_timeout(), self._sim_expire)
+        logger.debug("Sending %i messages", len(handlers))
+        try:
+            self.conn.write(b"".join(batch.data for batch in batches))
+        except Exception as e:
+            # Like the port going (ConnectionLost), the link pushing back
+            # (LinkSaturated) or a hook failing: every sender waiting on
+            # these batches gets the error
+            with self._handler_lock:
+                for handler in handlers:
+                    if handler.expects_response:
+                        self._remove_handler(handler)
+                self._room.notify_all()
+            for batch in batches:
+                batch.error = e
+        else:
+            self.stats["sent"] += len(handlers)
+            self.stats["writes"] += 1
+        finally:
+            for batch in batches:
+                batch.done = True
+
+    def in_flight(self):
+        with self._handler_lock:
+            return self._in_flight()
+
+    def _in_flight(self):
+        return sum(len(handlers) for handlers in self.handlers.values())
+
+    def room(self):
+        """How many more requests the window has room for"""
+        with self._handler_lock:
+            return max(
+                int(self.window) - self._in_flight() - self._reserved, 0)
+
+    def request_timeout(self):
+        if self.srtt is None:
+            return self.initial_timeout
+        # A board whose keepalives come irregularly answers irregularly too
+        variation = max(self.rttvar, self.conn.heartbeat.jitter or 0)
+        return max(self.min_timeout, self.srtt + 4 * variation)
+
+    def _reserve(self, count, priority, messages):
+        with self._room:
+            while True:
+                expired = []
+                wait = self._expire(expired)
+                if expired:
+                    self._room.release()
+                    try:
+                        self._fail_expired(expired)
+                    finally:
+                        self._room.acquire()
+                    continue
+                outstanding = self._in_flight() + self._reserved
+                # A batch bigger than the window goes when nothing else is out
+                if outstanding + count <= self.window or not outstanding:
+                    self._reserved += count
+                    return
+                if priority >= PRIORITY_LOW:
+                    self.conn.stats["rejected"] += messages
+                    raise LinkSaturated("%i requests in flight" % outstanding)
+                if self.clock.simulated:
+                    # Nothing else runs until this returns, so move the
+                    # simulation on to its next event
+                    self._room.release()
+                    try:
+                        self.clock.step(wait)
+                    finally:
+                        self._room.acquire()
+                else:
+                    self._room.wait(wait)
+
+    def expire(self):
+        """Fails requests that have waited too long for a response
+
+        Returns how long until the next one would.
+        """
+        expired = []
+        with self._handler_lock:
+            wait = self._expire(expired)
+        self._fail_expired(expired)
+        return wait
+
+    def _sim_expire(self):
+        # Simulations have no poll thread to check for lost requests when
+        # reads go quiet, so this comes round as an event
+        expired = []
+        with self._handler_lock:
+            wait = self._expire(expired)
+            self._expiry_due = bool(self.handlers)
+        self._fail_expired(expired)
+        if self._expiry_due:
+            self.clock.call_later(wait, self._sim_expire)
+
+    def _expire(self, expired):
+        """Takes out requests that have waited too long for a response
+
+        Call holding _handler_lock, then _fail_expired(expired) once it's
+        released.  Adds (handler, error) to expired for each, and returns
+        how long until the next request would time out.
+        """
+        now = self.clock.monotonic()
+        timeout = self.request_timeout()
+        oldest = now
+        late = []
+        for handlers in self.handlers.values():
+            for handler in handlers:
+                if now - handler.time_sent > timeout:
+                    late.append(handler)
+                else:
+                    oldest = min(oldest, handler.time_sent)
+        if not late:
+            return max(oldest + timeout - now, 0.001)
+        connected = self.conn.connected
+        for handler in late:
+            self._remove_handler(handler)
+            waited = now - handler.time_sent
+            if connected:
+                error = RequestTimeout("No response after %.3fs" % waited)
+            else:
+                error = ConnectionLost(
+                    "Serial port was lost; no response after %.3fs" % waited)
+            expired.append((handler, error))
+        if connected:
+            logger.info("%i requests timed out" % len(late))
+            self.stats["timeouts"] += len(late)
+            self._decrease_window()
+        else:
+            # The board never had the chance to answer, so the window stays
+            logger.info("%i requests lost with the port" % len(late))
+            self.conn.stats["failed"] += len(late)
+        self._room.notify_all()
+        return max(oldest + timeout - now, 0.001)
+
+    def _fail_expired(self, expired):
+        # Without _handler_lock, as an errback may well send again
+        for handler, error in expired:
+            handler.fail(error)
+            if isinstance(error, RequestTimeout):
+                self.on_timeout(handler)
+
+    def _set_window(self, window, reason):
+        old = self.window
+        self.window = window
+        self.stats["window"] = window
+        if int(window) != int(old):
+            self.window_history.append(
+                (self.clock.monotonic(), window, reason))
+
+    def _decrease_window(self):
+        now = self.clock.monotonic()
+        if now - self._last_decrease < (self.srtt or 0):
+            # Losses from the same round trip only count once
+            return
+        self._last_decrease = now
+        self.stats["window_decreases"] += 1
+        self._set_window(max(self.window / 2, self.min_window), "timeout")
+
+    def _observe_rtt(self, rtt):
+        # Smoothed round trip time and its variation, as TCP does
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+            self.min_rtt = rtt
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.min_rtt = min(self.min_rtt, rtt)
+        if rtt > 2 * self.min_rtt or self.window >= self.max_window:
+            return
+        self.stats["window_increases"] += 1
+        self._set_window(min(self.window + 1.0 / self.window, self.max_window),
+                         "response")
+
+    def has_budget(self, nbytes=0, priority=None):
+        if priority is None:
+            priority = PRIORITY_NORMAL
+        return self.conn.has_budget(nbytes, priority)
 
     def add_handler(self, handler):
+        with self._handler_lock:
+            self._add_handler(handler)
+
+    def remove_handler(self, handler):
+        with self._handler_lock:
+            self._remove_handler(handler)
+            self._room.notify_all()
+
+    def _add_handler(self, handler):
         self.handlers.setdefault(handler.ext_id, []).append(handler)
 
-    def dispatch_message(self, ext_id, value):
-        handlers = self.handlers.get(ext_id, [])
-        if not handlers:
+    def _remove_handler(self, handler):
+        handlers = self.handlers.get(handler.ext_id, [])
+        if handler in handlers:
+            handlers.remove(handler)
+            if not handlers:
+                del self.handlers[handler.ext_id]
+
+    def connection_restored(self):
+        # Anything still waiting was lost with the port: ask again, or give up
+        with self._handler_lock:
+            pending = [h for handlers in self.handlers.values()
+                       for h in handlers]
+            self.handlers = {}
+            self._room.notify_all()
+        pending.sort(key=lambda h: h.time_sent or 0)
+        retry = []
+        for handler in pending:
+            if not _resendable(handler):
+                # It may have reached the board before the port went, and a
+                # relative move run twice goes twice as far
+                handler.fail(ConnectionLost(
+                    "Serial port was lost; not resending a command"))
+                self.conn.stats["failed"] += 1
+            elif handler.retries < self.max_retries:
+                handler.retries += 1
+                retry.append(handler)
+            else:
+                handler.fail(ConnectionLost("Serial port was lost"))
+                self.conn.stats["failed"] += 1
+        if not retry:
+            return
+        try:
+            # This is the poll thread, which can't wait for room in the
+            # window: only it can make any
+            self.send_many(retry, PRIORITY_CONTROL)
+        except Exception as e:
+            # Like the port going again, or the link pushing back; whatever
+            # it is mustn't take the poll thread down with it
+            for handler in retry:
+                handler.fail(e)
+            self.conn.stats["failed"] += len(retry)
+        else:
+            self.conn.stats["reissued"] += len(retry)
+
+    def dispatch_message(self, ext_id, value, received=None):
+        # Responses come back in the order requests were sent, so the oldest
+        # handler for an ext_id gets the value.  received is when the
+        # response came off the port by the monotonic clock, if that was a
+        # while ago (like in a worker process); it's what round trip times
+        # are measured to.
+        if received is None:
+            received = self.clock.monotonic()
+        self.stats["received"] += 1
+        expired = []
+        with self._handler_lock:
+            handlers = self.handlers.get(ext_id)
+            if handlers:
+                handler = handlers.pop(0)
+                if not handlers:
+                    del self.handlers[ext_id]
+                self._observe_rtt(received - handler.time_sent)
+            else:
+                handler = None
+            # Requests the board dropped would otherwise hold up the window
+            # (and catch later responses to the same ext_id) forever
+            self._expire(expired)
+            self._room.notify_all()
+        self._fail_expired(expired)
+        self.on_dispatch(ext_id, value, handler)
+        if handler is None:
             logger.info("No handlers for ext_id=%s -> %r" % (ext_id, value))
-        if len(handlers) > 1:
-            logger.info("Multiple handlers for ext_id=%s -> %r..." % (ext_id, value))
-            logger.info("  Handlers: %r" % handlers)
-        for handler in handlers:
-            handler.value = value
+            self.stats["unmatched"] += 1
+            return
+        if handler.value_range and isinstance(value, float):
+            low, high = handler.value_range
+            if value < low or value > high:
+                self.stats["out_of_range"] += 1
+        handler.value = value
+        self.on_delivered(handler)
+        self.rtts.append(received - handler.time_sent)
+
+
+def _resendable(handler):
+    # Reads can be asked again without harm
+    command = handler.command or protocol.find_command(handler.encode())
+    return command is not None and command.action == protocol.GET
+
+
+class _Batch(object):
+    """The bytes of one send_many() call, waiting for the writer"""
+
+    __slots__ = ("data", "handlers", "reserved", "done", "error")
+
+    def __init__(self, data, handlers, reserved=0):
+        self.data = data
+        self.handlers = handlers
+        self.reserved = reserved
+        self.done = False
+        self.error = None
+
+
+class WriteBuffer:
+    """Stands in for a Connection to collect the bytes of several messages"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, v):
+        self.data += v
+
+
+class Macro(object):
+    """Messages encoded once, to send together again and again
+
+    For sequences that go out often, like stopping everything: the frames
+    are encoded when the Macro is made, and sending it (with Manager.send()
+    or Bot.send(), like a Message) is one write of bytes that are ready to
+    go.  Messages that get a response can't be in one, as every send would
+    need new Messages to take the responses.
+
+    slots names fields that change between sends, as name=(index, field)
+    for the field of messages[index]'s command; set() packs new values
+    straight into the encoded bytes::
+
+        drive = Macro([MotorRun(1, 0), SevenSegmentDisplay(7, 0)],
+                      speed=(0, "speed"), shown=(1, "number"))
+        manager.send(drive.set(speed=100, shown=1.0))
+
+    The values go in as they are, without anything the Message would have
+    done to them (like MotorMove turning the left speed around).
+
+    set() and sending from different threads at once can mix up values.
+    """
+
+    expects_response = False
+
+    def __init__(self, messages, priority=None, **slots):
+        self.data = bytearray()
+        starts = []
+        for message in messages:
+            if message.expects_response:
+                raise ValueError("%r gets a response" % message)
+            starts.append(len(self.data))
+            self.data += message.encode()
+        self.messages = list(messages)
+        if priority is None:
+            priority = min([m.priority for m in messages] or
+                           [PRIORITY_NORMAL])
+        self.priority = priority
+        self.time_sent = None
+        # name: (offset into data, struct)
+        self.slots = {}
+        for name, (index, field) in slots.items():
+            command = self.messages[index].command
+            if field not in command.formats or command.formats[field] in (
+                    "str", "bytes"):
+                raise ValueError("%s has no fixed size field %r" % (
+                    command.name, field))
+            self.slots[name] = (starts[index] + command.offsets[field],
+                                struct.Struct("<" + command.formats[field]))
+
+    def __repr__(self):
+        return "<Macro of %s messages, %s bytes>" % (
+            len(self.messages), len(self.data))
+
+    def set(self, **values):
+        """Puts new values in slots, returning the Macro"""
+        for name, value in values.items():
+            offset, packer = self.slots[name]
+            packer.pack_into(self.data, offset, value)
+        return self
+
+    def send(self, conn):
+        conn.write(self.data)
+
+
+class Frames(object):
+    """Bytes already encoded as request frames, to send as they are
+
+    Like an LED strip's frame, encoded all at once.  Sent through a Manager
+    (which takes care of the write lock and the link's budget), none of
+    them can expect a response.
+    """
+
+    expects_response = False
+
+    def __init__(self, data, priority=None):
+        self.data = data
+        self.priority = PRIORITY_NORMAL if priority is None else priority
+        self.time_sent = None
+
+    def __repr__(self):
+        return "<Frames %s bytes>" % len(self.data)
+
+    def send(self, conn):
+        conn.write(self.data)
 
 
 class Message:
 
-    device_id = None
+    command = None
+    # callback(value) when the response comes, errback(error) if it fails
+    callback = None
+    errback = None
+    expects_response = False
+    value_range = None
+    retries = 0
+    error = None
+    # Seconds from being sent to the value arriving, by the monotonic clock
+    rtt = None
+    priority = PRIORITY_NORMAL
+    # Set to the Manager's clock when it's sent
+    clock = clocks.REAL
     _event = None
 
     def __init__(self, port):
@@ -167,12 +1102,14 @@ class Message:
 
     def __repr__(self):
         sent = returned = value = ""
-        if self.time_sent:
-            sent = " sent %s" % self._format_time(self.time_sent)
+        if self.time_sent is not None:
+            # time_sent is by the monotonic clock, which has no date
+            sent = " sent %.3fs ago" % (
+                self.clock.monotonic() - self.time_sent)
         if self.time_returned:
             returned = " returned %s" % self._format_time(self.time_returned)
         if hasattr(self, "_value"):
-            value = " value=%r" % value
+            value = " value=%r" % self._value
         return "<%s port=%r%s%s%s>" % (
             self.__class__.__name__,
             self.port,
@@ -181,14 +1118,22 @@ class Message:
             value,
         )
 
-    def wait(self):
-        if hasattr(self, "_value"):
-            logger.debug("Waiting/no-need on %r" % self)
-            return
+    def wait(self, timeout=None):
+        if self.done():
+            logger.debug("Waiting/no-need on %r", self)
+            return True
+        if self.clock.simulated:
+            return self.clock.run_until(self.done, timeout)
         if self._event is None:
             self._event = threading.Event()
-        self._event.wait()
-        logger.debug("Waiting on %r" % self)
+            # The value may have come in while the event was being made
+            if hasattr(self, "_value") or self.error:
+                return True
+        logger.debug("Waiting on %r", self)
+        return self._event.wait(timeout)
+
+    def done(self):
+        return hasattr(self, "_value") or self.error is not None
 
     def _format_time(self, t):
         minute = 60
@@ -205,6 +1150,21 @@ class Message:
             result = "%ih%s" % (hours, result)
         return result
 
+    @property
+    def device_id(self):
+        return self.command.device_id
+
+    def fields(self):
+        return [getattr(self, name) for name in self.command.field_names]
+
+    def encode(self):
+        # Only frames that get an answer need an ext_id to match it up
+        ext_id = self.ext_id if self.expects_response else 0
+        return self.command.encode(ext_id, *self.fields())
+
+    def send(self, conn):
+        conn.write(self.encode())
+
     @property
     def ext_id(self):
         if not self.device_id:
@@ -218,440 +1178,341 @@ class Message:
     def value(self):
         if hasattr(self, "_value"):
             return self._value
+        if self.error:
+            raise self.error
         raise Exception("Value on %r has not returned" % self)
 
-    @value.setter
-    def value_set(self, value):
-        self.time_returned = time.time()
+    def fail(self, error):
+        self.error = error
+        self.time_returned = self.clock.time()
         if self._event:
             self._event.set()
+        logger.debug("Failed: %r (%s)", self, error)
+        if self.errback:
+            self.errback(error)
+
+    @value.setter
+    def value(self, value):
+        self.time_returned = self.clock.time()
+        if self.time_sent is not None:
+            self.rtt = self.clock.monotonic() - self.time_sent
+        if self.value_range and isinstance(value, float):
+            # Sensors sometimes return garbage; the MegaPi library zeroes
+            # anything out of range
+            low, high = self.value_range
+            if value < low or value > high:
+                value = 0
         self._value = value
-        logger.debug("Received value: %r" % self)
+        if self._event:
+            self._event.set()
+        logger.debug("Received value: %r", self)
+        if self.callback:
+            self.callback(value)
 
 class Request(Message):
 
-    extra_params = ()
+    expects_response = True
+    value_range = (-512, 1023)
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x04,
-            self.ext_id, 0x01, self.device_id, self.port,
-            *self.extra_params
-        ]))
+class SlotMessage(Message):
+    """For the motors addressed by slot rather than port"""
+
+    def __init__(self, slot):
+        super().__init__(None)
+        self.slot = slot
+
+    @property
+    def ext_id(self):
+        return ((self.slot << 4) + self.device_id) & 0xff
+
+class VersionRead(Request):
+
+    command = COMMANDS["version"]
+
+    def __init__(self):
+        super().__init__(0)
+
+class DigitalRead(Request):
+
+    command = COMMANDS["digital_read"]
+
+class AnalogRead(Request):
+
+    command = COMMANDS["analog_read"]
 
 class LightSensorRead(Request):
 
-    device_id = 4
+    command = COMMANDS["light_sensor_read"]
 
 class UltrasonicSensorRead(Request):
 
-    device_id = 1
+    command = COMMANDS["ultrasonic_sensor_read"]
 
 class LineFollowerRead(Request):
 
-    device_id = 17
+    command = COMMANDS["line_follower_read"]
 
 class SoundSensorRead(Request):
 
-    device_id = 7
+    command = COMMANDS["sound_sensor_read"]
 
 class PirMotionSensorRead(Request):
 
-    device_id = 15
+    command = COMMANDS["pir_motion_sensor_read"]
 
 class PotentiometerRead(Request):
 
-    device_id = 4
+    command = COMMANDS["potentiometer_read"]
 
 class LimitSwitchRead(Request):
 
-    device_id = 21
+    command = COMMANDS["limit_switch_read"]
 
 class TemperatureRead(Request):
 
-    device_id = 2
+    command = COMMANDS["temperature_read"]
 
 class TouchSensorRead(Request):
 
-    device_id = 15
+    command = COMMANDS["touch_sensor_read"]
 
 class HumitureSensorRead(Request):
 
-    device_id = 23
+    command = COMMANDS["humiture_sensor_read"]
 
     def __init__(self, port, type):
         super().__init__(port)
-        self.extra_params = (type,)
+        self.type = type
 
 class JoystickRead(Request):
 
-    device_id = 5
+    command = COMMANDS["joystick_read"]
 
     def __init__(self, port, axis):
         super().__init__(port)
-        self.extra_params = (axis,)
+        self.axis = axis
 
 class GasSensorRead(Request):
 
-    device_id = 25
+    command = COMMANDS["gas_sensor_read"]
 
 class FlameSensorRead(Request):
 
-    device_id = 24
+    command = COMMANDS["flame_sensor_read"]
 
 class CompassRead(Request):
 
-    device_id = 26
+    command = COMMANDS["compass_read"]
 
 class AngularSensorRead(Request):
 
-    device_id = 28
+    command = COMMANDS["angular_sensor_read"]
 
 class ButtonRead(Request):
 
-    device_id = 22
+    command = COMMANDS["button_read"]
 
 class GyroRead(Request):
 
-    device_id = 6
+    command = COMMANDS["gyro_read"]
 
     def __init__(self, port, axis):
         super().__init__(port)
-        self.extra_params = (axis,)
+        self.axis = axis
 
 class PressureSensorBegin(Message):
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x03, 0x00, 0x02, 29,
-        ]))
+    command = COMMANDS["pressure_sensor_begin"]
 
 class PressureSensorRead(Request):
 
-    device_id = 29
+    command = COMMANDS["pressure_sensor_read"]
+
+class DigitalWrite(Message):
+
+    command = COMMANDS["digital_write"]
+
+    def __init__(self, pin, level):
+        super().__init__(pin)
+        self.pin, self.level = pin, level
+
+class PwmWrite(Message):
 
-## TODO: digitalWrite
-## TODO: pwmWrite
+    command = COMMANDS["pwm_write"]
+
+    def __init__(self, pin, pwm):
+        super().__init__(pin)
+        self.pin, self.pwm = pin, pwm
 
 class MotorRun(Message):
 
+    command = COMMANDS["motor_run"]
+
     def __init__(self, port, speed):
         super().__init__(port)
         self.speed = speed
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x06, 0x00, 0x02, 0x0a,
-            port, *short2bytes(self.speed),
-        ]))
-
 class MotorMove(Message):
 
+    command = COMMANDS["motor_move"]
+
     def __init__(self, left_speed, right_speed):
         super().__init__(None)
         self.left_speed = left_speed
         self.right_speed = right_speed
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x07, 0x00, 0x02, 0x05,
-            *short2bytes(-self.left_speed),
-            *short2bytes(self.right_speed),
-        ]))
+    def fields(self):
+        # The left motor is mounted the other way around
+        return [-self.left_speed, self.right_speed]
 
 class ServoRun(Message):
 
+    command = COMMANDS["servo_run"]
+
     def __init__(self, port, slot, angle):
         super().__init__(port)
         self.slot = slot
         self.angle = angle
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x06, 0x00, 0x02, 0x0b,
-            self.port, self.slot, self.angle,
-        ]))
-
-class EncoderMotorRun(Message):
+class EncoderMotorRun(SlotMessage):
 
-    device_id = 62
+    command = COMMANDS["encoder_motor_run"]
 
     def __init__(self, slot, speed):
-        super().__init__(None)
-        self.slot = slot
+        super().__init__(slot)
         self.speed = speed
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x07, 0x00, 0x02,
-            self.device_id, 0x02, self.slot,
-            *short2bytes(self.speed),
-        ]))
-
-class EncoderMotorMove(Message):
+class EncoderMotorMove(SlotMessage):
 
-    device_id = 62
+    command = COMMANDS["encoder_motor_move"]
+    # Answers when the move is done
+    expects_response = True
 
     def __init__(self, slot, speed, distance):
-        self.slot = slot
+        super().__init__(slot)
         self.speed = speed
         self.distance = distance
 
-    def send(self, conn):
-        ## TODO: has response
-        conn.write(bytearray([
-            0xff, 0x55, 0x0b, self.ext_id,
-            0x02, self.device_id, 0x01, slot,
-            *long2bytes(self.distance),
-            *short2bytes(self.speed),
-        ]))
+class EncoderMotorMoveTo(EncoderMotorMove):
 
-class EncoderMotorMoveTo(Message):
+    command = COMMANDS["encoder_motor_move_to"]
 
-    device_id = 62
+class EncoderMotorSetCurPosZero(SlotMessage):
 
-    def __init__(self, slot, speed, distance):
-        ## TODO: has response
-        super().__init__(None)
-        self.slot = slot
-        self.speed = speed
-        self.distance = distance
-
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x0b,
-            self.ext_id, 0x02,
-            self.device_id, 0x06,
-            self.slot,
-            *long2bytes(self.distance),
-            *short2bytes(self.speed),
-        ]))
-
-class EncoderMotorSetCurPosZero(Message):
-
-    device_id = 62
-
-    def __init__(self, slot):
-        super().__init__(None)
-        self.slot = slot
-
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x05, 0x00, 0x02,
-            self.device_id, 0x04, self.slot,
-        ]))
-
-class EncoderMotorPosition(Message):
-
-    device_id = 61
-
-    def __init__(self, slot):
-        super().__init__()
-        self.slot = slot
-
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x05, 0x00, 0x02,
-            self.device_id, 0x04, self.slot
-        ]))
+    command = COMMANDS["encoder_motor_set_cur_pos_zero"]
 
-class EncoderMotorPosition(Message):
+class EncoderMotorPosition(SlotMessage):
 
-    device_id = 61
+    command = COMMANDS["encoder_motor_position"]
+    expects_response = True
+    # Encoder positions run well outside the range sensors are clamped to
+    value_range = None
 
-    def __init__(self, slot):
-        super().__init__(None)
-        self.slot = slot
+class EncoderMotorSpeed(EncoderMotorPosition):
 
-    def send(self, conn):
-        ## TODO: has response
-        conn.write(bytearray([
-            0xff, 0x55, 0x06,
-            self.ext_id, 0x01,
-            self.device_id, 0x00,
-            self.slot, 0x02,
-        ]))
+    command = COMMANDS["encoder_motor_speed"]
 
-class StepperMotorRun(Message):
+class StepperMotorRun(SlotMessage):
 
-    device_id = 76
+    command = COMMANDS["stepper_motor_run"]
 
     def __init__(self, slot, speed):
-        super().__init__(None)
-        self.slot = slot
+        super().__init__(slot)
         self.speed = speed
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x07, 0x00, 0x02,
-            self.device_id, 0x02, self.slot,
-            *short2bytes(self.speed()),
-        ]))
-
 class StepperMotorMove(Message):
 
-    device_id = 76
+    command = COMMANDS["stepper_motor_move"]
+    # Answers when the move is done
+    expects_response = True
 
     def __init__(self, port, speed, distance):
         super().__init__(port)
         self.speed = speed
         self.distance = distance
 
-    def send(self, conn):
-        ## TODO: response
-        conn.write(bytearray([
-            0xff, 0x55, 0x0b,
-            self.ext_id, 0x02,
-            self.device_id, 0x01,
-            self.port,
-            *long2bytes(self.distance),
-            *short2bytes(self.speed),
-        ]))
-
-class StepperMotorMoveTo(Message):
+class StepperMotorMoveTo(StepperMotorMove):
 
-    device_id = 76
-
-    def __init__(self, port, speed, distance):
-        super().__init__(port)
-        self.speed = speed
-        self.distance = distance
-
-    def send(self, conn):
-        ## TODO: response
-        conn.write(bytearray([
-            0xff, 0x55, 0x0b,
-            self.ext_id, 0x02,
-            self.device_id, 0x06,
-            self.port,
-            *long2bytes(self.distance),
-            *short2bytes(self.speed),
-        ]))
+    command = COMMANDS["stepper_motor_move_to"]
 
 class StepperMotorSetCurPosZero(Message):
 
-    device_id = 76
-
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x05, 0x00, 0x02,
-            self.device_id, 0x04,
-            self.port,
-        ]))
+    command = COMMANDS["stepper_motor_set_cur_pos_zero"]
 
 class RgbLedDisplay(Message):
 
+    command = COMMANDS["rgbled_display"]
+
     def __init__(self, port, slot, index, red, green, blue):
         super().__init__(port)
         self.slot = slot
         self.index = index
         self.red, self.green, self.blue = red, green, blue
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x09, 0x00, 0x02,
-            18,
-            self.port,
-            self.slot,
-            self.index,
-            int(self.red),
-            int(self.green),
-            int(self.blue),
-        ]))
+    def fields(self):
+        return [self.port, self.slot, self.index,
+                int(self.red), int(self.green), int(self.blue)]
 
 class RgbLedShow(Message):
 
+    command = COMMANDS["rgbled_show"]
+
     def __init__(self, port, slot):
         super().__init__(port)
         self.slot = slot
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x05, 0x00, 0x02,
-            19,
-            self.port,
-            self.slot,
-        ]))
-
 class SevenSegmentDisplay(Message):
 
+    command = COMMANDS["seven_segment_display"]
+
     def __init__(self, port, number):
         super().__init__(port)
         self.number = number
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x08, 0x00, 0x02,
-            9,
-            self.port,
-            *float2bytes(self.number)
-        ]))
-
 class LedMatrixMessage(Message):
 
+    command = COMMANDS["led_matrix_message"]
+
     def __init__(self, port, x, y, message):
         super().__init__(port)
         self.x, self.y = x, y
         self.message = message
 
-    def send(self, conn):
-        numbers = [ord(c) for c in self.message]
-        conn.write(bytearray([
-            0xff, 0x55,
-            8 + len(numbers),
-            0x00, 0x02,
-            41,
-            self.port,
-            1,
-            char2byte(self.x),
-            char2byte(7 - self.y),
-            len(numbers),
-            *numbers,
-        ]))
+    def fields(self):
+        return [self.port, self.x, 7 - self.y,
+                bytearray(ord(c) for c in self.message)]
 
 class LedMatrixDisplay(Message):
 
+    command = COMMANDS["led_matrix_display"]
+
     def __init__(self, port, x, y, buffer):
         super().__init__(port)
         self.x, self.y = x, y
         self.buffer = buffer
 
-    def send(self, conn):
+    def fields(self):
         ## FIXME: check and adapt buffer size
-        conn.write(bytearray([
-            0xff, 0x55,
-            7 + len(self.buffer),
-            0x00, 0x02,
-            41,
-            self.port,
-            2,
-            x,
-            7 - y,
-            *buffer,
-        ]))
+        return [self.port, self.x, 7 - self.y, self.buffer]
 
 class SetShutter(Message):
 
+    command = COMMANDS["camera"]
+
     def __init__(self, port, shutter_on):
         super().__init__(port)
         self.shutter_on = shutter_on
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x05, 0x00, 0x03,
-            20, self.port,
-            1 if self.shutter_on else 2
-        ]))
+    def fields(self):
+        return [self.port, 1 if self.shutter_on else 2]
 
 class SetFocus(Message):
 
+    command = COMMANDS["camera"]
+
     def __init__(self, port, focus_on):
         super().__init__(port)
         self.focus_on = focus_on
 
-    def send(self, conn):
-        conn.write(bytearray([
-            0xff, 0x55, 0x05, 0x00, 0x03,
-            20, self.port,
-            3 if self.focus_on else 4
-        ]))
+    def fields(self):
+        return [self.port, 3 if self.focus_on else 4]
@@ -0,0 +1,148 @@
+"""Running a control step at a fixed rate.
+
+ControlLoop calls step(snapshot) every period on the monotonic clock.  The
+snapshot holds the sensor values that arrived since the last tick, and
+whatever messages step returns go out in one write along with the sensor
+requests for the next tick.
+"""
+import collections
+import logging
+
+from . import communication
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot(dict):
+    """Sensor values by device name, as of the start of a tick
+
+    Sensors that haven't answered since the previous tick are in .stale (and
+    keep their older value, or None if they never answered).  .times has when
+    each value arrived, by the bot's clock.time(), where it's known.
+    """
+
+    def __init__(self, values, stale, time, times=None):
+        dict.__init__(self, values)
+        self.stale = stale
+        self.time = time
+        self.times = times or {}
+
+
+class ControlLoop(object):
+
+    # Sleep until this close to the deadline, then spin
+    spin = 0.0005
+
+    def __init__(self, bot, step, rate, sensors=None, max_misses=None,
+                 safe_state=None, history=1000):
+        self.bot = bot
+        self.clock = bot.clock
+        self.step = step
+        self.period = 1.0 / rate
+        if sensors is None:
+            sensors = bot.sensors()
+        self.sensors = sensors
+        self.max_misses = max_misses
+        self.safe_state = safe_state or bot.stop_motors
+        self.jitter = collections.deque(maxlen=history)
+        self.ticks = 0
+        self.misses = 0
+        self.consecutive_misses = 0
+        self.in_safe_state = False
+        self.running = False
+        self._requested = {}
+
+    def __repr__(self):
+        return "<ControlLoop %sHz ticks=%s misses=%s%s>" % (
+            round(1.0 / self.period, 2), self.ticks, self.misses,
+            " (safe state)" if self.in_safe_state else "")
+
+    def stop(self):
+        self.running = False
+
+    def run(self, ticks=None, duration=None):
+        self.running = True
+        start = self.clock.monotonic()
+        deadline = start
+        end = start + duration if duration is not None else None
+        count = 0
+        while self.running and not self.in_safe_state:
+            if ticks is not None and count >= ticks:
+                break
+            if end is not None and deadline >= end:
+                break
+            self._sleep_until(deadline)
+            woke = self.clock.monotonic()
+            self.jitter.append(woke - deadline)
+            self.tick(woke)
+            count += 1
+            deadline += self.period
+            finished = self.clock.monotonic()
+            if finished > deadline:
+                # Skip the ticks we ran over, rather than bunching them up
+                missed = int((finished - deadline) / self.period) + 1
+                deadline += missed * self.period
+                self._missed()
+            else:
+                self.consecutive_misses = 0
+        self.running = False
+
+    def tick(self, now):
+        snapshot = self.snapshot(now)
+        messages = list(self.step(snapshot) or [])
+        self._requested = {}
+        for sensor in self.sensors:
+            messages.append(sensor.request())
+            self._requested[sensor.name] = sensor.last_value_time
+        self.bot.manager.send_many(messages, communication.PRIORITY_CONTROL)
+        self.ticks += 1
+
+    def snapshot(self, now):
+        values = {}
+        stale = set()
+        for sensor in self.sensors:
+            values[sensor.name] = sensor.last_value
+            if (sensor.name not in self._requested
+                    or sensor.last_value_time == self._requested[sensor.name]):
+                stale.add(sensor.name)
+        return Snapshot(values, stale, now)
+
+    def _sleep_until(self, deadline):
+        remaining = deadline - self.clock.monotonic()
+        if remaining > self.spin:
+            self.clock.sleep(remaining - self.spin)
+        if self.clock.simulated:
+            self.clock.sleep(max(deadline - self.clock.monotonic(), 0))
+        while self.clock.monotonic() < deadline:
+            pass
+
+    def _missed(self):
+        self.misses += 1
+        self.consecutive_misses += 1
+        logger.info("Control loop missed its deadline (%i in a row)"
+                    % self.consecutive_misses)
+        if self.max_misses and self.consecutive_misses >= self.max_misses:
+            logger.warning("Control loop missed %i deadlines, stopping motors"
+                           % self.consecutive_misses)
+            self.in_safe_state = True
+            self.safe_state()
+
+    def stats(self):
+        jitter = sorted(self.jitter) or [0.0]
+        return {
+            "ticks": self.ticks,
+            "misses": self.misses,
+            "consecutive_misses": self.consecutive_misses,
+            "in_safe_state": self.in_safe_state,
+            "jitter_mean": sum(jitter) / len(jitter),
+            "jitter_p99": jitter[int(0.99 * (len(jitter) - 1))],
+            "jitter_max": jitter[-1],
+        }
+
+
+def stop_messages():
+    # The drive motors, and every encoder motor slot on the MegaPi
+    messages = [communication.MotorMove(0, 0)]
+    for slot in range(1, 5):
+        messages.append(communication.EncoderMotorRun(slot, 0))
+    return messages
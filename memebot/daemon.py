@@ -0,0 +1,365 @@
+"""Sharing one board between processes, as run by ``memebot serve``.
+
+Only one process can have the serial port open.  A Server owns the
+Connection and listens on a Unix socket; other processes connect with a
+DaemonPort, which looks like a serial port to Connection, so a Bot works
+against the daemon as it would against the board::
+
+    bot = memebot.configure(config, connection="unix:/tmp/memebot.sock")
+
+Clients and the daemon speak the MegaPi's own framing, so anything that
+can talk to a board can talk to the daemon.  The daemon gives every
+request that gets a response an ext_id of its own, so the responses can't
+get mixed up between clients, and puts the client's ext_id back on the
+way out.  A sensor read identical to one already on its way to the board
+isn't sent again: both clients get the one response.  The board's
+keepalives go to every client, and each client gets an empty frame for
+every command it sends once the daemon has passed it on, as it would from
+the board, so their Connections can still tell a stalled link.
+"""
+import errno
+import logging
+import os
+import socket
+import threading
+
+import serial
+
+from . import communication
+from . import protocol
+
+logger = logging.getLogger(__name__)
+
+# A keepalive, or a command's acknowledgement
+EMPTY = protocol.HEADER + b"\r\n"
+
+
+class DaemonPort(object):
+    """The client end of a Server's socket, looking like a serial port"""
+
+    def __init__(self, path, timeout=0.1):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self._received = bytearray()
+        self.open()
+
+    def __repr__(self):
+        return "<DaemonPort %s>" % self.path
+
+    def isOpen(self):
+        return self.sock is not None
+
+    def open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise serial.SerialException(
+                "Can't reach %s: %s" % (self.path, e))
+        sock.settimeout(self.timeout)
+        self._received = bytearray()
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def write(self, data):
+        if self.sock is None:
+            raise serial.SerialException("Port is closed")
+        try:
+            self.sock.sendall(data)
+        except OSError as e:
+            raise serial.SerialException(str(e))
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self._received)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        if self.sock is None:
+            raise serial.SerialException("Port is closed")
+        if not self._received:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                return b""
+            except OSError as e:
+                raise serial.SerialException(str(e))
+            if not data:
+                raise serial.SerialException("The daemon went away")
+            self._received += data
+        data = bytes(self._received[:size])
+        del self._received[:size]
+        return data
+
+
+class _Client(object):
+
+    def __init__(self, sock, number):
+        self.sock = sock
+        self.number = number
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def __repr__(self):
+        return "<client %s>" % self.number
+
+    def send(self, data):
+        with self._lock:
+            if self.closed:
+                return False
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                logger.info("Dropping %r: %s", self, e)
+                self.closed = True
+                return False
+        return True
+
+
+class _Forwarded(communication.Message):
+    """A client's request, on its way to the board under the daemon's ext_id
+
+    waiters are the (client, ext_id) that get the response.
+    """
+
+    ext_id = None
+
+    def __init__(self, server, frame, expects_response, key=None):
+        communication.Message.__init__(self, None)
+        self.server = server
+        self.frame = bytearray(frame)
+        self.expects_response = expects_response
+        self.key = key
+        self.waiters = []
+        self.callback = self._reply
+
+    def __repr__(self):
+        return "<Forwarded %s ext_id=%s for %s>" % (
+            bytes(self.frame[4:]).hex(), self.ext_id, self.waiters)
+
+    def encode(self):
+        return bytes(self.frame)
+
+    def _reply(self, value):
+        for client, ext_id in self.server._finished(self):
+            if client.send(protocol.encode_response(ext_id, value)):
+                self.server.stats["replies"] += 1
+
+    def fail(self, error):
+        communication.Message.fail(self, error)
+        # The clients' own requests time out
+        self.server._finished(self)
+
+
+class Server(object):
+    """Forwards what clients on a Unix socket send to conn, and back"""
+
+    # Most requests from one client to send in one go; more from the same
+    # read wait for the window
+    batch = 32
+
+    def __init__(self, conn, path):
+        self.conn = conn
+        self.manager = conn.manager
+        self.path = path
+        self.clients = []
+        self.stats = {
+            "clients": 0,
+            "forwarded": 0,
+            "deduplicated": 0,
+            "replies": 0,
+        }
+        self._lock = threading.Lock()
+        # Forwarded requests waiting for a response, by the daemon's ext_id
+        # and (for reads) by what they ask
+        self._by_ext_id = {}
+        self._reads = {}
+        self._next_ext_id = 1
+        self._closed = False
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        conn.add_hook("on_keepalive", self._keepalive)
+
+    def __repr__(self):
+        return "<Server %s, %s clients>" % (self.path, len(self.clients))
+
+    def serve_forever(self):
+        while not self._closed:
+            try:
+                sock, address = self.sock.accept()
+            except OSError:
+                if self._closed:
+                    return
+                raise
+            self.stats["clients"] += 1
+            client = _Client(sock, self.stats["clients"])
+            self.clients.append(client)
+            logger.info("%r connected", client)
+            thread = threading.Thread(target=self._serve_client,
+                                      args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """Runs serve_forever() in a thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self._closed = True
+        self.conn.remove_hook("on_keepalive", self._keepalive)
+        self.sock.close()
+        for client in list(self.clients):
+            client.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _serve_client(self, client):
+        buffer = bytearray()
+        try:
+            while True:
+                try:
+                    data = client.sock.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                buffer += data
+                messages = []
+                acks = 0
+                for frame in split_requests(buffer):
+                    acks += protocol.acknowledged(frame)
+                    try:
+                        message = self._accept(client, frame)
+                    except communication.LinkSaturated as e:
+                        logger.info("Dropping a request from %r: %s",
+                                    client, e)
+                        continue
+                    if message is not None:
+                        messages.append(message)
+                    if len(messages) >= self.batch:
+                        self._send(client, messages)
+                        messages = []
+                self._send(client, messages)
+                # Even for commands that couldn't go, or the client would
+                # take keepalives for their acknowledgements
+                if acks:
+                    client.send(EMPTY * acks)
+        finally:
+            client.closed = True
+            client.sock.close()
+            self.clients.remove(client)
+            logger.info("%r went away", client)
+
+    def _keepalive(self, now):
+        for client in list(self.clients):
+            client.send(EMPTY)
+
+    def _send(self, client, messages):
+        if not messages:
+            return
+        try:
+            self.manager.send_many(messages)
+        except IOError as e:
+            logger.info("Couldn't forward for %r: %s", client, e)
+            for message in messages:
+                if message.expects_response:
+                    self._finished(message)
+
+    def _accept(self, client, frame):
+        # Returns the Message to send for a request, or None if it's a read
+        # already on its way
+        self.stats["forwarded"] += 1
+        command = protocol.find_command(frame)
+        if command is None or command.response is None:
+            return _Forwarded(self, frame, False)
+        key = None
+        if command.action == protocol.GET:
+            key = bytes(frame[4:])
+        with self._lock:
+            message = self._reads.get(key) if key else None
+            if message is not None:
+                message.waiters.append((client, frame[3]))
+                self.stats["deduplicated"] += 1
+                return None
+            message = _Forwarded(self, frame, True, key)
+            message.waiters.append((client, frame[3]))
+            message.frame[3] = message.ext_id = self._allocate(message)
+            if key:
+                self._reads[key] = message
+        return message
+
+    def _allocate(self, message):
+        # Any ext_id but 0 that nothing's waiting on
+        for i in range(255):
+            ext_id = (self._next_ext_id + i - 1) % 255 + 1
+            if ext_id not in self._by_ext_id:
+                self._next_ext_id = ext_id % 255 + 1
+                self._by_ext_id[ext_id] = message
+                return ext_id
+        raise communication.LinkSaturated("255 requests waiting on the board")
+
+    def _finished(self, message):
+        # Returns the waiters for a request that's been answered or given up
+        with self._lock:
+            if self._by_ext_id.get(message.ext_id) is message:
+                del self._by_ext_id[message.ext_id]
+            if message.key and self._reads.get(message.key) is message:
+                del self._reads[message.key]
+            waiters, message.waiters = message.waiters, []
+        return waiters
+
+
+def split_requests(buffer):
+    """Takes the complete request frames off the front of buffer
+
+    Anything before a 0xff 0x55 is dropped.
+    """
+    frames = []
+    pos = 0
+    while True:
+        start = buffer.find(b"\xff\x55", pos)
+        if start < 0:
+            pos = len(buffer) - (buffer.endswith(b"\xff") and 1 or 0)
+            break
+        if len(buffer) < start + 3:
+            pos = start
+            break
+        end = start + 3 + buffer[start + 2]
+        if len(buffer) < end:
+            pos = start
+            break
+        frames.append(bytes(buffer[start:end]))
+        pos = end
+    del buffer[:pos]
+    return frames
+
+
+def serve(port, path, **kw):
+    """Opens port (as Bot.start() would) and serves it on path until killed"""
+    from . import memebot
+    bot = memebot.configure("", connection=port, **kw)
+    server = Server(bot.conn, path)
+    logger.warning("Serving %s on %s", port, path)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
@@ -0,0 +1,224 @@
+"""A pretend MegaPi, for running the communication code without a board.
+
+EmulatedSerial looks enough like serial.Serial for Connection to use it: it
+parses the frames that are written to it, records them, and queues up the
+responses the firmware would send back.
+"""
+import collections
+import random
+import struct
+import threading
+import time
+
+import serial
+
+
+def wire_time(nbytes, baudrate=115200):
+    # 8N1 framing: a start bit, 8 data bits, a stop bit
+    return nbytes * 10.0 / baudrate
+
+
+class EmulatedSerial(object):
+
+    version = b"09.01.016"
+
+    def __init__(self, baudrate=115200, timeout=0.1, values=None, latency=0,
+                 rx_buffer=None, keepalive=None, noise=0, seed=None,
+                 record=True):
+        self.baudrate = baudrate
+        self.timeout = timeout
+        # Seconds before each response can be read, like a board that takes
+        # a while to answer
+        self.latency = latency
+        # How many requests the board can be working on at once (with
+        # latency); more than that and it drops them, like the firmware
+        # does when its receive buffer overflows
+        self.rx_buffer = rx_buffer
+        self.dropped = 0
+        # Seconds between the empty frames the board sends of its own accord
+        self.keepalive = keepalive
+        self._next_keepalive = time.monotonic() + (keepalive or 0)
+        self._hung_until = 0
+        # The chance that a response comes with junk in front of it, like
+        # a noisy line: random bytes, sometimes with a broken frame in them
+        self.noise = noise
+        self._random = random.Random(seed)
+        # Sensor readings by (device_id, port), or by the whole request after
+        # the action (like (61, 0, slot, 1) for an encoder position); either
+        # numbers or functions that return a number
+        self.values = dict(values or {})
+        # Whether to keep everything written, in .written and .frames; long
+        # runs turn it off so it doesn't pile up
+        self.record = record
+        self.written = bytearray()
+        self.frames = []
+        self.bytes_written = 0
+        self._pending = bytearray()
+        self._out = bytearray()
+        # (ready time, bytes) of responses still on their way, with latency
+        self._delayed = collections.deque()
+        self._cond = threading.Condition()
+        self._open = True
+        self._unplugged_until = 0
+
+    def isOpen(self):
+        return self._open
+
+    def open(self):
+        if time.monotonic() < self._unplugged_until:
+            raise serial.SerialException("No such device")
+        with self._cond:
+            self._open = True
+            self._out = bytearray()
+            self._delayed.clear()
+
+    def close(self):
+        with self._cond:
+            self._open = False
+            self._cond.notify_all()
+
+    def hang(self, duration):
+        """Acts like the board locked up for duration seconds
+
+        It answers nothing and sends no keepalives, but the port stays open.
+        """
+        self._hung_until = time.monotonic() + duration
+
+    def unplug(self, duration):
+        """Acts like the cable was pulled out for duration seconds"""
+        self._unplugged_until = time.monotonic() + duration
+        self.close()
+
+    def write(self, data):
+        if not self._open:
+            raise serial.SerialException("Port is closed")
+        data = bytes(data)
+        self.bytes_written += len(data)
+        if self.record:
+            self.written += data
+        self._pending += data
+        self._parse_pending()
+        return len(data)
+
+    def _parse_pending(self):
+        buf = self._pending
+        while True:
+            start = buf.find(b"\xff\x55")
+            if start < 0:
+                del buf[:max(len(buf) - 1, 0)]
+                return
+            if len(buf) < start + 3:
+                del buf[:start]
+                return
+            end = start + 3 + buf[start + 2]
+            if len(buf) < end:
+                del buf[:start]
+                return
+            frame = bytes(buf[start + 3:end])
+            del buf[:end]
+            if self.record:
+                self.frames.append(frame)
+            self.on_frame(frame)
+
+    def on_frame(self, frame):
+        if time.monotonic() < self._hung_until:
+            return
+        if self.rx_buffer is not None and self.busy() >= self.rx_buffer:
+            self.dropped += 1
+            return
+        self.respond(self.reply(frame))
+
+    def reply(self, frame):
+        # Frames are ext_id, action, device_id, port...; reads (action 1) get
+        # a float back (or a string, for bytes), everything else gets an
+        # empty frame
+        if len(frame) >= 4 and frame[1] == 0x01:
+            value = self.values.get(tuple(frame[2:]))
+            if value is None:
+                value = self.values.get((frame[2], frame[3]))
+            if value is None:
+                # Device 0 is the firmware version
+                value = self.version if frame[2] == 0 else 0.0
+            if callable(value):
+                value = value()
+            if isinstance(value, bytes):
+                return bytes([frame[0], 4, len(value)]) + value
+            return bytes([frame[0], 2]) + struct.pack("<f", value)
+        return b""
+
+    def busy(self):
+        """How many requests the board is still working on"""
+        with self._cond:
+            self._arrived()
+            return len(self._delayed)
+
+    def respond(self, payload):
+        data = b"\xff\x55" + payload + b"\r\n"
+        if self.noise and self._random.random() < self.noise:
+            data = self._junk() + data
+        with self._cond:
+            if self.latency:
+                self._delayed.append((time.monotonic() + self.latency, data))
+            else:
+                self._out += data
+            self._cond.notify_all()
+
+    def _junk(self):
+        rand = self._random
+        junk = bytes(rand.randrange(256) for i in range(rand.randint(1, 8)))
+        if rand.random() < 0.5:
+            # The start of a frame that never finishes.  Not a string, whose
+            # length byte could hold up the frames after it for 255 bytes.
+            junk += b"\xff\x55" + bytes([rand.randrange(256),
+                                         rand.choice([1, 2, 3, 5, 6, 0x7f])])
+        return junk
+
+    def _arrived(self):
+        # Returns how long until the next byte is due, if any is
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._out += self._delayed.popleft()[1]
+        due = None
+        if self._delayed:
+            due = self._delayed[0][0] - now
+        if self.keepalive:
+            if now >= self._next_keepalive:
+                if now >= self._hung_until:
+                    self._out += b"\xff\x55\r\n"
+                self._next_keepalive += self.keepalive
+                if self._next_keepalive <= now:
+                    self._next_keepalive = now + self.keepalive
+            due = min(due if due is not None else self.keepalive,
+                      self._next_keepalive - now)
+        return due
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._arrived()
+            return len(self._out)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+        with self._cond:
+            while self._open:
+                next_arrival = self._arrived()
+                if self._out:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if next_arrival is not None:
+                    remaining = min(remaining, next_arrival)
+                self._cond.wait(remaining)
+            if not self._open:
+                raise serial.SerialException("Port is closed")
+            data = bytes(self._out[:size])
+            del self._out[:size]
+            return data
+
+    def frames_for(self, device_id):
+        return [f for f in self.frames if len(f) > 2 and f[2] == device_id]
@@ -1,11 +1,18 @@
+from . import clock as clocks
 from . import communication
+from . import control
+from . import daemon
+from . import emulator
+from . import scheduler
+import logging
 import sys
-import time
 
-def configure(s):
+logger = logging.getLogger(__name__)
+
+def configure(s, probe_timeout=3, connection=None, clock=None, worker=False):
     lines = s.strip().splitlines()
-    connection = None
-    bot = Bot()
+    override = connection
+    bot = Bot(clock)
     for line in lines:
         port = slot = None
         if not line.strip() or line.strip().startswith("#"):
@@ -19,6 +26,9 @@ def configure(s):
         if t == "connection":
             connection = parts[1]
             continue
+        if t == "conflict":
+            bot.conflict_groups.append(parts[1:])
+            continue
         if "+" in parts[1]:
             port, slot = parts[1].split("+", 1)
             port = int(port)
@@ -26,21 +36,180 @@ def configure(s):
         else:
             port = int(parts[1])
         bot.add_device(name, t, port, slot)
-    bot.start(connection)
+    bot.start(override or connection, probe_timeout=probe_timeout,
+              worker=worker)
     return bot
 
+def _running_loop():
+    # Without importing asyncio, which takes a while: if nothing has
+    # imported it, no loop can be running
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
 class Bot(object):
 
-    def __init__(self):
-        self.m = MegaPi()
+    def __init__(self, clock=None):
+        # simulation.SimClock runs the bot on virtual time
+        self.clock = clock or clocks.REAL
+        self.conn = None
+        self.manager = None
+        self.rtt = None
         self.devices = {}
+        # Lists of sensor names that shouldn't be read at the same time
+        self.conflict_groups = []
+        # Where sensor values go, if they're being recorded
+        self.recorder = None
+        # Collects what coroutines send (see aio)
+        self._sender = None
+        self._stop = communication.Macro(
+            control.stop_messages(), priority=communication.PRIORITY_CONTROL)
 
     def __str__(self):
         props = [v for n, v in sorted(self.devices.items())]
         return 'Bot:%s' % "\n".join("  %s" % prop for prop in props)
 
-    def start(self, connection):
-        self.m.start(connection)
+    def start(self, connection, probe_timeout=3, worker=False):
+        """Opens the connection and makes sure the board is answering
+
+        The first round trip is kept as .rtt.  With probe_timeout=None the
+        board isn't checked.  With worker, a child process owns the port
+        (see worker.WorkerConnection); connection must then be a port name,
+        "auto" or "emulator".  "unix:" and a path connects to a daemon (see
+        daemon.Server).
+        """
+        if isinstance(connection, str) and connection.startswith("unix:"):
+            # A memebot serve daemon
+            connection = daemon.DaemonPort(connection[len("unix:"):])
+        elif connection == "emulator":
+            connection = emulator.EmulatedSerial
+            if not worker:
+                connection = connection()
+        elif connection == "auto":
+            name, connection = communication.discover()
+            if connection is None:
+                raise IOError("No MegaPi found on any serial port")
+            if worker:
+                connection.close()
+                connection = name
+        if worker:
+            # multiprocessing and shared memory take a while to import
+            from . import worker as workers
+            self.conn = workers.WorkerConnection(connection, clock=self.clock)
+        else:
+            self.conn = communication.Connection(connection, clock=self.clock)
+        self.manager = self.conn.manager
+        if self.clock.simulated:
+            # Responses arrive as simulation events, not from a thread
+            connection.attach(self.conn)
+        else:
+            self.manager.launch()
+        if probe_timeout is not None:
+            self.rtt = self.manager.probe(probe_timeout)
+            if self.rtt is None:
+                raise IOError("No response from the board on %s" % connection)
+
+    def write(self, data, priority=None):
+        """Sends bytes that are already request frames, like a message"""
+        self.manager.send(communication.Frames(data, priority))
+
+    def send(self, *messages, **kw):
+        self.manager.send_many(messages, **kw)
+
+    def _send_message(self, message):
+        # Called from a coroutine, returns a future for the write instead
+        # of waiting on it
+        loop = _running_loop()
+        if loop is None:
+            self.manager.send(message)
+            return None
+        from . import aio
+        return aio.sender(self, loop).send(message)
+
+    def stop_motors(self):
+        self.send(self._stop)
+
+    def control_loop(self, step, rate, **kw):
+        """Returns a ControlLoop that calls step(snapshot) rate times a second
+
+        Call .run() on the result to start it.
+        """
+        return control.ControlLoop(self, step, rate, **kw)
+
+    def odometry(self, **kw):
+        """Returns an Odometry tracking the encoder motors
+
+        Call .start() on the result to start polling the encoders.
+        """
+        from . import odometry
+        return odometry.Odometry(self, **kw)
+
+    def record(self, directory, **kw):
+        """Starts logging every sensor value to directory
+
+        Returns the recorder.Recorder, which needs closing to write out
+        what it's holding; recorder.load(directory) reads the log back.
+        """
+        from . import recorder
+        self.recorder = recorder.Recorder(directory, **kw)
+        return self.recorder
+
+    def trace(self, **kw):
+        """Starts recording the serial timeline as Chrome trace events
+
+        Returns the trace.Tracer; stop() it and save() the trace to open
+        it in Perfetto or chrome://tracing.
+        """
+        from . import trace
+        tracer = trace.Tracer(self.manager, **kw)
+        tracer.start()
+        return tracer
+
+    def scheduler(self, **kw):
+        """Returns a Scheduler that polls every sensor
+
+        Call .start() on the result to start polling.
+        """
+        kw.setdefault("groups", self.conflict_groups)
+        return scheduler.Scheduler(self, **kw)
+
+    def read_all(self, timeout=1, sensors=None):
+        """Reads every sensor at once, returning a control.Snapshot
+
+        All the requests go out in one write and the replies are collected
+        as they come in, so this takes about one round trip however many
+        sensors there are.  Sensors that don't answer within timeout are in
+        the snapshot's .stale, with their last known value.
+        """
+        if sensors is None:
+            sensors = self.sensors()
+        messages = [sensor.request() for sensor in sensors]
+        clock = self.clock
+        sent = clock.time()
+        self.manager.send_many(messages)
+        deadline = clock.monotonic() + timeout
+        values = {}
+        times = {}
+        stale = set()
+        for sensor, message in zip(sensors, messages):
+            message.wait(max(deadline - clock.monotonic(), 0))
+            try:
+                values[sensor.name] = message.value
+                times[sensor.name] = message.time_returned
+            except Exception:
+                stale.add(sensor.name)
+                values[sensor.name] = sensor.last_value
+                times[sensor.name] = sensor.last_value_time
+        return control.Snapshot(values, stale, sent, times)
+
+    def sensors(self):
+        return [device for name, device in sorted(self.devices.items())
+                if isinstance(device, Sensor) and device.Message]
 
     def add_device(self, name, type, port, slot):
         device = factories[type](self, name, port, slot)
@@ -49,6 +218,8 @@ class Bot(object):
 
 class Device(object):
 
+    Message = None
+
     def __init__(self, bot, name, port, slot=None):
         self.bot = bot
         self.name = name
@@ -72,23 +243,39 @@ class Device(object):
 
 class Sensor(Device):
 
+    # How much a reading has to move to count as a change when polling
+    # adaptively
+    change_threshold = 1.0
+
     def __init__(self, *args, **kw):
         Device.__init__(self, *args, **kw)
         self.last_value = None
         self.last_value_time = None
 
+    def request(self):
+        message = self.Message(self.port)
+        message.callback = self.on_update
+        return message
+
     def update(self):
-        self.bot.m[self.megapi_name](self.port, self.on_update)
+        self.bot.manager.send(self.request())
+
+    def read(self):
+        """Awaits the sensor's next value, for coroutines"""
+        from . import aio
+        return aio.read(self)
 
     def on_update(self, value):
         self.last_value = value
-        self.last_value_time = time.time()
-        print("Received %r" % self)
+        self.last_value_time = self.bot.clock.time()
+        if self.bot.recorder is not None:
+            self.bot.recorder.add(self.name, self.last_value_time, value)
+        logger.debug("Received %r", self)
 
     def _extra_repr(self):
         if not self.last_value_time:
             return " (not updated)"
-        diff = int(time.time() - self.last_value_time)
+        diff = int(self.bot.clock.time() - self.last_value_time)
         if diff < 60:
             diff = "%ss" % diff
         else:
@@ -98,46 +285,110 @@ class Sensor(Device):
 
 class LightSensor(Sensor):
     type = "light_sensor"
-    Message = communication.lightSensorRead
-    megapi_name = "lightSensorRead"
+    Message = communication.LightSensorRead
+    change_threshold = 10
 
 class UltraSonic(Sensor):
     type = "ultrasound"
     Message = communication.UltrasonicSensorRead
-    megapi_name = "ultrasonicSensorRead"
+    change_threshold = 2
 
 ## FIXME: should do on-board sound, etc
 
 class Motion(Sensor):
     type = "motion"
     Message = communication.PirMotionSensorRead
-    megapi_name = "pirMotionSensorRead"
+    change_threshold = 0.5
 
 class Contact(Sensor):
     type = "contact"
-    megapi_name = "??"
 
 class NumberDisplay(Device):
     type = "number_display"
     Message = communication.SevenSegmentDisplay
 
     def set(self, value):
-        print("Setting", self.type, value, self.bot, self.bot.m, self.bot.m.sevenSegmentDisplay, self.port)
-        self.bot.m.sevenSegmentDisplay(self.port, value)
+        """Shows value; from a coroutine, returns a future for the write"""
+        return self.bot._send_message(self.Message(self.port, value))
 
 class LED(Device):
     type = "led"
     Message = communication.LedMatrixMessage
 
     def set(self, value, x=0, y=0):
-        if isinstance(value, (unicode, str)):
-            self.bot.m.ledMatrixMessage(self.port, x, y, value)
+        """Shows value; from a coroutine, returns a future for the write"""
+        if isinstance(value, str):
+            return self.bot._send_message(
+                self.Message(self.port, x, y, value))
         else:
             ## FIXME: convert array to appropriate buffer
-            self.bot.m.ledMatrixDisplay(self.port, x, y, value)
+            return self.bot._send_message(
+                communication.LedMatrixDisplay(self.port, x, y, value))
+
+class LEDStrip(Device):
+    """A strip of RGB LEDs, set a whole frame at a time
+
+    show() takes an array of (red, green, blue) rows, one per pixel, and
+    only sends the pixels that changed since the last show, in one write
+    through the Manager at priority (normal by default).
+    """
+    type = "led_strip"
+    Message = communication.RgbLedDisplay
+    # Pixel indexes go in a byte, and 0 means every pixel
+    max_pixels = 255
+
+    def __init__(self, *args, **kw):
+        Device.__init__(self, *args, **kw)
+        self.pixels = None
+
+    def _extra_repr(self):
+        if self.pixels is None:
+            return ""
+        return " %s pixels" % len(self.pixels)
+
+    def show(self, colors, priority=None):
+        # numpy takes longer to import than the rest of startup put together
+        import numpy
+        colors = numpy.asarray(colors, dtype=numpy.uint8).reshape(-1, 3)
+        if not len(colors) or len(colors) > self.max_pixels:
+            raise ValueError("%r can't address %s pixels (1 to %s)" % (
+                self, len(colors), self.max_pixels))
+        data = self.encode_frame(colors)
+        if data:
+            self.bot.write(data, priority)
+        self.pixels = colors.copy()
+
+    def encode_frame(self, colors):
+        import numpy
+        # Pixel indexes on the board start at 1; index 0 sets every pixel
+        if (colors == colors[0]).all():
+            if self.pixels is not None and (self.pixels == colors).all():
+                return b""
+            indexes = numpy.zeros(1, dtype=numpy.uint8)
+            colors = colors[:1]
+        elif self.pixels is None or self.pixels.shape != colors.shape:
+            indexes = numpy.arange(1, len(colors) + 1, dtype=numpy.uint8)
+        else:
+            changed = (self.pixels != colors).any(axis=1).nonzero()[0]
+            if not len(changed):
+                return b""
+            indexes = (changed + 1).astype(numpy.uint8)
+            colors = colors[changed]
+        display = communication.COMMANDS["rgbled_display"]
+        template = display.encode(0, self.port, self.slot or 0, 0, 0, 0, 0)
+        frames = numpy.empty((len(indexes), len(template)), dtype=numpy.uint8)
+        frames[:] = numpy.frombuffer(template, dtype=numpy.uint8)
+        frames[:, display.offsets["index"]] = indexes
+        red = display.offsets["red"]
+        frames[:, red:red + 3] = colors
+        show = communication.RgbLedShow(self.port, self.slot or 0)
+        return frames.tobytes() + show.encode()
+
+def _device_classes(cls=Device):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for c in _device_classes(subclass):
+            yield c
 
-factories = {}
-for _name in dir():
-    _a_class = eval(_name)
-    if isinstance(_a_class, type) and issubclass(_a_class, Device) and getattr(_a_class, "type", None):
-        factories[_a_class.type] = _a_class
+factories = dict(
+    (c.type, c) for c in _device_classes() if getattr(c, "type", None))
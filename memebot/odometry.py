@@ -0,0 +1,191 @@
+"""Wheel odometry from the encoder motors.
+
+Odometry keeps asking for both encoder positions, as a pair in a single
+write, with a few pairs in flight at once.  Completed pairs land in a
+preallocated array, and the pose is brought up to date whenever it's asked
+for by integrating all the new samples at once.  If it isn't asked for
+while half the array fills, polling integrates them itself, so nothing is
+overwritten before it counts.
+"""
+import logging
+import math
+import threading
+
+import numpy
+
+from . import communication
+
+logger = logging.getLogger(__name__)
+
+
+class Odometry(object):
+
+    def __init__(self, bot, slots=(1, 2), rate=100, depth=2,
+                 wheel_diameter=0.064, wheel_base=0.12, directions=(1, 1),
+                 capacity=4096, timeout=0.5):
+        self.bot = bot
+        self.clock = bot.clock
+        self.slots = slots
+        self.period = 1.0 / rate
+        self.depth = depth
+        self.timeout = timeout
+        # Encoders count degrees of wheel rotation
+        self.distance_per_degree = math.pi * wheel_diameter / 360.0
+        self.wheel_base = wheel_base
+        self.directions = numpy.array(directions, dtype=float)
+        # Rows of (time, left degrees, right degrees); a ring once full
+        self.samples = numpy.zeros((capacity, 3))
+        self.count = 0
+        self.in_flight = 0
+        self.lost = 0
+        # Steps between samples that were overwritten before they were
+        # integrated, whose motion is missing from the pose
+        self.skipped = 0
+        self.running = False
+        self.thread = None
+        self._lock = threading.Lock()
+        # Held while integrating, which the polling thread may do too
+        self._update_lock = threading.Lock()
+        self._integrated = 0
+        self._x = self._y = self._theta = 0.0
+        self._velocity = (0.0, 0.0)
+        self._last_reply = self.clock.monotonic()
+
+    def __repr__(self):
+        x, y, theta = self.pose
+        return "<Odometry x=%.3f y=%.3f theta=%.3f samples=%s>" % (
+            x, y, theta, self.count)
+
+    def start(self):
+        self.running = True
+        if self.clock.simulated:
+            self.clock.call_at(self.clock.monotonic(), self._step)
+            return self
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        deadline = self.clock.monotonic()
+        while self.running:
+            self.poll()
+            deadline += self.period
+            remaining = deadline - self.clock.monotonic()
+            if remaining > 0:
+                self.clock.sleep(remaining)
+            else:
+                deadline = self.clock.monotonic()
+
+    def _step(self):
+        # run(), one poll at a time, as simulation events
+        if not self.running:
+            return
+        self.poll()
+        self.clock.call_at(self.clock.monotonic() + self.period, self._step)
+
+    def poll(self):
+        """Asks for both encoder positions, unless too many pairs are out"""
+        if self.count - self._integrated >= len(self.samples) // 2:
+            # Nothing's asked for the pose in a while
+            self.update()
+        if self.in_flight >= self.depth:
+            if self.clock.monotonic() - self._last_reply < self.timeout:
+                return False
+            # Replies went missing; start over rather than stall forever
+            logger.info("Lost %i encoder requests" % self.in_flight)
+            with self._lock:
+                self.lost += self.in_flight
+                self.in_flight = 0
+        pair = [communication.EncoderMotorPosition(slot)
+                for slot in self.slots]
+        pending = [len(pair)]
+        sent = self.clock.monotonic()
+
+        def on_value(value):
+            pending[0] -= 1
+            if not pending[0]:
+                self._add_sample(sent, pair)
+
+        for message in pair:
+            message.callback = on_value
+        with self._lock:
+            self.in_flight += 1
+        self.bot.manager.send_many(pair)
+        return True
+
+    def _add_sample(self, sent, pair):
+        # Halfway between the request and the reply is our best guess of
+        # when the encoders were read
+        now = self.clock.monotonic()
+        with self._lock:
+            row = self.samples[self.count % len(self.samples)]
+            row[0] = (sent + now) / 2
+            row[1] = pair[0].value
+            row[2] = pair[1].value
+            self.count += 1
+            self.in_flight = max(self.in_flight - 1, 0)
+            self._last_reply = now
+
+    def _new_samples(self):
+        capacity = len(self.samples)
+        # One old sample to difference against
+        first = max(self._integrated - 1, 0)
+        with self._lock:
+            count = self.count
+            start = max(first, count - capacity)
+            # Copied before a reply can overwrite any of them
+            samples = self.samples[numpy.arange(start, count) % capacity]
+        if start > first:
+            skipped = start - first
+            logger.warning("Odometry overwrote %i steps before integrating "
+                           "them; the pose is off by their motion" % skipped)
+            self.skipped += skipped
+        self._integrated = count
+        if len(samples) < 2:
+            return None
+        return samples
+
+    def update(self):
+        with self._update_lock:
+            self._update()
+
+    def _update(self):
+        samples = self._new_samples()
+        if samples is None:
+            return
+        degrees = numpy.diff(samples[:, 1:], axis=0) * self.directions
+        distances = degrees * self.distance_per_degree
+        ds = distances.mean(axis=1)
+        dtheta = (distances[:, 1] - distances[:, 0]) / self.wheel_base
+        theta = self._theta + numpy.cumsum(dtheta)
+        # Each step moves along the heading halfway through the turn
+        heading = theta - dtheta / 2
+        self._x += float((ds * numpy.cos(heading)).sum())
+        self._y += float((ds * numpy.sin(heading)).sum())
+        self._theta = float(theta[-1])
+        dt = samples[-1, 0] - samples[0, 0]
+        if dt > 0:
+            self._velocity = (float(ds.sum() / dt), float(dtheta.sum() / dt))
+
+    @property
+    def pose(self):
+        """(x, y, theta) in meters and radians from where odometry started"""
+        with self._update_lock:
+            self._update()
+            return self._x, self._y, self._theta
+
+    @property
+    def velocity(self):
+        """(forward m/s, turning rad/s) over the last batch of samples"""
+        with self._update_lock:
+            self._update()
+            return self._velocity
+
+    def reset(self, x=0.0, y=0.0, theta=0.0):
+        with self._update_lock:
+            self._update()
+            self._x, self._y, self._theta = x, y, theta
@@ -0,0 +1,345 @@
+"""The MegaPi serial protocol, as one table.
+
+A request frame is::
+
+    0xff 0x55 length ext_id action device_id fields...
+
+where length counts everything after itself.  A response frame is::
+
+    0xff 0x55 ext_id type value... 0x0d 0x0a
+
+(or just 0xff 0x55 0x0d 0x0a, when there's nothing to say).  Each Command
+below knows its action, device id, the layout of its fields and what type
+of response it gets, and both communication.Message and megapi.MegaPi
+encode through them.
+"""
+import struct
+
+GET = 0x01
+RUN = 0x02
+CAMERA = 0x03
+
+# Response value types
+BYTE = 1
+FLOAT = 2
+SHORT = 3
+STRING = 4
+DOUBLE = 5
+LONG = 6
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Command(object):
+    """One kind of request, from its field layout
+
+    fields is a space-separated list of name:format (a struct format
+    character), or =number for a fixed byte.  The last field may have the
+    format str (a length byte then the text) or bytes (the bytes as they
+    are).
+    """
+
+    def __init__(self, name, action, device_id, fields="", response=None):
+        self.name = name
+        self.action = action
+        self.device_id = device_id
+        self.response = response
+        self.field_names = []
+        self.tail = None
+        # Where each field lands in the encoded frame, and its struct format
+        self.offsets = {}
+        self.formats = {}
+        # The fixed bytes, by where they land
+        self.fixed = {}
+        self._template = []
+        formats = "<BBBBBB"
+        for field in fields.split():
+            if field.startswith("="):
+                self.fixed[struct.calcsize(formats)] = int(field[1:], 0)
+                self._template.append(int(field[1:], 0))
+                formats += "B"
+                continue
+            name, format = field.split(":")
+            self.offsets[name] = struct.calcsize(formats)
+            self.formats[name] = format
+            if format in ("str", "bytes"):
+                self.tail = format
+            else:
+                self._template.append(None)
+                formats += format
+            self.field_names.append(name)
+        self.struct = struct.Struct(formats)
+        self._fixed_length = self.struct.size - 3
+
+    def __repr__(self):
+        return "<Command %s action=%s device=%s %s>" % (
+            self.name, self.action, self.device_id, " ".join(self.field_names))
+
+    def encode(self, ext_id, *values):
+        if len(values) != len(self.field_names):
+            raise TypeError("%s takes %s (got %r)" % (
+                self.name, ", ".join(self.field_names), values))
+        tail = b""
+        if self.tail:
+            tail = bytes(bytearray(values[-1]))
+            values = values[:-1]
+            if self.tail == "str":
+                tail = bytes([len(tail)]) + tail
+        values = iter(values)
+        fields = [next(values) if t is None else t for t in self._template]
+        return self.struct.pack(
+            0xff, 0x55, self._fixed_length + len(tail),
+            ext_id, self.action, self.device_id, *fields) + tail
+
+
+COMMANDS = dict((command.name, command) for command in [
+    Command("version", GET, 0, "port:B", STRING),
+    Command("digital_read", GET, 0x1e, "port:B", FLOAT),
+    Command("analog_read", GET, 0x1f, "port:B", FLOAT),
+    Command("light_sensor_read", GET, 4, "port:B", FLOAT),
+    Command("ultrasonic_sensor_read", GET, 1, "port:B", FLOAT),
+    Command("line_follower_read", GET, 17, "port:B", FLOAT),
+    Command("sound_sensor_read", GET, 7, "port:B", FLOAT),
+    Command("pir_motion_sensor_read", GET, 15, "port:B", FLOAT),
+    Command("potentiometer_read", GET, 4, "port:B", FLOAT),
+    Command("limit_switch_read", GET, 21, "port:B", FLOAT),
+    Command("temperature_read", GET, 2, "port:B", FLOAT),
+    Command("touch_sensor_read", GET, 15, "port:B", FLOAT),
+    Command("humiture_sensor_read", GET, 23, "port:B type:B", FLOAT),
+    Command("joystick_read", GET, 5, "port:B axis:B", FLOAT),
+    Command("gas_sensor_read", GET, 25, "port:B", FLOAT),
+    Command("flame_sensor_read", GET, 24, "port:B", FLOAT),
+    Command("compass_read", GET, 26, "port:B", FLOAT),
+    Command("angular_sensor_read", GET, 28, "port:B", FLOAT),
+    Command("button_read", GET, 22, "port:B", FLOAT),
+    Command("gyro_read", GET, 6, "port:B axis:B", FLOAT),
+    Command("pressure_sensor_read", GET, 29, "port:B", FLOAT),
+    Command("encoder_motor_position", GET, 61, "=0 slot:B =1", FLOAT),
+    Command("encoder_motor_speed", GET, 61, "=0 slot:B =2", FLOAT),
+    Command("pressure_sensor_begin", RUN, 29),
+    Command("digital_write", RUN, 0x1e, "pin:B level:B"),
+    Command("pwm_write", RUN, 0x20, "pin:B pwm:B"),
+    Command("motor_run", RUN, 0x0a, "port:B speed:h"),
+    Command("motor_move", RUN, 0x05, "left:h right:h"),
+    Command("servo_run", RUN, 0x0b, "port:B slot:B angle:B"),
+    Command("encoder_motor_run", RUN, 62, "=2 slot:B speed:h"),
+    Command("encoder_motor_move", RUN, 62,
+            "=1 slot:B distance:l speed:h", FLOAT),
+    Command("encoder_motor_move_to", RUN, 62,
+            "=6 slot:B distance:l speed:h", FLOAT),
+    Command("encoder_motor_set_cur_pos_zero", RUN, 62, "=4 slot:B"),
+    Command("stepper_motor_run", RUN, 76, "=2 slot:B speed:h"),
+    Command("stepper_motor_move", RUN, 76,
+            "=1 port:B distance:l speed:h", FLOAT),
+    Command("stepper_motor_move_to", RUN, 76,
+            "=6 port:B distance:l speed:h", FLOAT),
+    Command("stepper_motor_set_cur_pos_zero", RUN, 76, "=4 port:B"),
+    Command("rgbled_display", RUN, 18,
+            "port:B slot:B index:B red:B green:B blue:B"),
+    Command("rgbled_show", RUN, 19, "port:B slot:B"),
+    Command("seven_segment_display", RUN, 9, "port:B number:f"),
+    Command("led_matrix_message", RUN, 41, "port:B =1 x:b y:b message:str"),
+    Command("led_matrix_display", RUN, 41, "port:B =2 x:B y:B buffer:bytes"),
+    Command("camera", CAMERA, 20, "port:B mode:B"),
+])
+
+
+_BY_DEVICE = {}
+for _command in COMMANDS.values():
+    _BY_DEVICE.setdefault((_command.action, _command.device_id), []).append(
+        _command)
+del _command
+
+
+def find_command(frame):
+    """Returns the Command that encoded a request frame, or None
+
+    frame starts at the 0xff 0x55.  Commands for the same device are told
+    apart by their fixed bytes, but some (like the light sensor and
+    potentiometer reads) encode the same and either may come back.
+    """
+    if len(frame) < 6:
+        return None
+    for command in _BY_DEVICE.get((frame[4], frame[5]), ()):
+        if all(offset < len(frame) and frame[offset] == value
+               for offset, value in command.fixed.items()):
+            return command
+    return None
+
+
+def acknowledged(data):
+    """How many of the request frames in data the board acknowledges
+
+    Everything but a read gets an empty response frame once the board has
+    run it, which looks just like a keepalive.
+    """
+    count = 0
+    pos = 0
+    while pos + 5 <= len(data):
+        if data[pos + 4] != GET:
+            count += 1
+        pos += 3 + data[pos + 2]
+    return count
+
+
+def encode_response(ext_id, value):
+    """Returns a response frame for a value, as the board might send it
+
+    Floats go as FLOAT, bytes as STRING and other numbers as LONG, so a
+    decoded value can be passed on as it came.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        payload = bytes([STRING, len(value)]) + bytes(value)
+    elif isinstance(value, float):
+        payload = bytes([FLOAT]) + struct.pack("<f", value)
+    else:
+        payload = bytes([LONG]) + struct.pack("<l", value)
+    return HEADER + bytes([ext_id]) + payload + b"\r\n"
+
+
+def _decode_string(frame):
+    if len(frame) < 3 or len(frame) < 3 + frame[2]:
+        raise ProtocolError("Truncated string in %r" % bytes(frame))
+    length = frame[2]
+    return bytes(frame[3:3 + length])
+
+
+def _unpacker(format):
+    unpack_from = struct.Struct(format).unpack_from
+
+    def decode(frame):
+        try:
+            return unpack_from(frame, 2)[0]
+        except struct.error as e:
+            raise ProtocolError(str(e))
+    return decode
+
+
+DECODERS = {
+    BYTE: _unpacker("<B"),
+    FLOAT: _unpacker("<f"),
+    SHORT: _unpacker("<h"),
+    STRING: _decode_string,
+    # The firmware's doubles are 4 byte floats
+    DOUBLE: _unpacker("<f"),
+    LONG: _unpacker("<l"),
+}
+
+
+# Bytes of value after the type, for every type but STRING (which has a
+# length byte first)
+PAYLOAD_SIZES = {
+    BYTE: 1,
+    FLOAT: 4,
+    SHORT: 2,
+    DOUBLE: 4,
+    LONG: 4,
+}
+
+HEADER = b"\xff\x55"
+
+
+class FrameDecoder(object):
+    """Splits response frames out of the bytes coming from the board
+
+    There's no checksum, so a frame only counts if its type is known and the
+    terminator is right where that type's payload ends.  Anything else is
+    counted and skipped up to the next 0xff 0x55, so a corrupted byte costs
+    the frame it's in, and the decoder is back in step within the longest
+    frame (261 bytes, for a string) of it.  Counts go in stats:
+
+    corrupt
+        the terminator wasn't where it should be
+    truncated
+        the same, but with another frame starting where the rest should be
+    unexpected
+        a response type there's no decoder for
+    skipped_bytes
+        bytes outside any frame, like text the board prints as it starts
+    """
+
+    counters = ("corrupt", "truncated", "unexpected", "skipped_bytes")
+
+    def __init__(self, stats=None):
+        self.stats = stats if stats is not None else {}
+        for name in self.counters:
+            self.stats.setdefault(name, 0)
+        self.buffer = bytearray()
+
+    def reset(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Returns [(frame, ext_id, value)] for the frames data completes
+
+        frame is a memoryview of ext_id, type and payload.  Empty frames,
+        which the board sends as keepalives and acknowledgements, come out
+        with an ext_id of None.
+        """
+        buffer = self.buffer
+        buffer += data
+        stats = self.stats
+        frames = []
+        pos = 0
+        while True:
+            start = buffer.find(HEADER, pos)
+            if start < 0:
+                # Keep a last 0xff, which may be the start of a header
+                end = len(buffer) - (buffer.endswith(b"\xff") and 1 or 0)
+                stats["skipped_bytes"] += max(end - pos, 0)
+                pos = max(end, pos)
+                break
+            if start > pos:
+                stats["skipped_bytes"] += start - pos
+                pos = start
+            if len(buffer) < pos + 4:
+                break
+            if buffer[pos + 2] == 0x0d and buffer[pos + 3] == 0x0a:
+                frames.append(
+                    (memoryview(buffer)[pos + 2:pos + 2], None, None))
+                pos += 4
+                continue
+            kind = buffer[pos + 3]
+            size = PAYLOAD_SIZES.get(kind)
+            if size is None:
+                if kind != STRING:
+                    stats["unexpected"] += 1
+                    pos += 2
+                    continue
+                if len(buffer) < pos + 5:
+                    break
+                size = 1 + buffer[pos + 4]
+            end = pos + 4 + size
+            if len(buffer) < end + 2:
+                break
+            if buffer[end] != 0x0d or buffer[end + 1] != 0x0a:
+                if buffer.find(HEADER, pos + 2, end + 2) >= 0:
+                    stats["truncated"] += 1
+                else:
+                    stats["corrupt"] += 1
+                pos += 2
+                continue
+            frame = memoryview(buffer)[pos + 2:end]
+            ext_id, value = decode(frame)
+            frames.append((frame, ext_id, value))
+            pos = end + 2
+        if pos:
+            # A fresh buffer, as the frames handed out are views of this one
+            self.buffer = buffer[pos:]
+        return frames
+
+
+def decode(frame):
+    """Returns (ext_id, value) from the bytes between 0xff 0x55 and 0x0d 0x0a
+
+    frame can be anything that supports the buffer protocol, like a
+    memoryview of the read buffer.
+    """
+    if len(frame) < 2:
+        raise ProtocolError("Frame too short: %r" % bytes(frame))
+    decoder = DECODERS.get(frame[1])
+    if decoder is None:
+        raise ProtocolError("Unknown response type %s" % frame[1])
+    return frame[0], decoder(frame)
@@ -0,0 +1,107 @@
+"""Sensor history on disk, a column file per device per field.
+
+A Recorder keeps, for every sensor it hears from, two files in its
+directory:
+
+    <name>.time     when each value came in, as little-endian float64
+    <name>.value    the values, as little-endian float32 (the board's floats)
+
+Records are collected in memory and appended batch records at a time, so
+recording costs the reading thread an append.  load() maps the files
+straight into NumPy arrays, with nothing to parse::
+
+    rec = bot.record("run1")
+    ...
+    rec.close()
+    times, values = recorder.load("run1")["front"]
+"""
+import array
+import glob
+import os
+import sys
+import threading
+
+import numpy
+
+TIME = ".time"
+VALUE = ".value"
+
+
+class Recorder(object):
+
+    def __init__(self, directory, batch=4096):
+        self.directory = directory
+        self.batch = batch
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # name: (times, values) waiting to be written
+        self._pending = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def __repr__(self):
+        return "<Recorder %s, %s devices>" % (
+            self.directory, len(self._pending))
+
+    def add(self, name, time, value):
+        if isinstance(value, (bytes, bytearray, str)) or value is None:
+            # Only numbers go in the log
+            return
+        with self._lock:
+            columns = self._pending.get(name)
+            if columns is None:
+                columns = self._pending[name] = (
+                    array.array("d"), array.array("f"))
+            columns[0].append(time)
+            columns[1].append(value)
+            self._count += 1
+            if self._count >= self.batch:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        for name, (times, values) in self._pending.items():
+            if not times:
+                continue
+            # Values last, so a crash between the two can only leave a time
+            # without its value, which load() leaves out
+            for suffix, column in ((TIME, times), (VALUE, values)):
+                if sys.byteorder != "little":
+                    column.byteswap()
+                with open(self._path(name, suffix), "ab") as f:
+                    column.tofile(f)
+                del column[:]
+        self._count = 0
+
+    def _path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+
+def load(directory):
+    """Returns {name: (times, values)}, as arrays mapping the files"""
+    log = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*" + TIME))):
+        name = os.path.basename(path)[:-len(TIME)]
+        times = _map(path, "<f8")
+        values = _map(path[:-len(TIME)] + VALUE, "<f4")
+        length = min(len(times), len(values))
+        log[name] = times[:length], values[:length]
+    return log
+
+
+def _map(path, dtype):
+    dtype = numpy.dtype(dtype)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    length = size // dtype.itemsize
+    if not length:
+        # numpy can't map an empty file
+        return numpy.empty(0, dtype)
+    return numpy.memmap(path, dtype=dtype, mode="r", shape=(length,))
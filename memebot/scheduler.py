@@ -0,0 +1,229 @@
+"""Polling sensors on a schedule.
+
+Scheduler asks each sensor for a new value at its own rate.  Sensors that
+interfere with each other (ultrasonic sensors hearing each other's pings)
+can be put in a conflict group: only one sensor in a group is read per time
+slot, while everything else keeps going out in the same writes.
+
+In the configure() text a group is a line naming its sensors::
+
+    ultrasound 10 front
+    ultrasound 11 back
+    conflict front back
+
+With adaptive=True each sensor's rate follows its signal: a reading that
+moved more than the sensor's change_threshold since the last one doubles
+the rate (up to max_rate), and a steady reading halves it (down to
+min_rate).  budget caps the requests per second across all sensors; when
+it's used up, the most overdue sensors go first.  Polling is sent at low
+priority, so it also waits whenever the link is past Connection.ceiling,
+and only fills whatever room the Manager's in-flight window has left.
+"""
+import logging
+import threading
+
+from . import communication
+
+logger = logging.getLogger(__name__)
+
+
+class ConflictGroup(object):
+
+    def __init__(self, names, slot):
+        self.names = list(names)
+        self.slot = slot
+        self.free_at = 0.0
+
+    def __repr__(self):
+        return "<ConflictGroup %s slot=%ss>" % (
+            " ".join(self.names), self.slot)
+
+
+class Scheduler(object):
+
+    # Polling gives way to other traffic when the link gets busy, trying
+    # again after retry_delay
+    priority = communication.PRIORITY_LOW
+    retry_delay = 0.005
+
+    def __init__(self, bot, rate=10, slot=0.03, groups=(), sensors=None,
+                 adaptive=False, min_rate=1, max_rate=50, budget=None):
+        self.bot = bot
+        self.clock = bot.clock
+        if sensors is None:
+            sensors = bot.sensors()
+        self.sensors = {sensor.name: sensor for sensor in sensors}
+        self.periods = {name: 1.0 / rate for name in self.sensors}
+        self.adaptive = adaptive
+        self.limits = {name: (1.0 / max_rate, 1.0 / min_rate)
+                       for name in self.sensors}
+        self.thresholds = {name: sensor.change_threshold
+                           for name, sensor in self.sensors.items()}
+        self.last_values = {}
+        self.budget = budget
+        self.tokens = budget / 10.0 if budget else 0
+        self.deferred = 0
+        self._refilled = None
+        self._retry_at = 0.0
+        self.due = {name: 0.0 for name in self.sensors}
+        self.groups = [ConflictGroup(names, slot) for names in groups]
+        self.group_of = {}
+        for group in self.groups:
+            for name in group.names:
+                if name not in self.sensors:
+                    raise ValueError(
+                        "No sensor named %r in %r" % (name, group))
+                self.group_of[name] = group
+        self.sent = {name: 0 for name in self.sensors}
+        self.running = False
+        self.thread = None
+
+    def __repr__(self):
+        return "<Scheduler %s sensors, %s groups>" % (
+            len(self.sensors), len(self.groups))
+
+    def set_rate(self, name, rate):
+        self.periods[name] = 1.0 / rate
+
+    def set_limits(self, name, min_rate=None, max_rate=None, threshold=None):
+        shortest, longest = self.limits[name]
+        if max_rate is not None:
+            shortest = 1.0 / max_rate
+        if min_rate is not None:
+            longest = 1.0 / min_rate
+        self.limits[name] = (shortest, longest)
+        if threshold is not None:
+            self.thresholds[name] = threshold
+
+    def rate(self, name):
+        return 1.0 / self.periods[name]
+
+    def observe(self, name, value):
+        """Adjusts a sensor's rate given a new value"""
+        last = self.last_values.get(name)
+        self.last_values[name] = value
+        if last is None or value is None:
+            return
+        shortest, longest = self.limits[name]
+        if abs(value - last) > self.thresholds[name]:
+            period = self.periods[name] / 2
+        else:
+            period = self.periods[name] * 2
+        self.periods[name] = min(max(period, shortest), longest)
+
+    def _request(self, name):
+        sensor = self.sensors[name]
+        message = sensor.request()
+        if self.adaptive:
+            def callback(value):
+                sensor.on_update(value)
+                self.observe(name, value)
+            message.callback = callback
+        return message
+
+    def _allowance(self, now):
+        # Token bucket, holding at most a tenth of a second of budget
+        if not self.budget:
+            return None
+        if self._refilled is not None:
+            refill = (now - self._refilled) * self.budget
+            self.tokens = min(self.tokens + refill, max(self.budget / 10.0, 1))
+        self._refilled = now
+        return int(self.tokens)
+
+    def poll(self, now=None):
+        """Sends a request for every sensor that is due and free to go
+
+        Returns the names of the sensors asked.
+        """
+        if now is None:
+            now = self.clock.monotonic()
+        chosen = []
+        waiting = {}
+        for name, due in self.due.items():
+            if due > now:
+                continue
+            group = self.group_of.get(name)
+            if group is None:
+                chosen.append(name)
+            elif group.free_at <= now:
+                # Whoever in the group has waited longest gets the slot
+                if group not in waiting or due < self.due[waiting[group]]:
+                    waiting[group] = name
+        chosen.extend(waiting.values())
+        allowance = self._allowance(now)
+        if allowance is not None and len(chosen) > allowance:
+            chosen.sort(key=lambda name: self.due[name])
+            self.deferred += len(chosen) - allowance
+            chosen = chosen[:allowance]
+        # Only as many as the in-flight window has room for, rather than a
+        # burst the board would drop
+        room = self.bot.manager.room()
+        if len(chosen) > room:
+            chosen.sort(key=lambda name: self.due[name])
+            self.deferred += len(chosen) - room
+            chosen = chosen[:room]
+            if not chosen:
+                self._retry_at = now + self.retry_delay
+        if not chosen:
+            return chosen
+        try:
+            self.bot.manager.send_many(
+                [self._request(name) for name in chosen], self.priority)
+        except communication.LinkSaturated:
+            # Leave them due, to go when the link has room
+            self.deferred += len(chosen)
+            self._retry_at = now + self.retry_delay
+            return []
+        if allowance is not None:
+            self.tokens -= len(chosen)
+        for name in chosen:
+            group = self.group_of.get(name)
+            if group is not None:
+                group.free_at = now + group.slot
+            self.due[name] = max(self.due[name] + self.periods[name], now)
+            self.sent[name] += 1
+        return chosen
+
+    def next_event(self, now):
+        times = []
+        for name, due in self.due.items():
+            group = self.group_of.get(name)
+            if group is not None:
+                due = max(due, group.free_at)
+            times.append(due)
+        if not times:
+            return now + 1
+        next_time = max(min(times), self._retry_at)
+        if self.budget and self.tokens < 1:
+            next_time = max(next_time, now + (1 - self.tokens) / self.budget)
+        return next_time
+
+    def start(self):
+        self.running = True
+        if self.clock.simulated:
+            self.clock.call_at(self.clock.monotonic(), self._step)
+            return self
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            now = self.clock.monotonic()
+            self.poll(now)
+            delay = self.next_event(now) - self.clock.monotonic()
+            if delay > 0:
+                self.clock.sleep(delay)
+
+    def _step(self):
+        # run(), one poll at a time, as simulation events
+        if not self.running:
+            return
+        now = self.clock.monotonic()
+        self.poll(now)
+        self.clock.call_at(max(self.next_event(now), now), self._step)
@@ -0,0 +1,194 @@
+"""Running a bot on virtual time.
+
+A Simulation runs a Bot, its Manager, any schedulers, control loops and
+odometry, and an emulated MegaPi on one SimClock, with no threads and no
+real sleeping: whenever something would wait, the clock jumps straight to
+the next event.  Hours of polling run in seconds, and the same inputs give
+the same results every time::
+
+    sim = simulation.Simulation()
+    bot = sim.bot('''
+    ultrasound 10 front
+    light_sensor 6 light
+    ''', latency=0.002, values={(1, 10): 25.0})
+    bot.scheduler(rate=20).start()
+    sim.run(3600)
+    print(bot.manager.stats)
+
+The simulated board takes its bytes at the baud rate, works through
+requests one at a time, and sends responses back at the baud rate, so
+throughput estimates account for the link as well as the board.
+"""
+import heapq
+import itertools
+
+import serial
+
+from . import clock as clocks
+from . import emulator
+
+
+class SimClock(clocks.Clock):
+    """Virtual time, moved on by running the events queued on it
+
+    Both time() and monotonic() are seconds since the simulation started.
+    """
+
+    simulated = True
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self.events = []
+        self.processed = 0
+        self._order = itertools.count()
+
+    def __repr__(self):
+        return "<SimClock %.6fs, %s events queued>" % (
+            self.now, len(self.events))
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def call_at(self, when, function, *args):
+        # Events at the same time run in the order they were queued
+        heapq.heappush(self.events, (max(when, self.now), next(self._order),
+                                     function, args))
+
+    def call_later(self, delay, function, *args):
+        self.call_at(self.now + delay, function, *args)
+
+    def step(self, timeout=None):
+        """Runs the next event, if it comes within timeout
+
+        Otherwise moves the clock on by timeout.  Returns whether an event
+        ran.
+        """
+        deadline = None if timeout is None else self.now + timeout
+        if self.events and (deadline is None or self.events[0][0] <= deadline):
+            when, order, function, args = heapq.heappop(self.events)
+            self.now = max(self.now, when)
+            self.processed += 1
+            function(*args)
+            return True
+        if deadline is not None:
+            self.now = max(self.now, deadline)
+        return False
+
+    def run_until(self, predicate=None, timeout=None):
+        """Runs events until predicate() is true or timeout passes
+
+        Returns predicate(), or False without one.  With no timeout this
+        stops when there's nothing left to do, which with a scheduler
+        running is never.
+        """
+        deadline = None if timeout is None else self.now + timeout
+        while not (predicate is not None and predicate()):
+            if not self.events:
+                break
+            if deadline is not None and self.events[0][0] > deadline:
+                break
+            self.step()
+        if predicate is not None and predicate():
+            return True
+        if deadline is not None:
+            self.now = max(self.now, deadline)
+        return False
+
+    def sleep(self, seconds):
+        self.run_until(None, seconds)
+
+
+class SimulatedSerial(emulator.EmulatedSerial):
+    """An EmulatedSerial whose bytes travel as events on a SimClock
+
+    latency is how long the board takes over each request; it works
+    through them one at a time.  Responses go to the Connection attached
+    with attach(), as nothing reads the port.  record is whether to keep
+    what's written, as for EmulatedSerial.
+    """
+
+    def __init__(self, clock, baudrate=115200, values=None, latency=0.002,
+                 rx_buffer=None, record=True):
+        emulator.EmulatedSerial.__init__(
+            self, baudrate=baudrate, timeout=0, values=values,
+            latency=latency, rx_buffer=rx_buffer, record=record)
+        self.clock = clock
+        self.conn = None
+        # When the wire each way, and the board, are next free
+        self._to_board = self._from_board = self._board_free = 0.0
+        self._working = 0
+
+    def attach(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        if not self._open:
+            raise serial.SerialException("Port is closed")
+        data = bytes(data)
+        self.bytes_written += len(data)
+        if self.record:
+            self.written += data
+        start = max(self.clock.now, self._to_board)
+        self._to_board = start + emulator.wire_time(len(data), self.baudrate)
+        self.clock.call_at(self._to_board, self._arrive, data)
+        return len(data)
+
+    def _arrive(self, data):
+        self._pending += data
+        self._parse_pending()
+
+    def busy(self):
+        return self._working
+
+    def respond(self, payload):
+        self._working += 1
+        start = max(self.clock.now, self._board_free)
+        self._board_free = start + self.latency
+        self.clock.call_at(self._board_free, self._answer,
+                           b"\xff\x55" + payload + b"\r\n")
+
+    def _answer(self, data):
+        self._working -= 1
+        start = max(self.clock.now, self._from_board)
+        self._from_board = start + emulator.wire_time(len(data), self.baudrate)
+        self.clock.call_at(self._from_board, self._deliver, data)
+
+    def _deliver(self, data):
+        if self._open and self.conn is not None:
+            self.conn.feed(data)
+
+    def read(self, size=1):
+        return b""
+
+
+class Simulation(object):
+
+    def __init__(self, start=0.0):
+        self.clock = SimClock(start)
+
+    def __repr__(self):
+        return "<Simulation at %.3fs>" % self.clock.now
+
+    @property
+    def now(self):
+        return self.clock.now
+
+    def serial(self, **kw):
+        return SimulatedSerial(self.clock, **kw)
+
+    def bot(self, config="", probe_timeout=3, **kw):
+        """configure()s a Bot against a SimulatedSerial(**kw)
+
+        Any connection line in config is ignored.
+        """
+        from . import memebot
+        return memebot.configure(config, probe_timeout,
+                                 connection=self.serial(**kw),
+                                 clock=self.clock)
+
+    def run(self, duration):
+        """Runs everything for duration seconds of virtual time"""
+        self.clock.sleep(duration)
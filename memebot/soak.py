@@ -0,0 +1,307 @@
+"""Long runs at full rate, to catch slow leaks and slowdowns.
+
+A Soak keeps a Bot's sensors read as fast as the window allows for a
+while, and every interval takes a Sample: memory traced by tracemalloc,
+the process's RSS, counts of the commonest object types, what's waiting in
+Manager.handlers and the decoder's buffer, and percentiles of how long
+read_all() took.  Once the warmup's out of the way, it fits a line through
+the samples and fails the run if traced memory or the p99 read time grows
+faster than allowed::
+
+    bot = memebot.configure(config,
+                            connection=emulator.EmulatedSerial(noise=0.01))
+    report = soak.Soak(bot, duration=3600).run()
+    print(report.format())
+    assert report.ok
+
+as ``memebot soak`` does.  Short runs give noisy slopes: a leak of a few
+bytes a request needs minutes to stand out.
+"""
+import collections
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from . import bench
+from . import communication
+
+# Sensors for a soak without a configuration of its own, all of them ones
+# read_all() can read
+DEFAULT_CONFIG = """
+ultrasound 10 front
+ultrasound 11 back
+light_sensor 6 light
+motion 8
+"""
+
+# What's taken every interval.  objects is {type name: count} for the most
+# common types; handlers counts requests waiting for a response and
+# buffered the bytes the decoder is holding.  reads is how many read_all()
+# calls finished since the last sample, and p50 and p99 are percentiles of
+# how long they took (None if there weren't any).
+Sample = collections.namedtuple(
+    "Sample", "time traced rss objects handlers buffered reads p50 p99")
+
+
+def rss():
+    """The process's resident set size in bytes, or None if it's unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # The peak rather than the current size, but it still shows a leak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def slope(points):
+    """The least squares slope through [(x, y)], or None for under two"""
+    points = [(x, y) for x, y in points if y is not None]
+    if len(points) < 2:
+        return None
+    n = float(len(points))
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    spread = sum((x - mean_x) ** 2 for x, y in points)
+    if not spread:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+
+def trend(points, groups=8):
+    """The slope through [(x, y)], with outliers damped
+
+    A line through the medians of groups runs of consecutive points, so a
+    spike in one interval (like a collection pausing everything) doesn't
+    swing it the way it would a plain least squares fit.
+    """
+    points = sorted((x, y) for x, y in points if y is not None)
+    groups = min(groups, len(points))
+    medians = []
+    for i in range(groups):
+        run = points[len(points) * i // groups:len(points) * (i + 1) // groups]
+        medians.append((_median([x for x, y in run]),
+                        _median([y for x, y in run])))
+    return slope(medians)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def count_objects(top=10):
+    """{type name: count} for the top most common types of object"""
+    counts = collections.Counter(type(o).__name__ for o in gc.get_objects())
+    return dict(counts.most_common(top))
+
+
+class Soak(object):
+    """Runs bot at full request rate for duration seconds
+
+    drivers threads each call read_all() in a loop, waiting backoff seconds
+    whenever the link is too busy to take more.  Growth limits are per
+    hour: max_memory_growth in bytes of traced memory, max_latency_growth
+    in seconds of p99 read time.  The first warmup of the run (a fraction
+    of it) is left out of the fit, while caches and the window settle.
+    The samples themselves take a few hundred bytes each, which counts
+    against max_memory_growth.
+    """
+
+    backoff = 0.001
+
+    def __init__(self, bot, duration=60.0, interval=1.0, drivers=2,
+                 warmup=0.2, max_memory_growth=10e6, max_latency_growth=0.05,
+                 timeout=1.0, top=10):
+        self.bot = bot
+        self.duration = duration
+        self.interval = interval
+        self.drivers = drivers
+        self.warmup = warmup
+        self.max_memory_growth = max_memory_growth
+        self.max_latency_growth = max_latency_growth
+        self.timeout = timeout
+        self.top = top
+        self.sensors = bot.sensors()
+        if not self.sensors:
+            raise ValueError("%s has no sensors to read" % bot)
+        self.samples = []
+        self.errors = collections.Counter()
+        self._latencies = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # tracemalloc snapshots at the end of the warmup and the latest
+        self._baseline = self._snapshot = None
+
+    def __repr__(self):
+        return "<Soak %ss, %s samples>" % (self.duration, len(self.samples))
+
+    def run(self):
+        """Runs the soak, returning a Report"""
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        threads = [threading.Thread(target=self._drive)
+                   for i in range(self.drivers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        start = time.monotonic()
+        due = self.interval
+        try:
+            while due <= self.duration:
+                # On the interval, however long sampling takes
+                time.sleep(max(start + due - time.monotonic(), 0))
+                self.sample(time.monotonic() - start)
+                due += self.interval
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join(self.timeout + 1)
+            if started_tracing:
+                tracemalloc.stop()
+        return Report(self)
+
+    def _drive(self):
+        bot = self.bot
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            try:
+                snapshot = bot.read_all(self.timeout, self.sensors)
+            except communication.LinkSaturated:
+                # As fast as the link goes, then
+                with self._lock:
+                    self.errors["saturated"] += 1
+                time.sleep(self.backoff)
+                continue
+            except IOError as e:
+                # Like the port going away; keep at it
+                with self._lock:
+                    self.errors[type(e).__name__] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._latencies.append(elapsed)
+                if snapshot.stale:
+                    self.errors["stale"] += len(snapshot.stale)
+
+    def sample(self, now):
+        """Takes a Sample at now, seconds into the run"""
+        with self._lock:
+            latencies, self._latencies = self._latencies, []
+        points = bench.percentiles(latencies, (50, 99))
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            # Not the soak's own bookkeeping
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        if now <= self.duration * self.warmup or self._baseline is None:
+            self._baseline = snapshot
+        self._snapshot = snapshot
+        manager = self.bot.manager
+        sample = Sample(
+            time=now,
+            traced=sum(stat.size for stat in snapshot.statistics("filename")),
+            rss=rss(),
+            objects=count_objects(self.top),
+            handlers=manager.in_flight(),
+            buffered=len(self.bot.conn.decoder.buffer),
+            reads=len(latencies),
+            p50=points[50],
+            p99=points[99])
+        self.samples.append(sample)
+        return sample
+
+    def growth(self, field):
+        """How fast field of the samples after the warmup grows, an hour"""
+        start = self.duration * self.warmup
+        rate = trend([(s.time, getattr(s, field)) for s in self.samples
+                      if s.time > start])
+        return None if rate is None else rate * 3600
+
+    def top_allocations(self, limit=5):
+        """Where traced memory grew most since the warmup, as StatisticDiffs"""
+        if self._snapshot is None:
+            return []
+        return self._snapshot.compare_to(self._baseline, "lineno")[:limit]
+
+
+class Report(object):
+    """What a Soak found; ok is whether it stayed within its limits"""
+
+    def __init__(self, soak):
+        self.soak = soak
+        self.samples = soak.samples
+        self.memory_growth = soak.growth("traced")
+        self.rss_growth = soak.growth("rss")
+        self.latency_growth = soak.growth("p99")
+        self.top_allocations = soak.top_allocations()
+        self.failures = []
+        if self.memory_growth is not None and \
+                self.memory_growth > soak.max_memory_growth:
+            self.failures.append(
+                "traced memory grows %.0f bytes/hour (limit %.0f)" % (
+                    self.memory_growth, soak.max_memory_growth))
+        if self.latency_growth is not None and \
+                self.latency_growth > soak.max_latency_growth:
+            self.failures.append(
+                "p99 read time grows %.2fms/hour (limit %.2fms)" % (
+                    self.latency_growth * 1e3,
+                    soak.max_latency_growth * 1e3))
+
+    def __repr__(self):
+        return "<Report %s>" % ("ok" if self.ok else "; ".join(self.failures))
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    def format(self):
+        lines = ["%8s %12s %12s %9s %9s %8s %9s %9s" % (
+            "time", "traced", "rss", "handlers", "buffered", "reads",
+            "p50 ms", "p99 ms")]
+        for s in self.samples:
+            lines.append("%8.1f %12i %12s %9i %9i %8i %9s %9s" % (
+                s.time, s.traced, s.rss if s.rss is not None else "-",
+                s.handlers, s.buffered, s.reads, _ms(s.p50), _ms(s.p99)))
+        lines.append("")
+        for name, rate, unit in [
+                ("traced memory", self.memory_growth, 1),
+                ("rss", self.rss_growth, 1),
+                ("p99 read time", self.latency_growth, 1e3)]:
+            if rate is None:
+                lines.append("%-14s growth -" % name)
+            else:
+                lines.append("%-14s growth %+.1f %s/hour" % (
+                    name, rate * unit, "ms" if unit != 1 else "bytes"))
+        if len(self.samples) >= 2:
+            first, last = self.samples[0].objects, self.samples[-1].objects
+            lines.append("objects        " + "  ".join(
+                "%s %+i" % (name, last[name] - first.get(name, 0))
+                for name in sorted(last, key=last.get, reverse=True)))
+        if self.top_allocations:
+            lines.append("grew most since the warmup:")
+            for stat in self.top_allocations:
+                lines.append("  %s" % stat)
+        if self.soak.errors:
+            lines.append("errors         " + "  ".join(
+                "%s %i" % item for item in sorted(self.soak.errors.items())))
+        lines.append("")
+        lines.append("FAILED: " + "; ".join(self.failures)
+                     if self.failures else "ok")
+        return "\n".join(lines)
+
+
+def _ms(seconds):
+    return "-" if seconds is None else "%.2f" % (seconds * 1e3)
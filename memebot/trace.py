@@ -0,0 +1,176 @@
+"""The serial timeline, as Chrome trace events.
+
+A Tracer hooks into a running Manager and its Connection and records, for
+every thread, what the link was doing and when:
+
+    send        a send_many() call, from being called to returning
+    write       a write to the port
+    bytes       bytes coming off the port
+    parse       splitting a response out of the bytes that completed it
+    dispatch    matching the response up with the request waiting for it
+    callback    setting the request's value, and its callback
+    timeout     a request given up on
+
+with the ext_ids involved.  save() writes the Trace Event Format JSON that
+Perfetto (ui.perfetto.dev) and chrome://tracing open::
+
+    tracer = trace.Tracer(bot.manager)
+    tracer.start()
+    ...
+    tracer.stop()
+    tracer.save("serial.json")
+
+It can be started and stopped any number of times while the bot runs; the
+latest size events are kept.
+"""
+import collections
+import json
+import os
+import threading
+
+CATEGORY = "memebot"
+
+
+def _ext_ids(data):
+    # The ext_ids of the requests in a write that get a response
+    ext_ids = []
+    pos = 0
+    while pos + 4 <= len(data):
+        if data[pos + 3]:
+            ext_ids.append(data[pos + 3])
+        pos += 3 + data[pos + 2]
+    return ext_ids
+
+
+class Tracer(object):
+
+    def __init__(self, manager, size=100000):
+        self.manager = manager
+        self.conn = manager.conn
+        self.size = size
+        # (phase, name, start, duration, thread id, args), times in seconds
+        self.events = collections.deque(maxlen=size)
+        self.threads = {}
+        self.running = False
+        # When bytes last came in, and the latest response was parsed and
+        # dispatched, by thread
+        self._received = {}
+        self._parsed = {}
+        self._dispatched = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Tracer %s, %s/%s events>" % (
+            "running" if self.running else "stopped", len(self.events),
+            self.size)
+
+    def _hooks(self):
+        return [
+            (self.manager, "on_send", self._on_send),
+            (self.conn, "on_write", self._on_write),
+            (self.conn, "on_bytes_in", self._on_bytes_in),
+            (self.conn, "on_frame_parsed", self._on_frame_parsed),
+            (self.manager, "on_dispatch", self._on_dispatch),
+            (self.manager, "on_delivered", self._on_delivered),
+            (self.manager, "on_timeout", self._on_timeout),
+        ]
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            for hookable, name, hook in self._hooks():
+                hookable.add_hook(name, hook)
+            self.running = True
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+            for hookable, name, hook in self._hooks():
+                hookable.remove_hook(name, hook)
+            self.running = False
+
+    def clear(self):
+        self.events.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _thread(self):
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        return tid
+
+    def _on_send(self, now, started, handlers):
+        ext_ids = [h.ext_id for h in handlers if h.expects_response]
+        self.events.append(("X", "send", started, now - started,
+                            self._thread(), {"messages": len(handlers),
+                                             "ext_ids": ext_ids}))
+
+    def _on_write(self, now, started, data):
+        self.events.append(("X", "write", started, now - started,
+                            self._thread(), {"bytes": len(data),
+                                             "ext_ids": _ext_ids(data)}))
+
+    def _on_bytes_in(self, now, data):
+        tid = self._thread()
+        self._received[tid] = now
+        self.events.append(("i", "bytes", now, 0, tid, {"bytes": len(data)}))
+
+    def _on_frame_parsed(self, now, frame, ext_id, value):
+        tid = self._thread()
+        # Later frames from the same bytes were split out along with the
+        # first
+        started = self._received.pop(tid, now)
+        self._parsed[tid] = now
+        self.events.append(("X", "parse", started, now - started, tid,
+                            {"ext_id": ext_id}))
+
+    def _on_dispatch(self, now, ext_id, value, handler):
+        tid = self._thread()
+        started = self._parsed.pop(tid, now)
+        self._dispatched[tid] = now
+        matched = handler is not None
+        self.events.append(("X", "dispatch", started, now - started, tid,
+                            {"ext_id": ext_id, "matched": matched}))
+
+    def _on_delivered(self, now, handler):
+        tid = self._thread()
+        started = self._dispatched.pop(tid, now)
+        self.events.append(("X", "callback", started, now - started, tid,
+                            {"ext_id": handler.ext_id,
+                             "request": type(handler).__name__}))
+
+    def _on_timeout(self, now, handler):
+        self.events.append(("i", "timeout", now, 0, self._thread(),
+                            {"ext_id": handler.ext_id,
+                             "request": type(handler).__name__}))
+
+    def export(self):
+        """The events recorded so far, as a Trace Event Format dict"""
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid,
+                   "args": {"name": "memebot"}}]
+        for tid, name in sorted(self.threads.items()):
+            events.append({"name": "thread_name", "ph": "M", "pid": pid,
+                           "tid": tid, "args": {"name": name}})
+        for phase, name, start, duration, tid, args in list(self.events):
+            event = {"name": name, "cat": CATEGORY, "ph": phase,
+                     "ts": start * 1e6, "pid": pid, "tid": tid, "args": args}
+            if phase == "X":
+                event["dur"] = duration * 1e6
+            else:
+                # An instant on its thread's track
+                event["s"] = "t"
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.export(), f)
@@ -0,0 +1,354 @@
+"""Serial I/O in a process of its own.
+
+A WorkerConnection is a Connection whose port belongs to a child process.
+The child reads, splits the bytes into frames and writes, so heavy Python
+work in the application's threads can't hold up the port: responses are
+taken off the wire as they arrive however busy the main process is.  The
+two processes swap frames through a pair of Rings in shared memory, and
+the Manager and Messages on top work as they do with a Connection::
+
+    conn = worker.WorkerConnection("/dev/ttyUSB0")
+    conn.manager.launch()
+    ...
+    conn.close()
+
+Bot.start(..., worker=True) and configure(..., worker=True) do the same for
+a Bot.
+"""
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import serial
+
+from . import communication
+from . import protocol
+
+logger = logging.getLogger(__name__)
+
+# What each record from the worker carries, in its first byte.  A FRAME
+# has the time it came off the port, by the monotonic clock (which is the
+# same in both processes), then the frame.  An EMPTY frame (a keepalive or
+# a command's acknowledgement) only has the time.
+FRAME = b"F"
+EMPTY = b"E"
+LOST = b"L"
+RESTORED = b"R"
+
+# Counts the worker keeps, by their index in WorkerConnection.counts
+COUNTERS = protocol.FrameDecoder.counters + ("overflows",)
+
+_time = struct.Struct("<d")
+
+
+class RingFull(communication.LinkSaturated):
+    """The worker isn't taking frames as fast as they're written
+
+    Back-pressure, like the link being too busy: the port's still there.
+    """
+
+
+class Ring(object):
+    """Length-prefixed records in shared memory, one writer and one reader
+
+    The head and tail are byte counts that only ever go up, each written by
+    one side, so neither side needs a lock.  A reader with nothing to read
+    raises a flag after them and sleeps on a semaphore, which the writer
+    only releases when the flag's up: waking takes one blocking call, and
+    a busy reader costs the writer nothing.
+    """
+
+    # head and tail; a byte after them says whether the reader is waiting
+    _indices = struct.Struct("<QQ")
+    _length = struct.Struct("<I")
+
+    def __init__(self, size=1 << 16):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self._indices.size + 1 + size)
+        self.shm.buf[:self._indices.size + 1] = bytes(self._indices.size + 1)
+        self.ready = multiprocessing.Semaphore(0)
+        self._attach()
+
+    def _attach(self):
+        self._waiting = self._indices.size
+        self._data = self.shm.buf[self._indices.size + 1:]
+
+    def __getstate__(self):
+        return self.shm.name, self.size, self.ready
+
+    def __setstate__(self, state):
+        name, self.size, self.ready = state
+        self.shm = shared_memory.SharedMemory(name)
+        # The process that made it unlinks it
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+        self._attach()
+
+    def __repr__(self):
+        head, tail = self._indices.unpack_from(self.shm.buf, 0)
+        return "<Ring %s, %s/%s bytes used>" % (
+            self.shm.name, head - tail, self.size)
+
+    def _copy_in(self, position, data):
+        start = position % self.size
+        first = min(len(data), self.size - start)
+        self._data[start:start + first] = data[:first]
+        self._data[:len(data) - first] = data[first:]
+
+    def _copy_out(self, position, length):
+        start = position % self.size
+        first = min(length, self.size - start)
+        return bytes(self._data[start:start + first]) + \
+            bytes(self._data[:length - first])
+
+    def put(self, *parts):
+        """Adds the concatenation of parts as one record
+
+        Returns False, adding nothing, if there isn't room.
+        """
+        length = sum(len(part) for part in parts)
+        head, tail = self._indices.unpack_from(self.shm.buf, 0)
+        if head - tail + self._length.size + length > self.size:
+            return False
+        self._copy_in(head, self._length.pack(length))
+        position = head + self._length.size
+        for part in parts:
+            self._copy_in(position, part)
+            position += len(part)
+        struct.pack_into("<Q", self.shm.buf, 0, position)
+        if self.shm.buf[self._waiting]:
+            self.shm.buf[self._waiting] = 0
+            self.ready.release()
+        return True
+
+    def get(self):
+        """Returns the oldest record, or None if there isn't one"""
+        head, tail = self._indices.unpack_from(self.shm.buf, 0)
+        if head == tail:
+            return None
+        length, = self._length.unpack(
+            self._copy_out(tail, self._length.size))
+        record = self._copy_out(tail + self._length.size, length)
+        struct.pack_into("<Q", self.shm.buf, 8,
+                         tail + self._length.size + length)
+        return record
+
+    def wait(self, timeout=None):
+        """Returns the oldest record, waiting up to timeout for one"""
+        record = self.get()
+        if record is None:
+            self.shm.buf[self._waiting] = 1
+            # Something may have arrived before the flag went up
+            record = self.get()
+            if record is None and self.ready.acquire(timeout=timeout):
+                record = self.get()
+            self.shm.buf[self._waiting] = 0
+        return record
+
+    def close(self, unlink=False):
+        self._data.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _RingPort(object):
+    """What the Connection in the main process writes to"""
+
+    def __init__(self, ring, baudrate, timeout=1.0):
+        self.ring = ring
+        self.baudrate = baudrate
+        # How long a write waits for the worker to make room
+        self.timeout = timeout
+        self._open = True
+
+    def isOpen(self):
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def write(self, data):
+        if not self._open:
+            raise serial.SerialException("Port is closed")
+        if Ring._length.size + len(data) > self.ring.size:
+            raise RingFull("%i bytes won't fit in the ring" % len(data))
+        deadline = time.monotonic() + self.timeout
+        while not self.ring.put(data):
+            if time.monotonic() > deadline:
+                raise RingFull("The worker isn't taking frames")
+            time.sleep(0.0005)
+        return len(data)
+
+
+def _open(port, baudrate, timeout):
+    if isinstance(port, str):
+        return serial.Serial(port, baudrate=baudrate, timeout=timeout)
+    # Something that opens a port, like emulator.EmulatedSerial
+    s = port()
+    s.timeout = timeout
+    return s
+
+
+def serve(port, baudrate, inbound, outbound, counts, stop,
+          read_timeout=0.05):
+    """The worker process: moves bytes between the port and the rings"""
+    s = _open(port, baudrate, read_timeout)
+    decoder = protocol.FrameDecoder()
+    connected = threading.Event()
+    connected.set()
+    state_lock = threading.Lock()
+    overflows = COUNTERS.index("overflows")
+
+    def lost(error):
+        with state_lock:
+            if not connected.is_set():
+                return
+            connected.clear()
+            decoder.reset()
+            inbound.put(LOST, str(error).encode("utf-8", "replace"))
+        try:
+            s.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def write():
+        while not stop.is_set():
+            data = outbound.wait(read_timeout)
+            if data is None or not connected.is_set():
+                # Anything written while the port's away is lost with it
+                continue
+            try:
+                s.write(data)
+            except (serial.SerialException, OSError) as e:
+                lost(e)
+
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    delay = communication.Connection.reconnect_delay
+    while not stop.is_set():
+        if not connected.is_set():
+            try:
+                s.open()
+            except (serial.SerialException, OSError):
+                time.sleep(delay)
+                delay = min(delay * 2,
+                            communication.Connection.max_reconnect_delay)
+                continue
+            delay = communication.Connection.reconnect_delay
+            connected.set()
+            inbound.put(RESTORED)
+            continue
+        try:
+            data = s.read(max(s.in_waiting, 1))
+        except (serial.SerialException, OSError) as e:
+            lost(e)
+            continue
+        if not data:
+            continue
+        received = _time.pack(time.monotonic())
+        for frame, ext_id, value in decoder.feed(data):
+            if ext_id is None:
+                put = inbound.put(EMPTY, received)
+            else:
+                put = inbound.put(FRAME, received, frame)
+            if not put:
+                counts[overflows] += 1
+        for i, name in enumerate(protocol.FrameDecoder.counters):
+            counts[i] = decoder.stats[name]
+    writer.join()
+    try:
+        s.close()
+    except (serial.SerialException, OSError):
+        pass
+
+
+class WorkerConnection(communication.Connection):
+    """A Connection to a port that a child process reads and writes
+
+    port is a port name, or something that opens a port in the child when
+    called with no arguments (like emulator.EmulatedSerial).  on_bytes_in
+    is never called, as the bytes never reach this process.  Round trip
+    times go to when the worker read the response, however long this
+    process took to get to it, and keepalives likewise count from when the
+    worker read them.  overflows in stats counts responses dropped because
+    this process fell so far behind that the inbound ring filled.
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=0.1, ceiling=0.8,
+                 clock=None, ring_size=1 << 16):
+        if clock is not None and clock.simulated:
+            raise ValueError("A simulation can't run in a worker process")
+        # Connection's inbound and outbound are its RateMeters
+        self.from_worker = Ring(ring_size)
+        self.to_worker = Ring(ring_size)
+        self.counts = multiprocessing.Array("q", len(COUNTERS), lock=False)
+        self._stop = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=serve, name="memebot-worker",
+            args=(port, baudrate, self.from_worker, self.to_worker,
+                  self.counts, self._stop))
+        self.process.daemon = True
+        self.process.start()
+        self.read_timeout = timeout
+        communication.Connection.__init__(
+            self, _RingPort(self.to_worker, baudrate), baudrate, timeout,
+            ceiling, clock)
+        self.stats["overflows"] = 0
+
+    def __repr__(self):
+        return "<WorkerConnection pid=%s>" % self.process.pid
+
+    def poll(self):
+        logger.info("Waiting for incoming messages from the worker...")
+        ring = self.from_worker
+        while not self._stop.is_set():
+            record = ring.wait(self.read_timeout)
+            self._update_counts()
+            if record is None:
+                # Nothing for a read timeout; check for lost requests
+                self.manager.expire()
+                continue
+            kind = record[:1]
+            if kind == FRAME:
+                received, = _time.unpack_from(record, 1)
+                frame = memoryview(record)[1 + _time.size:]
+                self.inbound.add(len(frame) + 4, self.clock.monotonic())
+                ext_id, value = protocol.decode(frame)
+                self.on_frame_parsed(frame, ext_id, value)
+                self.manager.dispatch_message(ext_id, value, received)
+            elif kind == EMPTY:
+                received, = _time.unpack_from(record, 1)
+                self.inbound.add(4, self.clock.monotonic())
+                self._empty_frame(received)
+            elif kind == LOST:
+                self.lost(record[1:].decode("utf-8"))
+            elif kind == RESTORED:
+                self.s.open()
+                self._reconnected()
+
+    def _update_counts(self):
+        for i, name in enumerate(COUNTERS):
+            self.stats[name] = self.counts[i]
+
+    def close(self, timeout=1.0):
+        """Stops the worker and frees the rings"""
+        self._stop.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        thread = getattr(self.manager, "thread", None)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        self.s.close()
+        for ring in (self.from_worker, self.to_worker):
+            ring.close(unlink=True)
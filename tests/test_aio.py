@@ -0,0 +1,55 @@
+"""Tests for `memebot.aio`."""
+
+import asyncio
+
+import pytest
+
+from memebot import communication
+from memebot import memebot
+
+
+def aio_bot():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    light_sensor 6 light
+    number_display 7 display
+    """)
+    port = bot.conn.s
+    port.values[(1, 10)] = 25.0
+    port.values[(4, 6)] = 300.0
+    del port.frames[:]
+    return bot, port
+
+
+def test_gathered_reads_go_in_one_write():
+    bot, port = aio_bot()
+    writes = bot.manager.stats["writes"]
+
+    async def main():
+        return await asyncio.gather(
+            bot.front.read(), bot.light.read(), bot.display.set(5))
+
+    assert asyncio.run(main()) == [25.0, 300.0, None]
+    assert bot.manager.stats["writes"] == writes + 1
+    assert len(port.frames) == 3
+    assert bot.front.last_value == 25.0
+
+
+def test_read_raises_timeout():
+    bot, port = aio_bot()
+    port.respond = lambda payload: None
+    bot.manager.min_timeout = bot.manager.initial_timeout = 0.05
+    bot.manager.srtt = None
+
+    async def main():
+        await bot.front.read()
+
+    with pytest.raises(communication.RequestTimeout):
+        asyncio.run(main())
+
+
+def test_set_outside_a_loop_sends_straight_away():
+    bot, port = aio_bot()
+    assert bot.display.set(5) is None
+    assert len(port.frames_for(9)) == 1
@@ -0,0 +1,572 @@
+"""Tests for `memebot.communication`."""
+
+import struct
+import threading
+import time
+
+import pytest
+import serial
+
+from memebot import clock as clocks
+from memebot import communication
+from memebot import emulator
+from memebot import memebot
+from memebot import protocol
+
+
+def silent_port():
+    port = emulator.EmulatedSerial(timeout=0.05)
+    port.respond = lambda payload: None
+    return port
+
+
+def make_opener(ports):
+    def opener(name, **kw):
+        if name not in ports:
+            raise serial.SerialException("No such port %s" % name)
+        return ports[name]()
+    return opener
+
+
+def test_discover_finds_board_without_waiting_on_others():
+    opener = make_opener({
+        "/dev/ttyS0": silent_port,
+        "/dev/ttyS1": silent_port,
+        "/dev/ttyUSB0": lambda: emulator.EmulatedSerial(timeout=0.05),
+    })
+    start = time.monotonic()
+    name, port = communication.discover(
+        ["/dev/ttyS0", "/dev/ttyS1", "/dev/ttyUSB0", "/dev/missing"],
+        timeout=1, opener=opener)
+    assert name == "/dev/ttyUSB0"
+    assert port.isOpen()
+    assert time.monotonic() - start < 0.5
+
+
+def test_discover_nothing_found():
+    opener = make_opener({"/dev/ttyS0": silent_port})
+    start = time.monotonic()
+    name, port = communication.discover(
+        ["/dev/ttyS0", "/dev/ttyS1"], timeout=0.2, opener=opener)
+    assert (name, port) == (None, None)
+    assert time.monotonic() - start < 0.5
+
+
+def test_probe_port_closes_silent_port():
+    port = silent_port()
+    assert communication.probe_port(
+        "/dev/ttyS0", timeout=0.1, opener=lambda name, **kw: port) is None
+    assert not port.isOpen()
+
+
+class EchoingPort(object):
+    """A console that sends back whatever it's sent, like a getty"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.open = True
+
+    def write(self, data):
+        self.buffer += data + b"\r\n"
+
+    def read(self, size):
+        time.sleep(0.01)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.open = False
+
+
+def test_probe_port_ignores_echo():
+    port = EchoingPort()
+    assert communication.probe_port(
+        "/dev/ttyS0", timeout=0.1, opener=lambda name, **kw: port) is None
+    assert not port.open
+
+
+def test_candidate_ports_leave_out_consoles(monkeypatch):
+    monkeypatch.setattr(communication.sys, "platform", "linux")
+    found = {"/dev/ttyUSB*": ["/dev/ttyUSB0"],
+             "/dev/ttyACM*": ["/dev/ttyACM0"],
+             "/dev/tty[A-Za-z]*": ["/dev/ttyS0", "/dev/ttyUSB0"]}
+    monkeypatch.setattr(communication.glob, "glob",
+                        lambda pattern: found.get(pattern, []))
+    assert communication.candidate_ports() == ["/dev/ttyUSB0", "/dev/ttyACM0"]
+
+
+def quiet_bot():
+    """A bot whose board doesn't answer until told to"""
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10
+    """)
+    port = bot.conn.s
+    port.values[(1, 10)] = 7.0
+    # Longer than the outages here, so requests wait them out
+    bot.manager.min_timeout = 1.0
+    answer = port.respond
+    port.respond = lambda payload: None
+    return bot, port, answer
+
+
+def test_reconnect_reissues_pending_requests():
+    bot, port, answer = quiet_bot()
+    message = communication.UltrasonicSensorRead(10)
+    bot.manager.send(message)
+    port.respond = answer
+    port.unplug(0.1)
+    assert message.wait(1)
+    assert message.value == 7.0
+    stats = bot.conn.stats
+    assert stats["disconnects"] == 1
+    assert stats["reconnects"] == 1
+    assert stats["reissued"] == 1
+    assert 0.1 <= stats["last_outage"] < 1
+
+
+def test_reconnect_fails_requests_out_of_retries():
+    bot, port, answer = quiet_bot()
+    bot.manager.max_retries = 0
+    message = communication.UltrasonicSensorRead(10)
+    bot.manager.send(message)
+    port.unplug(0.05)
+    assert message.wait(1)
+    with pytest.raises(communication.ConnectionLost):
+        message.value
+    assert bot.conn.stats["failed"] == 1
+    assert not bot.manager.handlers
+
+
+def test_reconnect_fails_pending_commands():
+    bot, port, answer = quiet_bot()
+    move = communication.EncoderMotorMove(1, 100, 360)
+    read = communication.UltrasonicSensorRead(10)
+    bot.manager.send_many([move, read])
+    port.respond = answer
+    del port.frames[:]
+    port.unplug(0.05)
+    assert read.wait(1) and move.wait(1)
+    assert read.value == 7.0
+    with pytest.raises(communication.ConnectionLost):
+        move.value
+    # Only the read went again
+    assert [f[2] for f in port.frames] == [1]
+    assert bot.conn.stats["reissued"] == 1
+    assert bot.conn.stats["failed"] == 1
+
+
+def test_requests_fail_during_long_outage():
+    bot, port, answer = quiet_bot()
+    message = communication.UltrasonicSensorRead(10)
+    bot.manager.send(message)
+    port.unplug(5)
+    start = time.monotonic()
+    # Once it's waited as long as it would have for an answer
+    assert message.wait(1 + bot.manager.request_timeout())
+    assert time.monotonic() - start < 2
+    with pytest.raises(communication.ConnectionLost):
+        message.value
+    assert bot.conn.stats["failed"] == 1
+    assert bot.manager.stats["timeouts"] == 0
+    assert not bot.manager.handlers
+    port._unplugged_until = 0
+
+
+def test_failed_resend_keeps_polling():
+    bot, port, answer = quiet_bot()
+    message = communication.UltrasonicSensorRead(10)
+    bot.manager.send(message)
+    port.respond = answer
+    write = port.write
+
+    def saturated(data):
+        port.write = write
+        raise communication.LinkSaturated("Busy")
+    port.write = saturated
+    port.unplug(0.05)
+    assert message.wait(1)
+    with pytest.raises(communication.LinkSaturated):
+        message.value
+    assert bot.conn.stats["failed"] == 1
+    # The poll thread is still there to read the next answer
+    again = communication.UltrasonicSensorRead(10)
+    bot.manager.send(again)
+    assert again.wait(1)
+    assert again.value == 7.0
+
+
+def test_send_while_disconnected():
+    bot, port, answer = quiet_bot()
+    port.unplug(0.2)
+    message = communication.UltrasonicSensorRead(10)
+    deadline = time.monotonic() + 1
+    while bot.conn.connected and time.monotonic() < deadline:
+        time.sleep(0.001)
+    with pytest.raises(communication.ConnectionLost):
+        bot.manager.send(message)
+    assert not bot.manager.handlers
+
+
+def test_rate_meter():
+    meter = communication.RateMeter(window=1.0, bins=10)
+    for i in range(10):
+        meter.add(100, now=10.05 + i * 0.1)
+    assert meter.rate(now=10.95) == 1000
+    # Old bins fall out of the window
+    assert meter.rate(now=11.55) == 400
+    assert meter.rate(now=20) == 0
+    assert meter.total == 1000
+
+
+def test_admission_control():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10
+    """)
+    conn = bot.conn
+    # Fill 90% of a second's worth of link
+    conn.outbound.add(int(conn.capacity * 0.9))
+    assert conn.utilization() >= 0.9
+    low = communication.UltrasonicSensorRead(10)
+    low.priority = communication.PRIORITY_LOW
+    with pytest.raises(communication.LinkSaturated):
+        bot.manager.send(low)
+    assert conn.stats["rejected"] == 1
+    assert not bot.manager.handlers
+    assert bot.manager.has_budget(7)
+    bot.manager.send(communication.UltrasonicSensorRead(10))
+    conn.outbound.add(int(conn.capacity * 0.2))
+    with pytest.raises(communication.LinkSaturated):
+        bot.manager.send(communication.UltrasonicSensorRead(10))
+    bot.manager.send(communication.MotorMove(0, 0),
+                     communication.PRIORITY_CONTROL)
+    usage = conn.usage()
+    assert usage["capacity"] == 11520
+    assert usage["utilization"] > 1
+
+
+def test_concurrent_senders():
+    values = dict(((1, port), port) for port in range(1, 9))
+    port = emulator.EmulatedSerial(values=values)
+    conn = communication.Connection(port)
+    conn.manager.launch()
+    results = {}
+
+    def producer(number):
+        messages = [communication.UltrasonicSensorRead(number)
+                    for i in range(200)]
+        for message in messages:
+            conn.manager.send(message, communication.PRIORITY_CONTROL)
+        results[number] = [m.value if m.wait(2) else None for m in messages]
+
+    threads = [threading.Thread(target=producer, args=(number,))
+               for number in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every frame arrived whole, and every reply went to its own request
+    assert len(port.frames) == 8 * 200
+    for number, values in results.items():
+        assert values == [number] * 200
+    assert conn.manager.in_flight() == 0
+    assert conn.manager.stats["writes"] <= 8 * 200
+
+
+def test_waiting_senders_share_a_write():
+    port = emulator.EmulatedSerial()
+    conn = communication.Connection(port)
+    manager = conn.manager
+    manager._write_lock.acquire()
+    threads = [threading.Thread(target=manager.send,
+                                args=(communication.MotorMove(i, i),))
+               for i in range(2)]
+    for thread in threads:
+        thread.start()
+    while len(manager._outbox) < 2:
+        time.sleep(0.001)
+    manager._write_lock.release()
+    for thread in threads:
+        thread.join()
+    assert manager.stats["writes"] == 1
+    assert manager.stats["sent"] == 2
+    assert len(port.frames) == 2
+
+
+def test_window_keeps_within_board_buffer():
+    port = emulator.EmulatedSerial(
+        values={(1, 10): 42.0}, latency=0.005, rx_buffer=3)
+    conn = communication.Connection(port)
+    manager = conn.manager
+    manager.launch()
+    messages = [communication.UltrasonicSensorRead(10) for i in range(150)]
+    for message in messages:
+        manager.send(message)
+    for message in messages:
+        assert message.wait(2)
+    answered = [m for m in messages if m.error is None]
+    timed_out = [m for m in messages if m.error is not None]
+    assert all(m.value == 42.0 for m in answered)
+    assert all(isinstance(m.error, communication.RequestTimeout)
+               for m in timed_out)
+    assert manager.stats["timeouts"] == port.dropped == len(timed_out)
+    # It went over the board's buffer, backed off, and mostly stayed under
+    assert manager.stats["window_decreases"] >= 1
+    assert len(answered) > 100
+    assert manager.window_history
+    assert manager.in_flight() == 0
+
+
+def test_window_holds_back_low_priority():
+    conn = communication.Connection(silent_port())
+    manager = conn.manager
+    for i in range(manager.initial_window):
+        manager.send(communication.UltrasonicSensorRead(i))
+    with pytest.raises(communication.LinkSaturated):
+        manager.send(communication.UltrasonicSensorRead(9),
+                     communication.PRIORITY_LOW)
+    # Control traffic still goes
+    manager.send(communication.UltrasonicSensorRead(9),
+                 communication.PRIORITY_CONTROL)
+    assert manager.in_flight() == manager.initial_window + 1
+
+
+def test_hooks():
+    port = emulator.EmulatedSerial(values={(1, 10): 42.0})
+    conn = communication.Connection(port)
+    manager = conn.manager
+    events = []
+
+    def record(name):
+        def hook(now, *args):
+            assert isinstance(now, float)
+            events.append((name,) + tuple(
+                bytes(a) if isinstance(a, memoryview) else a for a in args))
+        return hook
+
+    conn.add_hook("on_frame_out", record("out"))
+    conn.add_hook("on_bytes_in", record("in"))
+    conn.add_hook("on_frame_parsed", record("parsed"))
+    manager.add_hook("on_dispatch", record("dispatch"))
+    manager.launch()
+    message = communication.UltrasonicSensorRead(10)
+    manager.send(message)
+    assert message.wait(1)
+    time.sleep(0.01)
+    names = [event[0] for event in events]
+    assert names[0] == "out"
+    assert events[0][1] == message.encode()
+    assert names.count("in") == 10
+    assert ("parsed", bytes([0xa1, 2]) + struct.pack("<f", 42.0),
+            0xa1, 42.0) in events
+    assert events[-1] == ("dispatch", 0xa1, 42.0, message)
+
+
+def test_failed_write_finishes_every_batch():
+    conn = communication.Connection(emulator.EmulatedSerial())
+    manager = conn.manager
+
+    def broken(now, data):
+        raise RuntimeError("broken hook")
+    conn.add_hook("on_frame_out", broken)
+    # Another sender's batch, queued behind this one
+    other = communication._Batch(b"", [])
+    manager._outbox.append(other)
+    message = communication.UltrasonicSensorRead(10)
+    with pytest.raises(RuntimeError):
+        manager.send(message)
+    assert other.done
+    assert isinstance(other.error, RuntimeError)
+    assert not manager.handlers
+    assert not manager._outbox
+
+
+def test_hooks_cost_nothing_unused():
+    conn = communication.Connection(emulator.EmulatedSerial())
+    assert conn.on_frame_parsed is communication._no_hook
+    assert conn._receive == conn.on_byte
+    hook = lambda *args: None
+    conn.add_hook("on_bytes_in", hook)
+    assert conn._receive == conn._receive_hooked
+    conn.remove_hook("on_bytes_in", hook)
+    assert conn._receive == conn.on_byte
+    assert conn.on_bytes_in is communication._no_hook
+    with pytest.raises(ValueError):
+        conn.add_hook("on_nothing", hook)
+
+
+def test_timeout_hook():
+    conn = communication.Connection(silent_port())
+    manager = conn.manager
+    manager.initial_timeout = 0.01
+    timeouts = []
+    manager.add_hook("on_timeout",
+                     lambda now, handler: timeouts.append(handler))
+    message = communication.UltrasonicSensorRead(10)
+    manager.send(message)
+    time.sleep(0.02)
+    manager.expire()
+    assert timeouts == [message]
+
+
+def test_errbacks_can_send_again():
+    conn = communication.Connection(silent_port())
+    manager = conn.manager
+    manager.initial_timeout = 0.01
+    message = communication.UltrasonicSensorRead(10)
+    again = communication.UltrasonicSensorRead(10)
+    message.errback = lambda error: manager.send(again)
+    manager.send(message)
+    time.sleep(0.02)
+    done = threading.Thread(target=manager.expire)
+    done.daemon = True
+    done.start()
+    done.join(1)
+    assert not done.is_alive()
+    assert isinstance(message.error, communication.RequestTimeout)
+    assert again.time_sent is not None
+
+
+class SteppedClock(clocks.Clock):
+    """Real time, but with the wall clock set back an hour on demand"""
+
+    offset = 0
+
+    def time(self):
+        return time.time() + self.offset
+
+
+def test_round_trips_ignore_wall_clock_steps():
+    clock = SteppedClock()
+    conn = communication.Connection(silent_port(), clock=clock)
+    manager = conn.manager
+    manager.initial_timeout = 0.5
+    message = communication.UltrasonicSensorRead(10)
+    manager.send(message)
+    clock.offset = -3600
+    # Neither timed out by the step nor measured as an hour early
+    assert manager.expire() > 0.1
+    assert message.ext_id in manager.handlers
+    manager.dispatch_message(message.ext_id, 1.0)
+    assert 0 <= message.rtt < 0.5
+    assert 0 <= manager.srtt < 0.5
+
+
+def test_macro_sends_in_one_write():
+    port = emulator.EmulatedSerial()
+    conn = communication.Connection(port)
+    messages = [communication.MotorMove(0, 0),
+                communication.SevenSegmentDisplay(7, 0),
+                communication.EncoderMotorRun(1, 0)]
+    macro = communication.Macro(messages, left=(0, "left"),
+                                right=(0, "right"), shown=(1, "number"))
+    conn.manager.send(macro.set(left=100, right=-100, shown=1.5))
+    assert conn.manager.stats["writes"] == 1
+    # The left motor's speed is turned around in MotorMove, not in the frame
+    expected = [communication.MotorMove(-100, -100),
+                communication.SevenSegmentDisplay(7, 1.5),
+                communication.EncoderMotorRun(1, 0)]
+    assert bytes(port.written) == b"".join(m.encode() for m in expected)
+
+
+def test_macro_rejects_requests_and_unknown_slots():
+    with pytest.raises(ValueError):
+        communication.Macro([communication.UltrasonicSensorRead(10)])
+    with pytest.raises(ValueError):
+        communication.Macro([communication.MotorMove(0, 0)],
+                            speed=(0, "speed"))
+
+
+def test_heartbeat():
+    heartbeat = communication.Heartbeat()
+    assert heartbeat.lateness(0) is None
+    for i in range(20):
+        heartbeat.beat(i * 0.5)
+    assert heartbeat.interval == pytest.approx(0.5)
+    assert heartbeat.jitter < 0.01
+    assert heartbeat.lateness(9.6) == 0
+    assert heartbeat.lateness(11.0) == pytest.approx(1.0)
+
+
+def test_command_acks_are_not_keepalives():
+    port = emulator.EmulatedSerial()
+    conn = communication.Connection(port)
+    conn.manager.launch()
+    for i in range(50):
+        conn.manager.send(communication.SevenSegmentDisplay(7, i))
+    deadline = time.monotonic() + 1
+    while conn._acks_seen < 50 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert conn._acks_seen == 50
+    assert conn.heartbeat.beats == 0
+    time.sleep(0.6)
+    assert not conn.check_link()
+    assert conn.stats["stalls"] == 0
+    assert conn.link_latency() is None
+
+
+def test_acks_counted_before_the_write():
+    port = emulator.EmulatedSerial()
+    conn = communication.Connection(port)
+    write = port.write
+
+    def answered_at_once(data):
+        # As if the poll thread read the acknowledgement before write()
+        # returned
+        write(data)
+        conn.on_byte(b"\xff\x55\r\n")
+    port.write = answered_at_once
+    conn.manager.send(communication.SevenSegmentDisplay(7, 1))
+    assert conn._acks_seen == conn._acks_due == 1
+    assert conn.heartbeat.beats == 0
+
+    def saturated(data):
+        raise communication.LinkSaturated("Busy")
+    port.write = saturated
+    with pytest.raises(communication.LinkSaturated):
+        conn.manager.send(communication.SevenSegmentDisplay(7, 2))
+    assert conn._acks_due == 1
+    # So the next empty frame is a keepalive
+    conn.on_byte(b"\xff\x55\r\n")
+    assert conn.heartbeat.beats == 1
+
+
+def test_keepalives_among_command_acks():
+    port = emulator.EmulatedSerial(keepalive=0.05)
+    conn = communication.Connection(port)
+    conn.manager.launch()
+    deadline = time.monotonic() + 2
+    while conn.heartbeat.beats < 8 and time.monotonic() < deadline:
+        conn.manager.send_many(
+            [communication.SevenSegmentDisplay(7, i) for i in range(10)])
+        time.sleep(0.01)
+    assert conn.heartbeat.interval == pytest.approx(0.05, abs=0.02)
+    assert conn.stats["stalls"] == 0
+
+
+def test_acknowledged():
+    data = communication.SevenSegmentDisplay(7, 1).encode() + \
+        communication.UltrasonicSensorRead(10).encode() + \
+        communication.MotorMove(0, 0).encode()
+    assert protocol.acknowledged(data) == 2
+
+
+def test_keepalives_detect_stalled_link():
+    port = emulator.EmulatedSerial(keepalive=0.02)
+    conn = communication.Connection(port)
+    conn.manager.launch()
+    deadline = time.monotonic() + 2
+    while conn.heartbeat.beats < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert conn.heartbeat.interval == pytest.approx(0.02, abs=0.01)
+    assert not conn.stalled()
+    port.hang(0.3)
+    while not conn.stats["stalls"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert conn.stats["stalls"] == 1
+    assert conn.stats["reconnects"] == 1
+    # Overdue keepalives count towards the latency before any request does
+    conn.heartbeat.last = time.monotonic() - 1
+    assert conn.link_latency() > 0.9
@@ -0,0 +1,55 @@
+"""Tests for `memebot.control`."""
+
+import time
+
+from memebot import memebot
+
+
+def make_bot():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10
+    light_sensor 6
+    """)
+    bot.conn.s.values[(1, 10)] = 42.0
+    return bot
+
+
+def test_loop_sends_commands_and_reads_sensors():
+    bot = make_bot()
+    port = bot.conn.s
+    snapshots = []
+
+    def step(snapshot):
+        snapshots.append(snapshot)
+        return [memebot.communication.MotorMove(10, 10)]
+
+    loop = bot.control_loop(step, 100)
+    loop.run(ticks=5)
+    assert loop.ticks == 5
+    # Nothing has been asked for before the first tick
+    assert snapshots[0].stale == {"ultrasound", "light_sensor"}
+    assert snapshots[-1]["ultrasound"] == 42.0
+    assert not snapshots[-1].stale
+    assert len(port.frames_for(5)) == 5
+    assert len(port.frames_for(1)) == 5
+    stats = loop.stats()
+    assert stats["ticks"] == 5
+    assert stats["jitter_max"] < 0.01
+
+
+def test_loop_enters_safe_state():
+    bot = make_bot()
+    port = bot.conn.s
+
+    def step(snapshot):
+        time.sleep(0.025)
+        return [memebot.communication.MotorMove(100, 100)]
+
+    loop = bot.control_loop(step, 100, max_misses=3)
+    loop.run(ticks=20)
+    assert loop.in_safe_state
+    assert loop.ticks == 3
+    assert loop.misses == 3
+    # The last motor command stops them
+    assert port.frames_for(5)[-1][3:] == bytes(4)
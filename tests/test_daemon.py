@@ -0,0 +1,77 @@
+"""Tests for `memebot.daemon`."""
+
+import time
+
+import pytest
+
+from memebot import communication
+from memebot import daemon
+from memebot import memebot
+
+
+@pytest.fixture
+def server(tmpdir):
+    bot = memebot.configure("connection emulator")
+    bot.conn.s.values[(1, 10)] = 25.0
+    bot.conn.s.values[(4, 6)] = 300.0
+    server = daemon.Server(bot.conn, str(tmpdir.join("memebot.sock")))
+    server.start()
+    yield server
+    server.close()
+
+
+def client(server):
+    return memebot.configure("", connection="unix:" + server.path)
+
+
+def test_split_requests():
+    first = communication.UltrasonicSensorRead(10).encode()
+    second = communication.MotorMove(100, -100).encode()
+    buffer = bytearray(b"junk" + first + second + second[:3])
+    assert daemon.split_requests(buffer) == [first, second]
+    assert buffer == second[:3]
+
+
+def test_clients_share_reads(server):
+    clients = [client(server), client(server)]
+    port = server.conn.s
+    del port.frames[:]
+    reads = [communication.UltrasonicSensorRead(10) for bot in clients]
+    light = communication.LightSensorRead(6)
+    # Slow enough that the first read is still waiting on the board when
+    # the second comes in
+    port.latency = 0.02
+    clients[0].send(reads[0])
+    clients[1].send(reads[1], light)
+    for message in reads + [light]:
+        assert message.wait(2)
+    assert [message.value for message in reads] == [25.0, 25.0]
+    assert light.value == 300.0
+    assert len(port.frames_for(1)) == 1
+    assert server.stats["deduplicated"] == 1
+    assert server.manager.stats["unmatched"] == 0
+
+
+def test_commands_are_forwarded(server):
+    bot = client(server)
+    port = server.conn.s
+    bot.send(communication.MotorMove(100, -100))
+    version = communication.VersionRead()
+    bot.send(version)
+    assert version.wait(2)
+    assert len(port.frames_for(5)) == 1
+
+
+def test_clients_get_keepalives_and_acks(server):
+    server.conn.s.keepalive = 0.05
+    bot = client(server)
+    conn = bot.conn
+    deadline = time.monotonic() + 2
+    while conn.heartbeat.beats < 8 and time.monotonic() < deadline:
+        bot.send(communication.SevenSegmentDisplay(7, 1))
+        time.sleep(0.01)
+    assert conn.heartbeat.interval == pytest.approx(0.05, abs=0.02)
+    while conn._acks_seen < conn._acks_due and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert conn._acks_seen == conn._acks_due > 0
+    assert not conn.stalled()
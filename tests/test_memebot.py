@@ -3,12 +3,17 @@
 
 """Tests for `memebot` package."""
 
+import time
+
+import numpy
 import pytest
 
 from click.testing import CliRunner
 
 from memebot import memebot
 from memebot import cli
+from memebot import communication
+from memebot import emulator
 
 
 @pytest.fixture
@@ -30,9 +35,158 @@ def test_content(response):
 def test_command_line_interface():
     """Test the CLI."""
     runner = CliRunner()
-    result = runner.invoke(cli.main)
-    assert result.exit_code == 0
-    assert 'memebot.cli.main' in result.output
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+    assert 'bench' in help_result.output
+    assert 'monitor' in help_result.output
+
+
+def test_cli_bench():
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['bench', '--count', '20'])
+    assert result.exit_code == 0
+    assert 'encode' in result.output
+    assert 'round trip (window 4)' in result.output
+    assert 'contention (8 threads)' in result.output
+
+
+def test_cli_monitor(tmpdir):
+    config = tmpdir.join("bot.conf")
+    config.write("ultrasound 10 front\n")
+    runner = CliRunner()
+    result = runner.invoke(cli.main, [
+        'monitor', 'emulator', '--config', str(config),
+        '--interval', '0.2', '--iterations', '1'])
+    assert result.exit_code == 0
+    assert 'utilization' in result.output
+    assert 'front' in result.output
+
+
+def strip_bot():
+    bot = memebot.configure("""
+    connection emulator
+    led_strip 6+2 strip
+    """)
+    port = bot.conn.s
+    # Leave out the startup probe
+    del port.frames[:]
+    return bot, port
+
+
+def test_led_strip_sends_changed_pixels():
+    bot, port = strip_bot()
+    colors = numpy.zeros((8, 3), dtype=numpy.uint8)
+    colors[3] = [255, 0, 0]
+    bot.strip.show(colors)
+    # Every pixel the first time, then the show
+    assert len(port.frames_for(18)) == 8
+    assert len(port.frames_for(19)) == 1
+    del port.frames[:]
+    colors[5] = [0, 0, 255]
+    bot.strip.show(colors)
+    assert [f[5] for f in port.frames_for(18)] == [6]
+    assert len(port.frames_for(19)) == 1
+    del port.frames[:]
+    bot.strip.show(colors)
+    assert port.frames == []
+
+
+def test_led_strip_single_color():
+    bot, port = strip_bot()
+    bot.strip.show([[0, 10, 20]] * 30)
+    assert port.frames == [
+        bytes([0x00, 0x02, 18, 6, 2, 0, 0, 10, 20]),
+        bytes([0x00, 0x02, 19, 6, 2]),
+    ]
+
+
+def test_led_strip_goes_through_manager():
+    bot, port = strip_bot()
+    sent = []
+    bot.manager.add_hook("on_send",
+                         lambda now, started, handlers: sent.append(handlers))
+    writes = bot.manager.stats["writes"]
+    bot.strip.show([[1, 2, 3], [4, 5, 6]])
+    assert bot.manager.stats["writes"] == writes + 1
+    assert len(sent) == 1
+    assert isinstance(sent[0][0], communication.Frames)
+    assert len(port.frames_for(18)) == 2
+
+
+def test_led_strip_rejects_unaddressable_pixels():
+    bot, port = strip_bot()
+    bot.strip.show(numpy.zeros((255, 3)))
+    del port.frames[:]
+    with pytest.raises(ValueError):
+        bot.strip.show(numpy.ones((300, 3)))
+    for empty in ([], numpy.zeros((0, 3))):
+        with pytest.raises(ValueError):
+            bot.strip.show(empty)
+    assert port.frames == []
+    assert len(bot.strip.pixels) == 255
+
+
+def test_led_strip_matches_message_encoding():
+    bot, port = strip_bot()
+    bot.strip.show([[1, 2, 3], [4, 5, 6]])
+    expected = emulator.EmulatedSerial()
+    communication.RgbLedDisplay(6, 2, 2, 4, 5, 6).send(expected)
+    assert port.frames[1] == expected.frames[0]
+
+
+def test_startup_probe():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10
+    """)
+    assert bot.rtt is not None
+    # A version request
+    assert bot.conn.s.frames[0] == bytes([0, 1, 0, 0])
+
+
+def test_startup_probe_fails():
+    port = emulator.EmulatedSerial()
+    port.respond = lambda payload: None
+    bot = memebot.Bot()
+    with pytest.raises(IOError):
+        bot.start(port, probe_timeout=0.1)
+
+
+def sensor_bot():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    ultrasound 11 back
+    light_sensor 6 light
+    """)
+    port = bot.conn.s
+    port.values.update({(1, 10): 25.0, (1, 11): 80.0, (4, 6): 300.0})
+    del port.frames[:]
+    return bot, port
+
+
+def test_read_all():
+    bot, port = sensor_bot()
+    port.latency = 0.05
+    started = time.monotonic()
+    snapshot = bot.read_all(timeout=1)
+    # One round trip for all three, not three round trips
+    assert time.monotonic() - started < 0.1
+    assert snapshot == {"front": 25.0, "back": 80.0, "light": 300.0}
+    assert snapshot.stale == set()
+    assert snapshot.time <= min(snapshot.times.values())
+    assert bot.manager.stats["writes"] == 2
+    assert len(port.frames) == 3
+
+
+def test_read_all_timeout():
+    bot, port = sensor_bot()
+    bot.read_all()
+    port.respond = lambda payload: None
+    port.values[(1, 10)] = 26.0
+    snapshot = bot.read_all(timeout=0.05)
+    assert snapshot.stale == {"front", "back", "light"}
+    # The last known values, from the earlier read
+    assert snapshot["front"] == 25.0
+    assert snapshot.times["front"] == bot.front.last_value_time
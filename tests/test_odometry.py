@@ -0,0 +1,85 @@
+"""Tests for `memebot.odometry`."""
+
+import math
+import time
+
+import pytest
+
+from memebot import memebot
+
+
+def make_odometry(**kw):
+    bot = memebot.configure("""
+    connection emulator
+    """)
+    positions = {1: 0.0, 2: 0.0}
+    values = bot.conn.s.values
+    for slot in positions:
+        values[(61, 0, slot, 1)] = lambda slot=slot: positions[slot]
+    return bot.odometry(**kw), positions
+
+
+def wait_for(odometry, count):
+    deadline = time.time() + 2
+    while odometry.count < count and time.time() < deadline:
+        time.sleep(0.001)
+    assert odometry.count >= count
+
+
+def test_straight_line():
+    odometry, positions = make_odometry(wheel_diameter=360 / math.pi)
+    for i in range(10):
+        positions[1] = positions[2] = i * 0.1
+        odometry.poll()
+        wait_for(odometry, i + 1)
+    x, y, theta = odometry.pose
+    assert x == pytest.approx(0.9)
+    assert y == pytest.approx(0)
+    assert theta == pytest.approx(0)
+    assert odometry.velocity[0] > 0
+
+
+def test_turn_in_place():
+    odometry, positions = make_odometry(wheel_diameter=360 / math.pi,
+                                        wheel_base=2)
+    odometry.poll()
+    wait_for(odometry, 1)
+    odometry.pose
+    positions[1], positions[2] = -math.pi / 2, math.pi / 2
+    odometry.poll()
+    wait_for(odometry, 2)
+    x, y, theta = odometry.pose
+    assert theta == pytest.approx(math.pi / 2)
+    assert x == pytest.approx(0)
+
+
+def test_pipelined_pairs():
+    odometry, positions = make_odometry(depth=2)
+    # The board never answers, so only two pairs go out
+    port = odometry.bot.conn.s
+    port.respond = lambda payload: None
+    assert odometry.poll()
+    assert odometry.poll()
+    assert not odometry.poll()
+    assert len(port.frames_for(61)) == 4
+
+
+def test_polling_integrates_before_the_ring_fills():
+    odometry, positions = make_odometry(wheel_diameter=360 / math.pi,
+                                        capacity=8)
+    # Far more samples than the ring holds, without asking for the pose
+    for i in range(30):
+        positions[1] = positions[2] = i * 0.1
+        odometry.poll()
+        wait_for(odometry, i + 1)
+    x, y, theta = odometry.pose
+    assert x == pytest.approx(2.9)
+    assert odometry.skipped == 0
+
+
+def test_overwritten_samples_are_counted():
+    odometry, positions = make_odometry(capacity=4)
+    odometry.samples[:, 1:] = 1.0
+    odometry.count = 10
+    odometry.pose
+    assert odometry.skipped == 6
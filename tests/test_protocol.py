@@ -0,0 +1,111 @@
+"""Tests for `memebot.protocol`."""
+
+import struct
+
+import pytest
+
+from memebot import communication
+from memebot import emulator
+from memebot import megapi
+from memebot import protocol
+from memebot.protocol import COMMANDS
+
+
+def test_encode_matches_known_frames():
+    assert COMMANDS["ultrasonic_sensor_read"].encode(0xa1, 10) == \
+        bytes.fromhex("ff5504a101010a")
+    assert COMMANDS["motor_move"].encode(0, -10, -10) == \
+        bytes.fromhex("ff5507000205f6fff6ff")
+    assert COMMANDS["encoder_motor_speed"].encode(0x4d, 1) == \
+        bytes.fromhex("ff55064d013d000102")
+    assert COMMANDS["led_matrix_message"].encode(0, 6, 0, 7, b"hi") == \
+        bytes.fromhex("ff550a00022906010007026869")
+
+
+def test_encode_checks_fields():
+    with pytest.raises(TypeError):
+        COMMANDS["motor_run"].encode(0, 1)
+
+
+def test_message_and_megapi_agree():
+    written = []
+
+    class Device(object):
+        def writePackage(self, data):
+            written.append(bytes(data))
+
+    bot = megapi.MegaPi()
+    bot.device = Device()
+    bot.motorMove(100, -50)
+    bot.sevenSegmentDisplay(7, 42)
+    bot.encoderMotorPosition(2, None)
+    assert written == [
+        communication.MotorMove(100, -50).encode(),
+        communication.SevenSegmentDisplay(7, 42).encode(),
+        communication.EncoderMotorPosition(2).encode(),
+    ]
+
+
+@pytest.mark.parametrize("type, payload, expected", [
+    (protocol.BYTE, b"\x07", 7),
+    (protocol.FLOAT, struct.pack("<f", 12.5), 12.5),
+    (protocol.SHORT, struct.pack("<h", -300), -300),
+    (protocol.STRING, b"\x0509.01", b"09.01"),
+    (protocol.LONG, struct.pack("<l", 100000), 100000),
+])
+def test_decode(type, payload, expected):
+    frame = memoryview(bytes([0x3d, type]) + payload)
+    assert protocol.decode(frame) == (0x3d, expected)
+
+
+@pytest.mark.parametrize("frame", [
+    b"\x01", b"\x01\x09\x00", b"\x01\x02\x00\x00", b"\x01\x04\x08ab",
+])
+def test_decode_rejects_bad_frames(frame):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode(frame)
+
+
+def response(ext_id, type, payload):
+    return b"\xff\x55" + bytes([ext_id, type]) + payload + b"\r\n"
+
+
+def test_frame_decoder_takes_frames_in_pieces():
+    decoder = protocol.FrameDecoder()
+    data = (b"Version 1\r\n" + response(0xa1, protocol.FLOAT,
+                                        struct.pack("<f", 2.5))
+            + b"\xff\x55\r\n" + response(0x10, protocol.STRING, b"\x02hi"))
+    frames = []
+    for i in range(len(data)):
+        frames.extend((ext_id, value) for frame, ext_id, value
+                      in decoder.feed(data[i:i + 1]))
+    assert frames == [(0xa1, 2.5), (None, None), (0x10, b"hi")]
+    assert decoder.stats["skipped_bytes"] == len(b"Version 1\r\n")
+    assert not decoder.buffer
+
+
+def test_frame_decoder_resyncs_after_corruption():
+    decoder = protocol.FrameDecoder()
+    good = response(0xa1, protocol.FLOAT, struct.pack("<f", 2.5))
+    corrupt = good[:-1] + b"\x00"
+    # Cut off by the next frame
+    truncated = good[:6]
+    unexpected = response(0xa1, 0x09, b"\x00")
+    frames = decoder.feed(
+        corrupt + good + truncated + good + unexpected + good)
+    assert [(ext_id, value) for frame, ext_id, value in frames] == \
+        [(0xa1, 2.5)] * 3
+    assert decoder.stats["corrupt"] == 1
+    assert decoder.stats["truncated"] == 1
+    assert decoder.stats["unexpected"] == 1
+
+
+def test_connection_counts_bad_frames():
+    conn = communication.Connection(emulator.EmulatedSerial())
+    message = communication.UltrasonicSensorRead(10)
+    conn.manager.send(message)
+    good = response(message.ext_id, protocol.FLOAT, struct.pack("<f", 25.0))
+    conn.on_byte(good[:-2] + b"\x0d\x0d" + good)
+    assert message.value == 25.0
+    assert conn.stats["corrupt"] == 1
+    assert conn.manager.stats["unmatched"] == 0
@@ -0,0 +1,50 @@
+"""Tests for `memebot.recorder`."""
+
+import numpy
+
+from memebot import memebot
+from memebot import recorder
+
+
+def test_record_and_load(tmpdir):
+    rec = recorder.Recorder(str(tmpdir), batch=4)
+    for i in range(5):
+        rec.add("front", 100.0 + i, 2.5 * i)
+    rec.add("light", 200.0, 7.0)
+    rec.add("version", 200.0, b"09.01")
+    # The first batch is on disk, the rest waits for close()
+    assert len(recorder.load(str(tmpdir))["front"][0]) == 4
+    rec.close()
+    log = recorder.load(str(tmpdir))
+    assert sorted(log) == ["front", "light"]
+    times, values = log["front"]
+    assert isinstance(times, numpy.memmap)
+    assert list(times) == [100.0, 101.0, 102.0, 103.0, 104.0]
+    assert list(values) == [0.0, 2.5, 5.0, 7.5, 10.0]
+    assert list(log["light"][1]) == [7.0]
+
+
+def test_load_leaves_out_unfinished_records(tmpdir):
+    rec = recorder.Recorder(str(tmpdir))
+    rec.add("front", 1.0, 2.0)
+    rec.close()
+    with open(str(tmpdir.join("front.time")), "ab") as f:
+        f.write(numpy.array([2.0]).tobytes())
+    times, values = recorder.load(str(tmpdir))["front"]
+    assert len(times) == len(values) == 1
+
+
+def test_bot_records_sensors(tmpdir):
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    light_sensor 6 light
+    """)
+    bot.conn.s.values[(1, 10)] = 25.0
+    rec = bot.record(str(tmpdir))
+    bot.read_all()
+    bot.read_all()
+    rec.close()
+    log = recorder.load(str(tmpdir))
+    assert list(log["front"][1]) == [25.0, 25.0]
+    assert len(log["light"][0]) == 2
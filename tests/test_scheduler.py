@@ -0,0 +1,110 @@
+"""Tests for `memebot.scheduler`."""
+
+import time
+
+import pytest
+
+from memebot import memebot
+
+
+def make_bot():
+    return memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    ultrasound 11 back
+    ultrasound 12 side
+    light_sensor 6 light
+    conflict front back side
+    """)
+
+
+def settle(bot):
+    # The steps below run faster than real time; let the responses in so
+    # the in-flight window doesn't hold polling back
+    while bot.manager.in_flight():
+        time.sleep(0.0005)
+
+
+def test_conflict_groups_get_exclusive_slots():
+    bot = make_bot()
+    assert bot.conflict_groups == [["front", "back", "side"]]
+    scheduler = bot.scheduler(rate=10, slot=0.03)
+    sent = {}
+    for step in range(100):
+        now = step * 0.01
+        for name in scheduler.poll(now):
+            sent.setdefault(name, []).append(now)
+        settle(bot)
+    times = sorted(sent["front"] + sent["back"] + sent["side"])
+    # Never two sonars inside one slot
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 0.03 - 1e-9
+    # Each sonar still gets its 10Hz
+    for name in ["front", "back", "side"]:
+        assert len(sent[name]) == 10
+    assert len(sent["light"]) == 10
+    assert len(bot.conn.s.frames_for(1)) == 30
+
+
+def test_unrelated_sensors_share_writes():
+    bot = make_bot()
+    scheduler = bot.scheduler()
+    # Ties in a group go by name
+    assert sorted(scheduler.poll(0.0)) == ["back", "light"]
+    assert scheduler.poll(0.01) == []
+    assert scheduler.next_event(0.01) == pytest.approx(0.03)
+    assert scheduler.poll(0.03) == ["front"]
+
+
+def test_unknown_conflict():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    conflict front back
+    """)
+    with pytest.raises(ValueError):
+        bot.scheduler()
+
+
+def test_adaptive_rates():
+    bot = make_bot()
+    scheduler = bot.scheduler(adaptive=True, rate=10, min_rate=1, max_rate=40)
+    for i in range(10):
+        scheduler.observe("light", 500)
+        scheduler.observe("front", i * 10.0)
+    # The steady light sensor backs off, the moving sonar speeds up
+    assert scheduler.rate("light") == pytest.approx(1)
+    assert scheduler.rate("front") == pytest.approx(40)
+    scheduler.set_limits("light", min_rate=2, threshold=100)
+    scheduler.observe("light", 550)
+    assert scheduler.rate("light") == pytest.approx(2)
+
+
+def test_adaptive_callback():
+    bot = make_bot()
+    scheduler = bot.scheduler(adaptive=True)
+    for i in range(2):
+        scheduler._request("light").value = 300.0
+    assert bot.light.last_value == 300.0
+    assert scheduler.rate("light") == pytest.approx(5)
+
+
+def test_budget():
+    bot = make_bot()
+    scheduler = bot.scheduler(rate=50, budget=40)
+    sent = 0
+    for step in range(1000):
+        sent += len(scheduler.poll(step * 0.001))
+        settle(bot)
+    # Four sensors would like 200/s, but get 40/s plus the initial burst
+    assert 40 <= sent <= 45
+    assert scheduler.deferred > 0
+
+
+def test_polling_waits_for_busy_link():
+    bot = make_bot()
+    scheduler = bot.scheduler()
+    bot.conn.outbound.add(int(bot.conn.capacity))
+    assert scheduler.poll() == []
+    assert scheduler.deferred == 2
+    assert scheduler.due["light"] == 0
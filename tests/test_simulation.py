@@ -0,0 +1,123 @@
+"""Tests for `memebot.simulation`."""
+
+import time
+
+import pytest
+
+from memebot import communication
+from memebot import simulation
+
+CONFIG = """
+ultrasound 10 front
+ultrasound 11 back
+light_sensor 6 light
+conflict front back
+"""
+
+
+def make_bot(**kw):
+    sim = simulation.Simulation()
+    kw.setdefault("values", {(1, 10): 25.0, (1, 11): 80.0, (4, 6): 300.0})
+    return sim, sim.bot(CONFIG, **kw)
+
+
+def test_clock_runs_events_in_order():
+    clock = simulation.SimClock()
+    ran = []
+    clock.call_at(2.0, ran.append, "b")
+    clock.call_at(1.0, ran.append, "a")
+    clock.call_at(2.0, ran.append, "c")
+    clock.sleep(1.5)
+    assert ran == ["a"]
+    assert clock.now == 1.5
+    assert clock.run_until(lambda: len(ran) == 3, 10)
+    assert ran == ["a", "b", "c"]
+    assert clock.now == 2.0
+    assert not clock.run_until(lambda: False, 5)
+    assert clock.now == 7.0
+
+
+def test_polling_for_five_minutes():
+    sim, bot = make_bot()
+    assert 0 < bot.rtt < 0.01
+    scheduler = bot.scheduler(rate=20).start()
+    started = time.time()
+    sim.run(300)
+    assert time.time() - started < 10
+    assert sim.now >= 300
+    assert scheduler.sent["light"] == 20 * 300 + 1
+    # The sonars share 0.03s slots
+    assert abs(scheduler.sent["front"] - 5000) <= 1
+    assert abs(scheduler.sent["back"] - 5000) <= 1
+    assert bot.front.last_value == 25.0
+    assert bot.manager.stats["timeouts"] == 0
+
+
+def test_long_runs_can_leave_out_what_was_written():
+    sim, bot = make_bot(record=False)
+    bot.scheduler(rate=20).start()
+    sim.run(10)
+    port = bot.conn.s
+    assert port.bytes_written > 0
+    assert port.written == b""
+    assert port.frames == []
+
+
+def test_runs_are_repeatable():
+    results = []
+    for i in range(2):
+        sim, bot = make_bot(latency=0.003, rx_buffer=2)
+        bot.scheduler(rate=50, adaptive=True).start()
+        sim.run(20)
+        results.append((bot.conn.s.frames, dict(bot.manager.stats),
+                        list(bot.manager.window_history)))
+    assert results[0] == results[1]
+
+
+def test_control_loop():
+    sim, bot = make_bot()
+    loop = bot.control_loop(lambda snapshot: [], 100)
+    start = sim.now
+    loop.run(ticks=500)
+    assert sim.now - start == pytest.approx(499 * 0.01)
+    assert loop.misses == 0
+    assert loop.stats()["jitter_max"] == 0
+
+
+def test_timeouts():
+    sim, bot = make_bot(latency=0.01, rx_buffer=2)
+    messages = [communication.UltrasonicSensorRead(10) for i in range(10)]
+    bot.send(*messages, priority=communication.PRIORITY_CONTROL)
+    started = sim.now
+    for message in messages:
+        assert message.wait()
+    lost = [m for m in messages if m.error is not None]
+    assert len(lost) == bot.conn.s.dropped == 8
+    assert bot.manager.stats["timeouts"] == 8
+    assert bot.manager.stats["window_decreases"] == 1
+    # Timed out when the timeout said, in virtual time
+    assert sim.now - started >= bot.manager.min_timeout
+
+
+def test_read_all():
+    sim, bot = make_bot()
+    snapshot = bot.read_all(timeout=1)
+    assert snapshot == {"front": 25.0, "back": 80.0, "light": 300.0}
+    assert not snapshot.stale
+    # The board answers the three in turn, each taking its latency
+    times = sorted(snapshot.times.values())
+    assert times[1] - times[0] == pytest.approx(0.002)
+    assert times[2] - times[1] == pytest.approx(0.002)
+    assert times[0] - snapshot.time < 0.005
+
+
+def test_polling_keeps_within_board_buffer():
+    sim = simulation.Simulation()
+    config = "\n".join("ultrasound %i sonar%i" % (port, port)
+                       for port in range(1, 9))
+    bot = sim.bot(config, latency=0.002, rx_buffer=4)
+    bot.scheduler(rate=1000, max_rate=1000).start()
+    sim.run(5)
+    # All eight are due at once, but go no more than the window at a time
+    assert bot.manager.stats["timeouts"] == 0
+    assert bot.manager.stats["received"] > 0.9 * 5 / 0.002
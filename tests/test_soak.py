@@ -0,0 +1,68 @@
+"""Tests for `memebot.soak`."""
+
+from click.testing import CliRunner
+
+from memebot import cli
+from memebot import emulator
+from memebot import memebot
+from memebot import soak
+
+
+def soak_bot(**kw):
+    port = emulator.EmulatedSerial(record=False, **kw)
+    return memebot.configure(soak.DEFAULT_CONFIG, connection=port)
+
+
+def test_default_config_is_all_read():
+    bot = soak_bot()
+    assert len(bot.sensors()) == len(bot.devices) == 4
+
+
+def test_trend_shrugs_off_a_spike():
+    points = [(t, 10.0) for t in range(40)]
+    points[-1] = (39, 500.0)
+    assert soak.slope(points) > 1
+    assert soak.trend(points) == 0
+    assert soak.trend([(t, 3.0 * t + 1) for t in range(40)]) == 3.0
+    assert soak.trend([(0, 1.0), (1, None)]) is None
+
+
+def test_soak_samples():
+    bot = soak_bot(noise=0.05, seed=1)
+    report = soak.Soak(bot, duration=0.6, interval=0.2).run()
+    assert len(report.samples) >= 2
+    sample = report.samples[-1]
+    assert sample.reads > 0
+    assert sample.traced > 0
+    assert sample.p50 <= sample.p99
+    assert "tuple" in sample.objects or "dict" in sample.objects
+    # The noise costs the decoder frames, but nothing piles up
+    assert bot.conn.stats["skipped_bytes"] > 0
+    assert sample.buffered < 64
+    assert "p99 ms" in report.format()
+
+
+def test_report_fails_on_growth():
+    s = soak.Soak(soak_bot(), duration=100, warmup=0.2,
+                  max_memory_growth=1e6, max_latency_growth=0.01)
+    for t in range(1, 101):
+        s.samples.append(soak.Sample(
+            time=t, traced=1000 * t, rss=None, objects={"dict": 10},
+            handlers=0, buffered=0, reads=10, p50=0.001, p99=0.002))
+    report = soak.Report(s)
+    # 1000 bytes a second
+    assert round(report.memory_growth) == 3600000
+    assert report.latency_growth == 0
+    assert report.rss_growth is None
+    assert not report.ok
+    assert "traced memory grows" in report.failures[0]
+    assert "FAILED" in report.format()
+
+
+def test_cli_soak():
+    runner = CliRunner()
+    result = runner.invoke(cli.main, [
+        'soak', '--duration', '0.4', '--interval', '0.2',
+        '--max-memory-growth', '1e9', '--max-latency-growth', '1e9'])
+    assert result.exit_code == 0, result.output
+    assert result.output.strip().endswith("ok")
@@ -0,0 +1,86 @@
+"""Tests for `memebot.trace`."""
+
+import json
+import threading
+
+from memebot import communication
+from memebot import memebot
+from memebot import trace
+
+
+def test_trace_read(tmpdir):
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    """)
+    seen = []
+    bot.front.request = lambda: _request(bot.front, seen)
+    tracer = bot.trace()
+    bot.read_all()
+    tracer.stop()
+    names = [event[1] for event in tracer.events]
+    for name in ("send", "write", "bytes", "parse", "dispatch", "callback"):
+        assert name in names
+    # The spans for the response follow each other on the reading thread
+    spans = dict((event[1], event) for event in tracer.events
+                 if event[1] in ("parse", "dispatch", "callback"))
+    assert spans["parse"][4] == spans["dispatch"][4] == seen[0]
+    assert spans["dispatch"][2] >= spans["parse"][2] + spans["parse"][3]
+    assert spans["callback"][5] == {"ext_id": 0xa1,
+                                    "request": "UltrasonicSensorRead"}
+    write = [event for event in tracer.events if event[1] == "write"][0]
+    assert write[5] == {"bytes": 7, "ext_ids": [0xa1]}
+
+    path = str(tmpdir.join("serial.json"))
+    tracer.save(path)
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    assert any(e["name"] == "thread_name" and e["tid"] == seen[0]
+               for e in events)
+    send = [e for e in events if e["name"] == "send"][0]
+    assert send["ph"] == "X" and send["cat"] == "memebot"
+    assert send["args"]["ext_ids"] == [0xa1]
+    assert send["dur"] >= 0
+
+
+def _request(sensor, seen):
+    # The sensor's request, noting which thread its callback runs on
+    message = type(sensor).request(sensor)
+    update = message.callback
+
+    def callback(value):
+        seen.append(threading.get_native_id())
+        update(value)
+    message.callback = callback
+    return message
+
+
+def test_tracer_switches_on_and_off():
+    bot = memebot.configure("""
+    connection emulator
+    """)
+    manager, conn = bot.manager, bot.conn
+    tracer = trace.Tracer(manager, size=10)
+    tracer.start()
+    assert "send_many" in manager.__dict__ and "write" in conn.__dict__
+    for i in range(20):
+        bot.send(communication.SevenSegmentDisplay(7, i))
+    # The ring keeps the latest
+    assert len(tracer.events) == 10
+    tracer.stop()
+    assert conn.on_bytes_in is communication._no_hook
+    assert "send_many" not in manager.__dict__
+    assert "write" not in conn.__dict__
+    bot.send(communication.SevenSegmentDisplay(7, 0))
+    assert len(tracer.events) == 10
+    with tracer:
+        bot.send(communication.SevenSegmentDisplay(7, 0))
+    assert tracer.events[-1][1] == "send"
+    assert tracer.events[-1][5] == {"messages": 1, "ext_ids": []}
+
+
+def test_ext_ids_of_a_write():
+    data = communication.UltrasonicSensorRead(10).encode() + \
+        communication.MotorMove(0, 0).encode() + \
+        communication.LightSensorRead(6).encode()
+    assert trace._ext_ids(data) == [0xa1, 0x64]
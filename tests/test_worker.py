@@ -0,0 +1,114 @@
+"""Tests for `memebot.worker`."""
+
+import functools
+import subprocess
+import sys
+import time
+
+import pytest
+
+from memebot import communication
+from memebot import emulator
+from memebot import memebot
+from memebot import worker
+
+
+def test_ring_wraps_around():
+    ring = worker.Ring(64)
+    try:
+        for i in range(50):
+            record = bytes([i]) * (i % 20)
+            assert ring.put(record[:3], record[3:])
+            assert ring.get() == record
+        assert ring.get() is None
+    finally:
+        ring.close(unlink=True)
+
+
+def test_ring_refuses_records_that_dont_fit():
+    ring = worker.Ring(32)
+    try:
+        assert ring.put(b"x" * 20)
+        assert not ring.put(b"y" * 20)
+        assert ring.get() == b"x" * 20
+        assert ring.put(b"y" * 20)
+        assert ring.wait(0.01) == b"y" * 20
+        assert ring.wait(0.01) is None
+    finally:
+        ring.close(unlink=True)
+
+
+def test_worker_connection_round_trips():
+    port = functools.partial(emulator.EmulatedSerial, values={(1, 10): 25.0})
+    conn = worker.WorkerConnection(port)
+    try:
+        conn.manager.launch()
+        messages = [communication.UltrasonicSensorRead(10)
+                    for i in range(50)]
+        conn.manager.send_many(messages)
+        for message in messages:
+            assert message.wait(2)
+            assert message.value == 25.0
+        assert conn.manager.stats["unmatched"] == 0
+    finally:
+        conn.close()
+    assert conn.process.exitcode == 0
+
+
+def test_worker_passes_on_keepalives():
+    port = functools.partial(emulator.EmulatedSerial, keepalive=0.05)
+    conn = worker.WorkerConnection(port)
+    try:
+        conn.manager.launch()
+        deadline = time.monotonic() + 2
+        while conn.heartbeat.beats < 8 and time.monotonic() < deadline:
+            conn.manager.send_many(
+                [communication.SevenSegmentDisplay(7, i) for i in range(10)])
+            time.sleep(0.01)
+        assert conn.heartbeat.interval == pytest.approx(0.05, abs=0.02)
+        # Every command's acknowledgement came through too
+        while conn._acks_seen < conn._acks_due and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert conn._acks_seen == conn._acks_due > 0
+        assert not conn.stalled()
+    finally:
+        conn.close()
+
+
+def test_full_ring_is_back_pressure():
+    port = functools.partial(emulator.EmulatedSerial, values={(1, 10): 25.0})
+    conn = worker.WorkerConnection(port, ring_size=64)
+    try:
+        conn.manager.launch()
+        with pytest.raises(communication.LinkSaturated):
+            conn.manager.send(communication.LedMatrixMessage(
+                8, 0, 0, "x" * 80))
+        assert conn.connected
+        assert conn.s.isOpen()
+        message = communication.UltrasonicSensorRead(10)
+        conn.manager.send(message)
+        assert message.wait(2)
+        assert message.value == 25.0
+        assert conn.manager.in_flight() == 0
+    finally:
+        conn.close()
+
+
+def test_bot_in_worker():
+    bot = memebot.configure("""
+    connection emulator
+    ultrasound 10 front
+    """, worker=True)
+    try:
+        assert bot.rtt is not None
+        assert bot.conn.process.is_alive()
+    finally:
+        bot.conn.close()
+
+
+def test_worker_imported_only_when_used():
+    code = ("import sys, memebot.memebot; "
+            "print('multiprocessing' in sys.modules)")
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.strip() == b"False"